@@ -3,7 +3,10 @@ The flask application package.
 """
 
 import os
-from flask import Flask, redirect, jsonify, request, url_for, render_template, send_from_directory
+from flask import Flask, redirect, jsonify, request, url_for, render_template
+from werkzeug.exceptions import NotFound
+from werkzeug.utils import safe_join
+from gogrow_app.caching import send_cached, fingerprinted_url
 app = Flask(__name__)
 app.debug = True
 
@@ -11,13 +14,23 @@ versionNum = "1.0.0"
 
 app.config['STATIC_FOLDER'] = os.path.join(app.root_path, 'static')
 
-@app.route('/static/<path:path>')
-def serve_static(path):
-    static_folder = app.config['STATIC_FOLDER']
-    if path.startswith('icons'):
-        return send_from_directory(os.path.join(static_folder, 'icons'), path[len('icons/'):])
-    else:
-        return send_from_directory(static_folder, path)
+# Takes over Flask's own /static/<path:filename> route, so static files get content hash ETags
+# and fingerprinted URLs (see caching.py)
+@app.endpoint('static')
+def serve_static(filename):
+    path = safe_join(app.config['STATIC_FOLDER'], filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+    return send_cached(path)
+
+@app.template_global()
+def static_url(filename):
+    """URL of a static file with its content hash, so templates can link bundles that are cached for good."""
+    url = url_for('static', filename=filename)
+    try:
+        return fingerprinted_url(url, os.path.join(app.config['STATIC_FOLDER'], filename))
+    except OSError:
+        return url
 
 @app.route('/version')
 def version():
@@ -0,0 +1,480 @@
+"""
+Incremental, deduplicating map backups for /backup and /restore.
+
+A snapshot is a small JSON manifest in the backups folder that lists the map's files and, for each,
+the SHA-256 of its CHUNK_SIZE pieces. Each piece is stored once, compressed, in
+backups/.chunks/<first 2 hex digits>/<sha256>.<codec> - whichever snapshot or map it came from - so a
+map image that never changes costs nothing after the first snapshot, and of the database only the
+changed chunks are new. Files whose size, mtime and inode match the map's previous snapshot aren't
+even read again.
+
+The database is copied with SQLite's online backup API, so the copy is consistent while the map is
+being written to. New chunks are compressed on a thread pool (zlib and zstd release the GIL); zstd
+is used when the zstandard package is installed, gzip otherwise. Both can be read either way.
+
+/backups lists the snapshots (and the .tar.gz backups of earlier versions) from a small index in
+backups/.index, which only looks at the directory again when its mtime changes. Restores run as a
+background job (restore_backup): the backup is checked first, reassembled - decompressing chunks in
+parallel - or streamed from the tarball into a hidden staging directory next to the maps, and then
+renamed into place, so a map is never half restored.
+
+Deleting a snapshot deletes the chunks no other snapshot references. Snapshots, restores, deletes and
+garbage collection hold a write transaction on backups/.lock, so they also exclude each other across
+processes (waitress workers, scripts) sharing the backups folder.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import zlib
+import shutil
+import sqlite3
+import hashlib
+import tarfile
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from gogrow_app.database import get_db_connection
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, chunks are gzipped without it
+    zstandard = None
+
+SNAPSHOT_SUFFIX = '.snapshot.json'
+TARBALL_SUFFIX = '.tar.gz'
+CHUNK_DIR_NAME = '.chunks'
+TEMP_DIR_NAME = '.tmp'
+LOCK_FILE_NAME = '.lock'
+LOCK_TIMEOUT = 3600  # seconds to wait for a snapshot, restore or garbage collection in another process
+INDEX_DIR_NAME = '.index'
+RESTORE_DIR_PREFIX = '.restore-'
+PROGRESS_INTERVAL = 0.5  # seconds between progress reports of a restore
+CHUNK_SIZE = 1024 * 1024
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+MANIFEST_VERSION = 1
+
+def compress(data, codec):
+    if codec == 'zst':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, GZIP_LEVEL)
+
+def decompress(data, codec):
+    if codec == 'zst':
+        if zstandard is None:
+            raise ValueError("This backup was compressed with zstd - install the zstandard package to restore it")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+def is_snapshot(name):
+    return name.endswith(SNAPSHOT_SUFFIX)
+
+def is_backup(name):
+    return is_snapshot(name) or name.endswith(TARBALL_SUFFIX)
+
+def safe_path_parts(path):
+    """The parts of a relative path in a backup, raising ValueError when it could point outside the restore."""
+    parts = [part for part in path.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or path.startswith(('/', '\\')) or ':' in parts[0] or '..' in parts:
+        raise ValueError(f"Backup contains invalid paths: {path}")
+    return parts
+
+def tarball_folder(name):
+    # Tarballs were named <folder>_<%Y-%m-%d_%H-%M-%S>.tar.gz
+    match = re.match(r'^(.+)_\d{4}-\d\d-\d\d_\d\d-\d\d-\d\d\.tar\.gz$', name)
+    return match.group(1) if match else None
+
+class SnapshotStore:
+    def __init__(self, root, workers=4):
+        self.root = root
+        self.chunk_root = os.path.join(root, CHUNK_DIR_NAME)
+        self.workers = workers
+        self.codec = 'zst' if zstandard else 'gz'
+        self.index_path = os.path.join(root, INDEX_DIR_NAME, 'backups.db')
+        self._lock = threading.Lock()  # one snapshot at a time, and no garbage collection during one
+        self._index_lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        """
+        Holds the store for a snapshot, restore, delete or garbage collection. The thread lock covers this
+        process; a write transaction on backups/.lock covers the other processes using the same folder.
+        """
+        with self._lock:
+            os.makedirs(self.root, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.root, LOCK_FILE_NAME), timeout=LOCK_TIMEOUT)
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                yield
+            finally:
+                conn.close()  # rolls back the empty transaction, releasing the lock
+
+    def chunk_path(self, sha256, codec):
+        return os.path.join(self.chunk_root, sha256[:2], f'{sha256}.{codec}')
+
+    def find_chunk(self, sha256):
+        """(path, codec) of a stored chunk, or None."""
+        for codec in ('zst', 'gz'):
+            path = self.chunk_path(sha256, codec)
+            if os.path.exists(path):
+                return path, codec
+        return None
+
+    def _store_chunk(self, sha256, data):
+        path = self.chunk_path(sha256, self.codec)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        body = compress(data, self.codec)
+        temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(body)
+        os.replace(temp_path, path)
+        return len(body)
+
+    def _snapshot_path(self, name):
+        if not is_snapshot(name) or os.path.basename(name) != name:
+            raise ValueError("Invalid snapshot name")
+        return os.path.join(self.root, name)
+
+    def read_manifest(self, name):
+        with open(self._snapshot_path(name)) as file:
+            return json.load(file)
+
+    def _connect_index(self):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        conn = sqlite3.connect(self.index_path, timeout=30)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS backups (
+                name TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                folder TEXT,
+                created_at REAL NOT NULL,
+                size INTEGER NOT NULL,
+                stored INTEGER NOT NULL,
+                files INTEGER
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS backups_folder ON backups (folder, created_at)')
+        conn.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value)')
+        return conn
+
+    def _index_row(self, name, manifest=None):
+        if is_snapshot(name):
+            manifest = manifest or self.read_manifest(name)
+            return (name, 'snapshot', manifest['folder'], manifest['created_at'], manifest['size'], manifest['stored'], len(manifest['files']))
+        st = os.stat(os.path.join(self.root, name))
+        return (name, 'tarball', tarball_folder(name), st.st_mtime, st.st_size, st.st_size, None)
+
+    def _sync_index(self, conn):
+        """Brings the index up to date with the backups directory - a stat() when nothing changed there."""
+        if not os.path.isdir(self.root):
+            return
+        mtime = os.stat(self.root).st_mtime_ns
+        row = conn.execute("SELECT value FROM state WHERE key = 'mtime_ns'").fetchone()
+        if row is not None and row[0] == mtime:
+            return
+        names = {name for name in os.listdir(self.root) if is_backup(name) and os.path.isfile(os.path.join(self.root, name))}
+        known = {name for name, in conn.execute('SELECT name FROM backups')}
+        for name in known - names:
+            conn.execute('DELETE FROM backups WHERE name = ?', (name,))
+        for name in names - known:
+            try:
+                conn.execute('INSERT OR REPLACE INTO backups VALUES (?, ?, ?, ?, ?, ?, ?)', self._index_row(name))
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Skipping unreadable backup {name}: {e}")
+        conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('mtime_ns', ?)", (mtime,))
+        conn.commit()
+
+    def list_backups(self):
+        """The backups, newest first, as dicts with name, kind ('snapshot' or 'tarball'), folder, created_at, size, stored and files."""
+        with self._index_lock:
+            conn = self._connect_index()
+            try:
+                self._sync_index(conn)
+                rows = conn.execute('SELECT name, kind, folder, created_at, size, stored, files FROM backups ORDER BY created_at DESC, name DESC').fetchall()
+            finally:
+                conn.close()
+        return [dict(zip(('name', 'kind', 'folder', 'created_at', 'size', 'stored', 'files'), row)) for row in rows]
+
+    def snapshots(self, folder=None):
+        """Names of the snapshots (of folder), oldest first."""
+        with self._index_lock:
+            conn = self._connect_index()
+            try:
+                self._sync_index(conn)
+                if folder is None:
+                    rows = conn.execute("SELECT name FROM backups WHERE kind = 'snapshot' ORDER BY created_at, name").fetchall()
+                else:
+                    rows = conn.execute("SELECT name FROM backups WHERE kind = 'snapshot' AND folder = ? ORDER BY created_at, name", (folder,)).fetchall()
+            finally:
+                conn.close()
+        return [name for name, in rows]
+
+    def _add_to_index(self, name, manifest):
+        with self._index_lock:
+            conn = self._connect_index()
+            try:
+                conn.execute('INSERT OR REPLACE INTO backups VALUES (?, ?, ?, ?, ?, ?, ?)', self._index_row(name, manifest))
+                conn.commit()
+                self._sync_index(conn)  # notes the directory's new mtime
+            finally:
+                conn.close()
+
+    def create(self, folder, folder_path, db_path, exclude_dirs=()):
+        """
+        Takes a snapshot of the map in folder_path, leaving out the directories named in exclude_dirs
+        (caches like tiles). Returns its manifest, with 'name' and 'stored' (compressed bytes written).
+        """
+        with self._locked():
+            previous = self.snapshots(folder)
+            known = {}
+            if previous:
+                known = {entry['path']: entry for entry in self.read_manifest(previous[-1])['files']}
+            os.makedirs(os.path.join(self.root, TEMP_DIR_NAME), exist_ok=True)
+            db_copy = os.path.join(self.root, TEMP_DIR_NAME, f'{uuid.uuid4().hex}.db')
+            db_name = os.path.relpath(db_path, folder_path)
+
+            stats = {'stored': 0}
+            seen = set()  # chunks of this snapshot, a chunk that repeats is compressed once
+            files = []
+            with ThreadPoolExecutor(self.workers) as pool:
+                pending = set()
+                try:
+                    for path, relative in self._walk(folder_path, exclude_dirs):
+                        if relative in (db_name, f'{db_name}-wal', f'{db_name}-shm', f'{db_name}-journal'):
+                            continue  # the live database and its -wal and -shm files, copied below
+                        st = os.stat(path)
+                        entry = {'path': relative, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'inode': st.st_ino}
+                        before = known.get(relative)
+                        if before and all(before.get(key) == entry[key] for key in ('size', 'mtime_ns', 'inode')):
+                            entry['chunks'] = before['chunks']
+                        else:
+                            entry['chunks'] = self._add_file(path, pool, pending, stats, seen)
+                        files.append(entry)
+
+                    if os.path.exists(db_path):
+                        self._copy_database(db_path, db_copy)
+                        entry = {'path': db_name, 'size': os.path.getsize(db_copy)}
+                        entry['chunks'] = self._add_file(db_copy, pool, pending, stats, seen)
+                        files.append(entry)
+                    for future in pending:
+                        stats['stored'] += future.result()
+                finally:
+                    if os.path.exists(db_copy):
+                        os.remove(db_copy)
+
+            manifest = {
+                'version': MANIFEST_VERSION,
+                'folder': folder,
+                'created_at': time.time(),
+                'size': sum(entry['size'] for entry in files),
+                'stored': stats['stored'],
+                'files': files
+            }
+            name = self._write_manifest(folder, manifest)
+            self._add_to_index(name, manifest)
+        return dict(manifest, name=name)
+
+    def _walk(self, folder_path, exclude_dirs):
+        for directory, subdirectories, filenames in os.walk(folder_path):
+            if directory == folder_path:
+                subdirectories[:] = [name for name in subdirectories if name not in exclude_dirs]
+            for filename in sorted(filenames):
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(directory, filename)
+                yield path, os.path.relpath(path, folder_path).replace(os.sep, '/')
+
+    def _copy_database(self, db_path, destination):
+        source = get_db_connection(db_path)
+        target = sqlite3.connect(destination)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+
+    def _add_file(self, path, pool, pending, stats, seen):
+        """Chunks a file, queueing the compression of chunks that aren't stored yet. Returns the chunk hashes."""
+        chunks = []
+        with open(path, 'rb') as file:
+            for data in iter(lambda: file.read(CHUNK_SIZE), b''):
+                sha256 = hashlib.sha256(data).hexdigest()
+                chunks.append(sha256)
+                if sha256 in seen or self.find_chunk(sha256):
+                    continue
+                seen.add(sha256)
+                # Bounds the chunks held in memory while they wait for a worker
+                while len(pending) >= self.workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        stats['stored'] += future.result()
+                    pending -= done
+                pending.add(pool.submit(self._store_chunk, sha256, data))
+        return chunks
+
+    def _write_manifest(self, folder, manifest):
+        stamp = datetime.fromtimestamp(manifest['created_at']).strftime('%Y-%m-%d_%H-%M-%S')
+        name = f'{folder}_{stamp}{SNAPSHOT_SUFFIX}'
+        counter = 1
+        while os.path.exists(os.path.join(self.root, name)):
+            counter += 1
+            name = f'{folder}_{stamp}-{counter}{SNAPSHOT_SUFFIX}'
+        temp_path = os.path.join(self.root, TEMP_DIR_NAME, f'{uuid.uuid4().hex}.json')
+        with open(temp_path, 'w') as file:
+            json.dump(manifest, file)
+        os.replace(temp_path, os.path.join(self.root, name))
+        return name
+
+    def check(self, name):
+        """Pre-flight check of a snapshot before it is restored - returns its manifest or raises ValueError."""
+        manifest = self.read_manifest(name)
+        if manifest.get('version') != MANIFEST_VERSION or not re.match(r'^[\w-]+$', manifest.get('folder', '')):
+            raise ValueError(f"{name} isn't a snapshot this version can restore")
+        for entry in manifest['files']:
+            safe_path_parts(entry['path'])
+        missing = {sha256 for entry in manifest['files'] for sha256 in entry['chunks'] if not self.find_chunk(sha256)}
+        if missing:
+            raise ValueError(f"The backup is damaged - {len(missing)} of its chunks are missing")
+        return manifest
+
+    def _read_chunk(self, sha256):
+        chunk_path, codec = self.find_chunk(sha256)
+        with open(chunk_path, 'rb') as chunk:
+            return decompress(chunk.read(), codec)
+
+    def _read_chunks(self, pool, chunks):
+        """Yields the data of chunks in order, decompressing the next ones on the pool meanwhile."""
+        ahead = self.workers * 2
+        futures = [pool.submit(self._read_chunk, sha256) for sha256 in chunks[:ahead]]
+        for index in range(len(chunks)):
+            if index + ahead < len(chunks):
+                futures.append(pool.submit(self._read_chunk, chunks[index + ahead]))
+            yield futures[index].result()
+            futures[index] = None
+
+    def restore(self, name, destination, report=None):
+        """
+        Writes the files of a snapshot into the directory destination, which must not exist yet.
+        report(bytes written, total bytes) is called after every chunk.
+        """
+        with self._locked():  # garbage collection mustn't delete chunks while they are read
+            manifest = self.check(name)
+            os.makedirs(destination)
+            done = 0
+            with ThreadPoolExecutor(self.workers) as pool:
+                for entry in manifest['files']:
+                    path = os.path.join(destination, *safe_path_parts(entry['path']))
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path, 'wb') as file:
+                        for data in self._read_chunks(pool, entry['chunks']):
+                            file.write(data)
+                            done += len(data)
+                            if report:
+                                report(done, manifest['size'])
+            return manifest
+
+    def delete(self, name):
+        """
+        Deletes a backup. The chunks only a deleted snapshot used are collected right away. Returns how many
+        chunks were deleted.
+        """
+        if not is_backup(name) or os.path.basename(name) != name:
+            raise ValueError("Invalid backup file name")
+        path = os.path.join(self.root, name)
+        if not os.path.exists(path):
+            raise FileNotFoundError(name)
+        with self._locked():
+            os.remove(path)
+            with self._index_lock:
+                conn = self._connect_index()
+                try:
+                    conn.execute('DELETE FROM backups WHERE name = ?', (name,))
+                    conn.commit()
+                    self._sync_index(conn)
+                finally:
+                    conn.close()
+            return self._collect_garbage() if is_snapshot(name) else 0
+
+    def collect_garbage(self):
+        """Deletes the chunks no snapshot references any more (after snapshots were deleted). Returns how many."""
+        with self._locked():
+            return self._collect_garbage()
+
+    def _collect_garbage(self):
+        referenced = set()
+        for name in self.snapshots():
+            for entry in self.read_manifest(name)['files']:
+                referenced.update(entry['chunks'])
+        removed = 0
+        if not os.path.isdir(self.chunk_root):
+            return removed
+        for prefix in os.listdir(self.chunk_root):
+            directory = os.path.join(self.chunk_root, prefix)
+            for filename in os.listdir(directory):
+                if filename.split('.')[0] not in referenced:
+                    os.remove(os.path.join(directory, filename))
+                    removed += 1
+        shutil.rmtree(os.path.join(self.root, TEMP_DIR_NAME), ignore_errors=True)
+        return removed
+
+def restore_tarball(path, destination, report=None):
+    """
+    Extracts a .tar.gz backup into destination as a stream - the archive is read once, front to back,
+    and every member is checked before it is written. report(bytes read, archive size) follows along.
+    gzip can't be decompressed in parallel, unlike the chunks of a snapshot.
+    """
+    size = os.path.getsize(path)
+    os.makedirs(destination)
+    with open(path, 'rb') as raw, tarfile.open(fileobj=raw, mode='r|gz') as tar:
+        for member in tar:
+            safe_path_parts(member.name)
+            if not (member.isdir() or member.isfile()):
+                raise ValueError(f"Backup contains links or special files: {member.name}")
+            tar.extract(member, destination, filter='data')
+            if report:
+                report(raw.tell(), size)
+
+def swap_in(staging_path, img_dir):
+    """
+    Moves what was restored into staging_path to img_dir - a rename each, so every map appears whole.
+    Raises ValueError, and moves nothing, when a map with the same name exists.
+    """
+    names = os.listdir(staging_path)
+    conflicts = [name for name in names if os.path.exists(os.path.join(img_dir, name))]
+    if conflicts:
+        raise ValueError(f"A directory with the same name already exists ({', '.join(conflicts)}). Please rename or delete it before proceeding.")
+    for name in names:
+        os.rename(os.path.join(staging_path, name), os.path.join(img_dir, name))
+    return names
+
+def restore_backup(payload, report_progress):
+    """Job handler (see jobs.py) - restores a snapshot or tarball from the backups directory into img_dir."""
+    store = SnapshotStore(payload['backups_dir'], workers=payload.get('workers', 4))
+    name = payload['backup_file']
+    img_dir = payload['img_dir']
+    staging_path = os.path.join(img_dir, f'{RESTORE_DIR_PREFIX}{uuid.uuid4().hex}')
+    last_report = [0.0]
+
+    def report(done, total):
+        now = time.monotonic()
+        if now - last_report[0] >= PROGRESS_INTERVAL:
+            last_report[0] = now
+            # The last few percent are left for moving the map into place
+            report_progress(0.99 * done / total if total else 0.0, f"{done / 1e6:.1f} of {total / 1e6:.1f} MB")
+
+    try:
+        if is_snapshot(name):
+            manifest = store.restore(name, os.path.join(staging_path, store.read_manifest(name)['folder']), report)
+            size = manifest['size']
+        else:
+            restore_tarball(os.path.join(store.root, os.path.basename(name)), staging_path, report)
+            size = os.path.getsize(os.path.join(store.root, os.path.basename(name)))
+        report_progress(0.99, "Moving the restored files into place")
+        folders = swap_in(staging_path, img_dir)
+    finally:
+        shutil.rmtree(staging_path, ignore_errors=True)
+    return {'backup_file': name, 'folders': folders, 'size': size}
@@ -0,0 +1,182 @@
+"""
+Many marker, line and journal writes in one transaction, for /maps/<folder>/batch.
+
+Each operation is checked on its own - invalid ones are reported and left out - and consecutive
+operations with the same kind, op and fields are written with one executemany(), so a batch costs one
+transaction (one fsync) however many rows it has. Operations are applied in the order they were given.
+
+An operation is a JSON object like
+    {"op": "insert", "kind": "markers", "lat": 1, "lng": 2, "info": "", "iconType": "leaf.svg", "iconColor": "#00ff00"}
+    {"op": "update", "kind": "markers", "id": "...", "iconColor": "#ff0000"}
+    {"op": "delete", "kind": "lines", "id": "..."}
+"""
+
+import time
+import uuid
+from datetime import datetime
+from itertools import groupby
+from gogrow_app.database import JOURNAL_DATE_FORMAT, journal_timestamp
+
+MAX_BATCH_OPERATIONS = 50000
+ID_QUERY_CHUNK = 500  # ids per "id IN (...)" query, well under SQLite's limit on bound parameters
+
+BATCH_OPS = ('insert', 'update', 'delete')
+# kind -> fields an insert needs, fields it may leave out with their defaults, fields that must be numbers
+BATCH_TABLES = {
+    'markers': {
+        'required': ('lat', 'lng', 'info', 'iconType', 'iconColor'),
+        'defaults': {'markerNotes': ''},
+        'numeric': ('lat', 'lng')
+    },
+    'lines': {
+        'required': ('start_lat', 'start_lng', 'end_lat', 'end_lng', 'info', 'color'),
+        'defaults': {'notes': ''},
+        'numeric': ('start_lat', 'start_lng', 'end_lat', 'end_lng')
+    },
+    'journals': {
+        'required': ('entry_title', 'entry_content'),
+        'defaults': {'linked_item_id': '', 'is_favorite': 'no', 'entry_date': None},  # None: the current date (see set_entry_time)
+        'numeric': ()
+    }
+}
+# The id fields of the items the API returns, accepted in place of "id"
+ID_ALIASES = {'markers': 'markerId', 'lines': 'lineId', 'journals': 'journalId'}
+
+def journal_date():
+    # The format POST /journals/<dir> uses
+    return datetime.now().strftime(JOURNAL_DATE_FORMAT)
+
+def set_entry_time(fields):
+    # entry_time follows entry_date, which is written in the usual format even when it was given as ISO-8601
+    if fields.get('entry_date') is None:
+        fields['entry_date'] = journal_date()
+        fields['entry_time'] = int(time.time())
+    else:
+        fields['entry_time'] = journal_timestamp(fields['entry_date'])
+        fields['entry_date'] = datetime.fromtimestamp(fields['entry_time']).strftime(JOURNAL_DATE_FORMAT)
+
+def parse_operation(operation):
+    """Checks one operation and returns (kind, op, id, fields), raising ValueError when it is invalid."""
+    if not isinstance(operation, dict):
+        raise ValueError("An operation must be a JSON object")
+    op = operation.get('op')
+    kind = operation.get('kind')
+    if op not in BATCH_OPS:
+        raise ValueError(f"op must be one of {', '.join(BATCH_OPS)}")
+    if kind not in BATCH_TABLES:
+        raise ValueError(f"kind must be one of {', '.join(BATCH_TABLES)}")
+    spec = BATCH_TABLES[kind]
+    item_id = operation.get('id', operation.get(ID_ALIASES[kind]))
+    if item_id is not None and (not isinstance(item_id, str) or not item_id):
+        raise ValueError("id must be a non-empty string")
+
+    columns = spec['required'] + tuple(spec['defaults'])
+    fields = {column: operation[column] for column in columns if column in operation}
+    null_fields = [column for column in spec['required'] if column in fields and fields[column] is None]
+    if null_fields:
+        raise ValueError(f"Fields can't be null: {', '.join(null_fields)}")
+    for column in spec['numeric']:
+        if column in fields:
+            value = fields[column]
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"{column} must be a number")
+
+    if op == 'insert':
+        missing = [column for column in spec['required'] if column not in fields]
+        if missing:
+            raise ValueError(f"Missing fields: {', '.join(missing)}")
+        for column, default in spec['defaults'].items():
+            if fields.get(column) is None and column != 'entry_date':
+                fields[column] = default
+        if kind == 'journals':
+            set_entry_time(fields)
+        return kind, op, item_id or str(uuid.uuid4()), fields
+
+    if item_id is None:
+        raise ValueError(f"{op} needs the id of the item")
+    if op == 'update' and not fields:
+        raise ValueError(f"Nothing to update - give one or more of {', '.join(columns)}")
+    if op == 'update' and 'entry_date' in fields:
+        set_entry_time(fields)
+    return kind, op, item_id, fields if op == 'update' else {}
+
+def existing_ids(conn, table, ids):
+    found = set()
+    ids = list(set(ids))
+    for start in range(0, len(ids), ID_QUERY_CHUNK):
+        chunk = ids[start:start + ID_QUERY_CHUNK]
+        placeholders = ', '.join('?' * len(chunk))
+        found.update(row[0] for row in conn.execute(f'SELECT id FROM {table} WHERE id IN ({placeholders})', chunk))
+    return found
+
+def _apply_run(conn, kind, op, columns, run, results):
+    """Writes a run of operations with the same kind, op and fields with one executemany()."""
+    present = existing_ids(conn, kind, [item_id for _, _, _, item_id, _ in run])
+    rows = []
+    for index, _, _, item_id, fields in run:
+        if op == 'insert' and item_id in present:
+            results[index] = {'index': index, 'id': item_id, 'ok': False, 'error': f"{kind} {item_id} already exists"}
+            continue
+        if op != 'insert' and item_id not in present:
+            results[index] = {'index': index, 'id': item_id, 'ok': False, 'error': f"{kind} {item_id} not found"}
+            continue
+        if op == 'insert':
+            present.add(item_id)  # a second insert of the same id in this run is a duplicate too
+            rows.append((item_id,) + tuple(fields[column] for column in columns))
+        elif op == 'update':
+            rows.append(tuple(fields[column] for column in columns) + (item_id,))
+        else:
+            rows.append((item_id,))
+        results[index] = {'index': index, 'id': item_id, 'ok': True}
+
+    if not rows:
+        return
+    if op == 'insert':
+        conn.executemany(f"INSERT INTO {kind} (id, {', '.join(columns)}) VALUES ({', '.join('?' * (len(columns) + 1))})", rows)
+    elif op == 'update':
+        conn.executemany(f"UPDATE {kind} SET {', '.join(f'{column} = ?' for column in columns)} WHERE id = ?", rows)
+    else:
+        conn.executemany(f'DELETE FROM {kind} WHERE id = ?', rows)
+
+def apply_batch(conn, operations, atomic=False, before_commit=None):
+    """
+    Applies operations in one transaction. Returns a result per operation - {'index', 'id', 'ok'} plus
+    'error' when it failed - and the kinds that were written to. With atomic, nothing is written when
+    any operation fails. before_commit(conn, results) can write more in the same transaction.
+    """
+    results = [None] * len(operations)
+    parsed = []
+    for index, operation in enumerate(operations):
+        try:
+            kind, op, item_id, fields = parse_operation(operation)
+        except ValueError as e:
+            item_id = operation.get('id') if isinstance(operation, dict) else None
+            results[index] = {'index': index, 'id': item_id, 'ok': False, 'error': str(e)}
+            continue
+        parsed.append((index, kind, op, item_id, fields))
+    if atomic and len(parsed) < len(operations):
+        for index, _, _, item_id, _ in parsed:
+            results[index] = {'index': index, 'id': item_id, 'ok': True}
+        return _not_applied(results), set()
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for (kind, op, columns), run in groupby(parsed, key=lambda item: (item[1], item[2], tuple(sorted(item[4])))):
+            _apply_run(conn, kind, op, columns, list(run), results)
+        if atomic and not all(result['ok'] for result in results):
+            conn.rollback()
+            return _not_applied(results), set()
+        if before_commit:
+            before_commit(conn, results)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return results, {kind for index, kind, _, _, _ in parsed if results[index]['ok']}
+
+def _not_applied(results):
+    for result in results:
+        if result['ok']:
+            result['ok'] = False
+            result['error'] = "Not applied because another operation failed"
+    return results
@@ -0,0 +1,210 @@
+"""
+Content-addressed store for uploaded images, so the same photo is only stored (and decoded) once.
+
+Blobs live in img/.blobs/<first 2 hex digits>/<sha256>. Map images and journal pictures are hard links to
+their blob, so every existing path keeps working while the bytes are shared. Where hard links aren't
+supported the file is copied instead (no saving, but nothing breaks). Things derived from a blob - its
+thumbnail, the .jpg a RAW file decodes to and its tile pyramid - are kept next to it and reused by every
+map that references it. index.db counts the references from maps and journals.
+
+A blob goes away with its last reference: when a file that referenced it is replaced by another
+blob's, right away, and when files were deleted or replaced outside GoGrow, by collect_garbage()
+(the collect_blob_garbage job).
+"""
+
+import os
+import time
+import uuid
+import shutil
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+BLOB_DIR_NAME = '.blobs'
+HASH_CHUNK_SIZE = 1024 * 1024
+INODE_CACHE_SIZE = 4096
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def place_link(source, destination):
+    """Makes destination a hard link to source (or a copy where links aren't possible), replacing it atomically."""
+    temp_path = os.path.join(os.path.dirname(destination), f'.{uuid.uuid4().hex}.tmp')
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        shutil.copy2(source, temp_path)
+    os.replace(temp_path, destination)
+
+class BlobStore:
+    def __init__(self, root, inode_cache_size=INODE_CACHE_SIZE):
+        self.root = root
+        self.inode_cache_size = inode_cache_size
+        self.db_path = os.path.join(root, 'index.db')
+        self._lock = threading.Lock()
+        self._initialized = False
+        self._inode_cache = OrderedDict()  # (inode, mtime) of a file -> sha256 of the blob it links to, or None; least recently used first
+
+    def _connect(self):
+        if not self._initialized:
+            os.makedirs(self.root, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        if not self._initialized:
+            with self._lock:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('CREATE TABLE IF NOT EXISTS blobs (sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL, inode INTEGER, created_at REAL NOT NULL)')
+                conn.execute('CREATE INDEX IF NOT EXISTS blobs_inode ON blobs (inode)')
+                conn.execute('CREATE TABLE IF NOT EXISTS refs (path TEXT PRIMARY KEY, sha256 TEXT NOT NULL, kind TEXT NOT NULL)')
+                conn.execute('CREATE INDEX IF NOT EXISTS refs_sha256 ON refs (sha256)')
+                # e.g. (sha256 of a .dng, 'jpg') -> sha256 of the .jpg it was decoded to
+                conn.execute('CREATE TABLE IF NOT EXISTS derived (source_sha256 TEXT NOT NULL, kind TEXT NOT NULL, sha256 TEXT NOT NULL, PRIMARY KEY (source_sha256, kind))')
+                conn.commit()
+                self._initialized = True
+        return conn
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def derived_path(self, sha256, name):
+        return os.path.join(self.root, sha256[:2], f'{sha256}.{name}')
+
+    def tiles_dir(self, sha256):
+        return self.derived_path(sha256, 'tiles')
+
+    def add_file(self, path, kind, sha256=None):
+        """
+        Stores the file at path, which becomes a reference to its blob. When the blob already existed the
+        file is replaced by a link to it. Returns the sha256 and whether the blob already existed.
+        """
+        sha256 = sha256 or hash_file(path)
+        blob = self.blob_path(sha256)
+        conn = self._connect()
+        try:
+            # The write lock is held while the blob is linked, so it can't be released in between
+            conn.execute('BEGIN IMMEDIATE')
+            existed = os.path.exists(blob)
+            if existed:
+                if not os.path.samefile(path, blob):
+                    place_link(blob, path)
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                place_link(path, blob)
+            st = os.stat(blob)
+            conn.execute('INSERT OR REPLACE INTO blobs (sha256, size, inode, created_at) VALUES (?, ?, ?, COALESCE((SELECT created_at FROM blobs WHERE sha256=?), ?))',
+                         (sha256, st.st_size, st.st_ino, sha256, time.time()))
+            self._set_ref(conn, path, sha256, kind)
+            conn.commit()
+        finally:
+            conn.close()
+        return sha256, existed
+
+    def link_blob(self, sha256, path, kind):
+        """Places a reference to an existing blob at path - False if the blob is gone."""
+        blob = self.blob_path(sha256)
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            if not os.path.exists(blob):
+                conn.rollback()
+                return False
+            place_link(blob, path)
+            self._set_ref(conn, path, sha256, kind)
+            conn.commit()
+        finally:
+            conn.close()
+        return True
+
+    def _set_ref(self, conn, path, sha256, kind):
+        # A file that referenced another blob was replaced - that blob goes when this was its last reference
+        path = os.path.abspath(path)
+        row = conn.execute('SELECT sha256 FROM refs WHERE path=?', (path,)).fetchone()
+        conn.execute('INSERT OR REPLACE INTO refs (path, sha256, kind) VALUES (?, ?, ?)', (path, sha256, kind))
+        if row and row[0] != sha256 and not conn.execute('SELECT EXISTS (SELECT 1 FROM refs WHERE sha256=?)', (row[0],)).fetchone()[0]:
+            self._delete_blob(conn, row[0])
+
+    def _delete_blob(self, conn, sha256):
+        # The blob and everything derived from it (thumbnail, tiles) share its name as a prefix
+        prefix = os.path.join(self.root, sha256[:2])
+        if os.path.isdir(prefix):
+            for name in os.listdir(prefix):
+                if name.startswith(sha256):
+                    path = os.path.join(prefix, name)
+                    shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+        conn.execute('DELETE FROM blobs WHERE sha256=?', (sha256,))
+        conn.execute('DELETE FROM derived WHERE sha256=?', (sha256,))
+        self._inode_cache.clear()
+
+    def get_derived(self, source_sha256, kind):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT sha256 FROM derived WHERE source_sha256=? AND kind=?', (source_sha256, kind)).fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else None
+
+    def set_derived(self, source_sha256, kind, sha256):
+        conn = self._connect()
+        try:
+            conn.execute('INSERT OR REPLACE INTO derived (source_sha256, kind, sha256) VALUES (?, ?, ?)', (source_sha256, kind, sha256))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def sha256_of(self, path):
+        """Returns the sha256 of the blob the file at path links to, or None if it isn't a blob reference."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = (st.st_ino, st.st_mtime_ns)
+        with self._lock:
+            if key in self._inode_cache:
+                self._inode_cache.move_to_end(key)
+                return self._inode_cache[key]
+        if not os.path.exists(self.db_path):
+            return None
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT sha256 FROM blobs WHERE inode=?', (st.st_ino,)).fetchone()
+        finally:
+            conn.close()
+        sha256 = row[0] if row and os.path.samefile(path, self.blob_path(row[0])) else None
+        with self._lock:
+            self._inode_cache[key] = sha256
+            while len(self._inode_cache) > self.inode_cache_size:
+                self._inode_cache.popitem(last=False)
+        return sha256
+
+    def tiles_dir_for(self, source_path, fallback):
+        # Maps showing the same image share one tile pyramid
+        sha256 = self.sha256_of(source_path)
+        return self.tiles_dir(sha256) if sha256 else fallback
+
+    def collect_garbage(self):
+        """Deletes blobs (and what was derived from them) that no map or journal references any more."""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            # Forget references whose file was deleted or replaced by something else
+            for path, sha256 in conn.execute('SELECT path, sha256 FROM refs').fetchall():
+                blob = self.blob_path(sha256)
+                if not (os.path.exists(path) and os.path.exists(blob) and os.path.samefile(path, blob)):
+                    conn.execute('DELETE FROM refs WHERE path=?', (path,))
+            unreferenced = [row[0] for row in conn.execute('SELECT sha256 FROM blobs WHERE sha256 NOT IN (SELECT sha256 FROM refs)')]
+            for sha256 in unreferenced:
+                self._delete_blob(conn, sha256)
+            conn.commit()
+        finally:
+            conn.close()
+        self._inode_cache.clear()
+        return len(unreferenced)
+
+def collect_blob_garbage(payload, report_progress):
+    """Job handler (see jobs.py) - deletes the blobs in payload['blob_root'] that nothing references any more."""
+    report_progress(0.0, 'Checking blob references')
+    return {'deleted': BlobStore(payload['blob_root']).collect_garbage()}
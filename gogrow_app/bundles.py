@@ -0,0 +1,71 @@
+"""
+Everything needed to open a map (image URL, markers, lines, journals and the folder list) as one response.
+
+The response's ETag comes from the map database's change counter (see database.py) plus the image
+and folder list, so an unchanged map is answered with a 304 before any row is read. Encoded bodies are
+kept per ETag, so a map is only serialized and compressed once per change.
+"""
+
+import gzip
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+def supported_encodings():
+    return ('br', 'gzip') if brotli else ('gzip',)
+
+def choose_encoding(accept_encodings):
+    """The best Content-Encoding the client accepts, or None to send the body as is."""
+    for encoding in supported_encodings():
+        if accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+def encode(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    return body
+
+class BundleCache:
+    """Encoded bundles of recently opened maps, keyed by (map, ETag) so a change makes them unreachable."""
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (db_path, etag) -> {encoding: bytes}
+
+    def get(self, db_path, etag, encoding, build):
+        """
+        Returns (etag, body) of the bundle in encoding. build() reads the map and returns (etag, JSON bytes) -
+        its etag can be newer than the one asked for when the map changed in between, and is cached under that.
+        """
+        with self._lock:
+            bodies = self._entries.get((db_path, etag))
+            if bodies is not None:
+                self._entries.move_to_end((db_path, etag))
+                if encoding in bodies:
+                    return etag, bodies[encoding]
+                raw = bodies[None]
+
+        if bodies is None:
+            etag, raw = build()
+        body = encode(raw, encoding)
+
+        key = (db_path, etag)
+        with self._lock:
+            self._entries.setdefault(key, {None: raw})[encoding] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return etag, body
+
+bundle_cache = BundleCache()
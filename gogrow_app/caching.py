@@ -0,0 +1,69 @@
+"""
+HTTP caching for files served from disk (/img, /icons and /static).
+
+Responses carry a strong ETag (the SHA-256 of the file) and Last-Modified, so browsers revalidate
+with If-None-Match/If-Modified-Since and get a 304 instead of the file again. URLs made with
+fingerprinted_url() end in ?v=<content hash>: when that still matches the file the response is
+cached for a year as immutable, because an edited file gets a new URL.
+"""
+
+import os
+import hashlib
+import threading
+from flask import request, send_file, Response
+
+IMMUTABLE_MAX_AGE = 31536000
+FINGERPRINT_LENGTH = 12
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_lock = threading.Lock()
+_digests = {}  # path -> ((size, mtime), sha256 hex digest)
+
+def file_digest(path):
+    """SHA-256 of the file, hashed once per version of the file."""
+    st = os.stat(path)
+    version = (st.st_size, st.st_mtime_ns)
+    cached = _digests.get(path)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+    with _lock:
+        _digests[path] = (version, digest)
+    return digest
+
+def fingerprinted_url(url, path, digest=None):
+    return f'{url}?v={(digest or file_digest(path))[:FINGERPRINT_LENGTH]}'
+
+def send_cached(path, mimetype=None, digest=None):
+    """
+    send_file with a content hash ETag - digest can be passed when it is already known (e.g. for blobs).
+    Answers conditional requests with 304 and marks fingerprinted URLs immutable.
+    """
+    digest = digest or file_digest(path)
+    immutable = request.args.get('v') == digest[:FINGERPRINT_LENGTH]
+    response = send_file(path, mimetype=mimetype, conditional=True, etag=digest,
+                         max_age=IMMUTABLE_MAX_AGE if immutable else None)
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
+
+def send_cached_data(data, digest, mimetype, last_modified=None):
+    """Like send_cached, for a file already held in memory (e.g. an icon from the icon catalog)."""
+    immutable = request.args.get('v') == digest[:FINGERPRINT_LENGTH]
+    response = Response(data, mimetype=mimetype)
+    response.set_etag(digest)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
@@ -0,0 +1,280 @@
+"""
+The map catalog: img/catalog.db lists every map folder with its image (name, size, dimensions and
+content hash), thumbnail, marker, line and journal counts and change counter, so the map picker,
+/get_folders, /get_image_url and index() read one small table instead of listing and globbing the
+img directory.
+
+It is kept up to date incrementally. Uploads and image ingestion refresh the folder they changed,
+and write routes mark their map with touch() - its counts are read again (from the counters of
+migration 10, not by counting rows) before the catalog is read next. A watcher thread reconciles the
+catalog with the file system every poll_interval seconds: a folder that was added or removed changes
+the mtime of the img directory, a new or replaced image that of its folder, and a write by another
+process the map's change counter. Readers also check the img directory's mtime, so a folder that
+appears or goes away is noticed even without the watcher.
+
+The rows are kept in memory as well, so reads don't query catalog.db: it is only read again when the
+img directory's mtime moved or a map was touched, and refresh() updates the row it stored. The
+catalog keeps one connection to catalog.db open - opening and closing one would create and remove its
+WAL files, which moves the img directory's mtime every time.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+from PIL import Image
+from gogrow_app.database import get_db_connection, ensure_schema, get_change_version, get_item_counts
+
+CATALOG_DB_NAME = 'catalog.db'
+# Files in a map folder that aren't its image
+MAP_DATA_SUFFIXES = ('.db', '.db-wal', '.db-shm', '.db-journal', '.tmp')
+THUMBNAIL_PREFIX = 'thumbnail-'
+
+CATALOG_COLUMNS = ['folder', 'image', 'image_sha256', 'image_size', 'image_mtime_ns', 'width', 'height', 'thumbnail',
+                   'markers', 'lines', 'journals', 'revision', 'dir_mtime_ns', 'updated_at']
+
+def is_map_image(name):
+    lower = name.lower()
+    return not name.startswith('.') and not lower.startswith(THUMBNAIL_PREFIX) and not lower.endswith(MAP_DATA_SUFFIXES)
+
+def image_size(path):
+    """(width, height) of an image, read from its header - (None, None) when it can't be read."""
+    try:
+        with Image.open(path) as img:
+            return img.size
+    except OSError:
+        return None, None
+
+class MapCatalog:
+    def __init__(self, img_dir, sha256_of=None, poll_interval=5.0):
+        """sha256_of(path) is the content hash of a map image when it is known (see BlobStore.sha256_of)."""
+        self.img_dir = img_dir
+        self.db_path = os.path.join(img_dir, CATALOG_DB_NAME)
+        self.sha256_of = sha256_of
+        self.poll_interval = poll_interval
+        self._lock = threading.RLock()
+        self._dirty = set()  # maps written to since their counts were last read
+        self._entries = None  # folder -> row, what catalog.db holds (None until first read)
+        self._img_mtime_ns = None  # mtime of the img directory when _entries was read
+        self._conn = None
+        self._watching = False
+
+    def _connect(self):
+        # The catalog's connection, used under self._lock by every thread
+        if self._conn is not None:
+            return self._conn
+        os.makedirs(self.img_dir, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS maps (
+                                folder TEXT PRIMARY KEY,
+                                image TEXT,
+                                image_sha256 TEXT,
+                                image_size INTEGER,
+                                image_mtime_ns INTEGER,
+                                width INTEGER,
+                                height INTEGER,
+                                thumbnail TEXT,
+                                markers INTEGER NOT NULL DEFAULT 0,
+                                lines INTEGER NOT NULL DEFAULT 0,
+                                journals INTEGER NOT NULL DEFAULT 0,
+                                revision INTEGER NOT NULL DEFAULT 0,
+                                dir_mtime_ns INTEGER NOT NULL DEFAULT 0,
+                                updated_at REAL NOT NULL
+                            )''')
+            conn.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER)')
+            conn.commit()
+        except Exception:
+            conn.close()
+            raise
+        self._conn = conn
+        return conn
+
+    def _map_db_path(self, folder):
+        return os.path.join(self.img_dir, folder, f'{folder}.db')
+
+    def _scan_files(self, folder, previous):
+        """The image and thumbnail columns of a folder - the newest image (by creation time) is the map's."""
+        folder_path = os.path.join(self.img_dir, folder)
+        dir_mtime_ns = os.stat(folder_path).st_mtime_ns
+        latest = None
+        thumbnails = []
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                if entry.name.lower().startswith(THUMBNAIL_PREFIX) and entry.name.lower().endswith('.png'):
+                    thumbnails.append(entry.name)
+                elif is_map_image(entry.name):
+                    st = entry.stat()
+                    if latest is None or st.st_ctime > latest[0]:
+                        latest = (st.st_ctime, entry.name, st)
+        thumbnail = f'{THUMBNAIL_PREFIX}{folder}.png' if f'{THUMBNAIL_PREFIX}{folder}.png' in thumbnails else min(thumbnails, default=None)
+
+        files = {'image': None, 'image_sha256': None, 'image_size': None, 'image_mtime_ns': None, 'width': None, 'height': None,
+                 'thumbnail': thumbnail, 'dir_mtime_ns': dir_mtime_ns}
+        if latest:
+            _, name, st = latest
+            files.update(image=name, image_size=st.st_size, image_mtime_ns=st.st_mtime_ns)
+            if previous and previous['image_sha256'] and (previous['image'], previous['image_size'], previous['image_mtime_ns']) == (name, st.st_size, st.st_mtime_ns):
+                # The same image as last time - its dimensions and hash are known
+                files.update(width=previous['width'], height=previous['height'], image_sha256=previous['image_sha256'])
+            else:
+                path = os.path.join(folder_path, name)
+                files['width'], files['height'] = image_size(path)
+                files['image_sha256'] = self.sha256_of(path) if self.sha256_of else None
+        return files
+
+    def _read_stats(self, folder):
+        """The counts and change counter of a map's database (zeros when it has none yet)."""
+        db_path = self._map_db_path(folder)
+        stats = {'markers': 0, 'lines': 0, 'journals': 0, 'revision': 0}
+        if not os.path.exists(db_path):
+            return stats
+        ensure_schema(db_path)
+        conn = get_db_connection(db_path)
+        try:
+            stats.update(get_item_counts(conn))
+            stats['revision'] = get_change_version(conn)
+        finally:
+            conn.close()
+        return stats
+
+    def _rows(self, conn, folder=None):
+        query = f"SELECT {', '.join(CATALOG_COLUMNS)} FROM maps"
+        rows = conn.execute(query + ' WHERE folder = ?', (folder,)) if folder else conn.execute(query + ' ORDER BY folder')
+        return [dict(zip(CATALOG_COLUMNS, row)) for row in rows]
+
+    def _store(self, conn, entry):
+        entry['updated_at'] = time.time()
+        conn.execute(f"INSERT OR REPLACE INTO maps ({', '.join(CATALOG_COLUMNS)}) VALUES ({', '.join('?' * len(CATALOG_COLUMNS))})",
+                     [entry[column] for column in CATALOG_COLUMNS])
+
+    def refresh(self, folder):
+        """Reads a map folder again - after an upload, or when the watcher saw it change. Removes it when it is gone."""
+        with self._lock:
+            conn = self._connect()
+            try:
+                if not os.path.isdir(os.path.join(self.img_dir, folder)):
+                    conn.execute('DELETE FROM maps WHERE folder = ?', (folder,))
+                    entry = None
+                else:
+                    previous = (self._rows(conn, folder) or [None])[0]
+                    entry = {'folder': folder, **self._scan_files(folder, previous), **self._read_stats(folder)}
+                    self._store(conn, entry)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            self._dirty.discard(folder)
+            if self._entries is not None:
+                if entry is None:
+                    self._entries.pop(folder, None)
+                else:
+                    self._entries[folder] = entry
+
+    def touch(self, folder):
+        """Marks a map as written to - cheap, its counts are read when the catalog is read next."""
+        self._dirty.add(folder)
+
+    def _flush(self, conn):
+        while self._dirty:
+            folder = self._dirty.pop()
+            if os.path.exists(self._map_db_path(folder)):
+                stats = self._read_stats(folder)
+                conn.execute('UPDATE maps SET markers = ?, lines = ?, journals = ?, revision = ?, updated_at = ? WHERE folder = ?',
+                             (stats['markers'], stats['lines'], stats['journals'], stats['revision'], time.time(), folder))
+        conn.commit()
+
+    def _sync_folders(self, conn):
+        """Adds and removes folders when the img directory changed - it is only listed then."""
+        try:
+            mtime_ns = os.stat(self.img_dir).st_mtime_ns
+        except FileNotFoundError:
+            return
+        row = conn.execute("SELECT value FROM state WHERE key = 'mtime_ns'").fetchone()
+        if row and row[0] == mtime_ns:
+            return
+        folders = {name for name in os.listdir(self.img_dir)
+                   if not name.startswith('.') and os.path.isdir(os.path.join(self.img_dir, name))}
+        known = {row[0] for row in conn.execute('SELECT folder FROM maps')}
+        for folder in known - folders:
+            conn.execute('DELETE FROM maps WHERE folder = ?', (folder,))
+        conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('mtime_ns', ?)", (mtime_ns,))
+        conn.commit()
+        for folder in sorted(folders - known):
+            self.refresh(folder)
+
+    def _load(self):
+        """The catalog's rows by folder, read from catalog.db only when folders came or went or maps were touched."""
+        with self._lock:
+            conn = self._connect()
+            mtime_ns = os.stat(self.img_dir).st_mtime_ns
+            if self._entries is not None and not self._dirty and mtime_ns == self._img_mtime_ns:
+                return self._entries
+            try:
+                self._sync_folders(conn)
+                self._flush(conn)
+            except Exception:
+                conn.rollback()
+                raise
+            self._entries = {entry['folder']: entry for entry in self._rows(conn)}
+            self._img_mtime_ns = mtime_ns
+            return self._entries
+
+    def maps(self):
+        """Every map as a dict of CATALOG_COLUMNS, by folder name."""
+        with self._lock:
+            entries = self._load()
+            return [dict(entries[folder]) for folder in sorted(entries)]
+
+    def folders(self):
+        with self._lock:
+            return sorted(self._load())
+
+    def get(self, folder):
+        with self._lock:
+            entry = self._load().get(folder)
+            return dict(entry) if entry else None
+
+    def reconcile(self):
+        """Brings the catalog in line with the file system and the map databases."""
+        for entry in self.maps():
+            folder = entry['folder']
+            try:
+                if os.stat(os.path.join(self.img_dir, folder)).st_mtime_ns != entry['dir_mtime_ns']:
+                    self.refresh(folder)
+                    continue
+            except FileNotFoundError:
+                self.refresh(folder)
+                continue
+            db_path = self._map_db_path(folder)
+            if os.path.exists(db_path):
+                conn = get_db_connection(db_path)
+                try:
+                    revision = get_change_version(conn)
+                except sqlite3.OperationalError:
+                    revision = None  # not migrated yet - refresh() takes care of it
+                finally:
+                    conn.close()
+                if revision != entry['revision']:
+                    self.touch(folder)
+        # Written by another process - the counts are read now rather than by the next reader
+        self._load()
+
+    def start_watching(self):
+        with self._lock:
+            if self._watching:
+                return
+            self._watching = True
+        thread = threading.Thread(target=self._watch_loop, name='map-catalog', daemon=True)
+        thread.start()
+
+    def _watch_loop(self):
+        while True:
+            try:
+                self.reconcile()
+            except Exception as e:
+                print(f"Error reconciling the map catalog: {e}")
+            time.sleep(self.poll_interval)
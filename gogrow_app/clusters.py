@@ -0,0 +1,122 @@
+"""
+Server-side grid clustering of markers for zoomed out map views.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Size of a cluster cell on screen. The map uses L.CRS.Simple, where one map unit is 2^zoom screen pixels.
+CLUSTER_CELL_PIXELS = 80
+MIN_CLUSTER_ZOOM = -8
+MAX_CLUSTER_ZOOM = 8
+
+def cluster_cell_size(zoom):
+    return CLUSTER_CELL_PIXELS / (2.0 ** zoom)
+
+def build_clusters(ids, lats, lngs, icon_types, cell_size):
+    """
+    Groups markers into square grid cells of cell_size map units.
+    Each cluster has its marker count, centroid, bounds and the most common iconType in the cell.
+    """
+    if len(ids) == 0:
+        return []
+
+    lats = np.asarray(lats, dtype=np.float64)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    cell_x = np.floor(lngs / cell_size).astype(np.int64)
+    cell_y = np.floor(lats / cell_size).astype(np.int64)
+    cell_x -= cell_x.min()
+    cell_y -= cell_y.min()
+    keys = cell_x * (int(cell_y.max()) + 1) + cell_y
+
+    # Sort by cell so every cluster is a contiguous run of markers
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    lats = lats[order]
+    lngs = lngs[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    counts = np.diff(np.append(starts, len(keys)))
+    cell_index = np.repeat(np.arange(len(starts)), counts)
+
+    centroid_lat = np.add.reduceat(lats, starts) / counts
+    centroid_lng = np.add.reduceat(lngs, starts) / counts
+    south = np.minimum.reduceat(lats, starts)
+    north = np.maximum.reduceat(lats, starts)
+    west = np.minimum.reduceat(lngs, starts)
+    east = np.maximum.reduceat(lngs, starts)
+
+    # Dominant iconType: count (cell, type) pairs, then keep the most frequent type of each cell
+    type_names, type_codes = np.unique(np.asarray(icon_types, dtype=object).astype(str), return_inverse=True)
+    pairs = cell_index * len(type_names) + type_codes[order]
+    pair_keys, pair_counts = np.unique(pairs, return_counts=True)
+    pair_cells = pair_keys // len(type_names)
+    best = np.lexsort((-pair_counts, pair_cells))
+    first_of_cell = best[np.concatenate(([True], pair_cells[best][1:] != pair_cells[best][:-1]))]
+    dominant_types = type_names[pair_keys[first_of_cell] % len(type_names)]
+
+    first_ids = np.asarray(ids, dtype=object)[order[starts]]
+
+    clusters = []
+    for i in range(len(starts)):
+        cluster = {
+            'count': int(counts[i]),
+            'lat': float(centroid_lat[i]),
+            'lng': float(centroid_lng[i]),
+            'bounds': [float(south[i]), float(west[i]), float(north[i]), float(east[i])],
+            'iconType': str(dominant_types[i])
+        }
+        if counts[i] == 1:
+            cluster['markerId'] = first_ids[i]
+        clusters.append(cluster)
+    return clusters
+
+class ClusterCache:
+    """Keeps the clusters of recently viewed (map, zoom) pairs until a marker of that map changes."""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (db_path, zoom) -> (map version, list of clusters)
+        self._generations = {}  # db_path -> number of invalidations, so a build racing a write isn't cached
+
+    def get(self, db_path, zoom, load_markers, version=None):
+        """
+        The clusters of a map at zoom. version is the map's change counter when known - it catches
+        writes that were made without invalidate(), e.g. by an import running in a worker process.
+        """
+        key = (os.path.abspath(db_path), zoom)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached[0] == version:
+                self._entries.move_to_end(key)
+                return cached[1]
+            generation = self._generations.get(key[0], 0)
+
+        ids, lats, lngs, icon_types = load_markers()
+        clusters = build_clusters(ids, lats, lngs, icon_types, cluster_cell_size(zoom))
+
+        with self._lock:
+            if self._generations.get(key[0], 0) != generation:
+                return clusters
+            self._entries[key] = (version, clusters)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return clusters
+
+    def invalidate(self, db_path):
+        db_path = os.path.abspath(db_path)
+        with self._lock:
+            self._generations[db_path] = self._generations.get(db_path, 0) + 1
+            for key in [key for key in self._entries if key[0] == db_path]:
+                del self._entries[key]
+
+cluster_cache = ClusterCache()
+
+def clusters_in_bbox(clusters, bbox):
+    if bbox is None:
+        return clusters
+    south, west, north, east = bbox
+    return [cluster for cluster in clusters if south <= cluster['lat'] <= north and west <= cluster['lng'] <= east]
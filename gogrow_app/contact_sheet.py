@@ -0,0 +1,182 @@
+"""
+The folder panel's contact sheet: every map's thumbnail in one sprite image (/maps/contact_sheet.<ext>)
+with the offset of each map's cell, so the map picker shows all thumbnails from one request.
+
+The sheet is a grid of CELL_SIZE squares, COLUMNS wide. It is kept up to date from the map catalog
+(see catalog.py) a cell at a time: a map keeps its cell while its thumbnail is unchanged, a new or
+changed thumbnail is drawn into its cell (a new map takes the first free one), and the cell of a map
+that is gone is cleared for the next. The lossless sheet and its layout are kept in
+img/.contact_sheet, so a restart doesn't redraw it either; the WebP or JPEG the browser gets is
+encoded once per version of the sheet.
+"""
+
+import io
+import os
+import json
+import uuid
+import hashlib
+import threading
+from PIL import Image
+from gogrow_app.derivatives import DERIVATIVE_FORMATS, format_supported
+
+CONTACT_SHEET_DIR_NAME = '.contact_sheet'
+CELL_SIZE = 120  # shown at 60px, so it stays sharp on high density screens
+COLUMNS = 16
+# fmt -> file extension of /maps/contact_sheet.<ext>
+SHEET_FORMATS = {'webp': 'webp', 'jpeg': 'jpg'}
+JPEG_BACKGROUND = (255, 255, 255)  # JPEG has no transparency - empty cell space is filled with this
+
+def default_format():
+    return 'webp' if format_supported('webp') else 'jpeg'
+
+def thumbnail_key(entry, img_dir):
+    """What identifies the version of a map's thumbnail - it is made from the image, so the image's hash does."""
+    if entry['image_sha256']:
+        return f"{entry['thumbnail']}|{entry['image_sha256']}"
+    st = os.stat(os.path.join(img_dir, entry['folder'], entry['thumbnail']))
+    return f"{entry['thumbnail']}|{st.st_size}|{st.st_mtime_ns}"
+
+def cell_offset(slot):
+    return (slot % COLUMNS) * CELL_SIZE, (slot // COLUMNS) * CELL_SIZE
+
+class ContactSheet:
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.root = os.path.join(catalog.img_dir, CONTACT_SHEET_DIR_NAME)
+        self._lock = threading.Lock()
+        self._layout = None  # folder -> {'slot', 'key'}
+        self._image = None  # the lossless RGBA sheet
+        self._version = None
+        self._encoded = {}  # fmt -> (sha256 hex digest, bytes) of the current version
+
+    def _paths(self):
+        return os.path.join(self.root, 'sheet.png'), os.path.join(self.root, 'sheet.json')
+
+    def _load(self):
+        image_path, layout_path = self._paths()
+        self._layout, self._image = {}, None
+        try:
+            with open(layout_path) as file:
+                layout = json.load(file)
+            with Image.open(image_path) as img:
+                self._image = img.convert('RGBA')
+            self._layout = layout
+        except (OSError, ValueError):
+            pass  # not built yet, or unreadable - drawn again from scratch
+        self._version = self._layout_version()
+
+    def _save(self):
+        os.makedirs(self.root, exist_ok=True)
+        image_path, layout_path = self._paths()
+        # Written next to the old files and swapped in, the sheet first - a layout is only saved with its sheet
+        image_temp, layout_temp = (f'{path}.{uuid.uuid4().hex}.tmp' for path in (image_path, layout_path))
+        try:
+            self._image.save(image_temp, 'PNG')
+            with open(layout_temp, 'w') as file:
+                json.dump(self._layout, file)
+            os.replace(image_temp, image_path)
+            os.replace(layout_temp, layout_path)
+        finally:
+            for temp_path in (image_temp, layout_temp):
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+    def _layout_version(self):
+        return hashlib.sha256(json.dumps(self._layout, sort_keys=True).encode()).hexdigest()
+
+    def _resize(self, slots):
+        """Grows or shrinks the sheet to hold slots cells, keeping the cells that are drawn."""
+        rows = max(1, -(-slots // COLUMNS))
+        size = (COLUMNS * CELL_SIZE, rows * CELL_SIZE)
+        if self._image is not None and self._image.size == size:
+            return
+        image = Image.new('RGBA', size, (0, 0, 0, 0))
+        if self._image is not None:
+            image.paste(self._image.crop((0, 0, size[0], min(size[1], self._image.height))), (0, 0))
+        self._image = image
+
+    def _draw(self, slot, path):
+        x, y = cell_offset(slot)
+        self._image.paste((0, 0, 0, 0), (x, y, x + CELL_SIZE, y + CELL_SIZE))
+        if path is None:
+            return
+        try:
+            with Image.open(path) as img:
+                img.draft('RGB', (CELL_SIZE, CELL_SIZE))
+                img.thumbnail((CELL_SIZE, CELL_SIZE))
+                img = img.convert('RGBA')
+        except OSError as e:
+            print(f"Error drawing {path} into the contact sheet: {e}")
+            return
+        # Centered in its cell
+        self._image.paste(img, (x + (CELL_SIZE - img.width) // 2, y + (CELL_SIZE - img.height) // 2))
+
+    def _update(self, entries):
+        """Brings the sheet in line with the catalog entries. Returns whether anything changed."""
+        thumbnails = {}  # folder -> (key, path)
+        for entry in entries:
+            if entry['thumbnail']:
+                try:
+                    thumbnails[entry['folder']] = (thumbnail_key(entry, self.catalog.img_dir),
+                                                   os.path.join(self.catalog.img_dir, entry['folder'], entry['thumbnail']))
+                except FileNotFoundError:
+                    pass  # removed since the catalog was updated - the watcher will catch up
+        layout = self._layout
+        gone = [folder for folder in layout if folder not in thumbnails]
+        changed = sorted(folder for folder, (key, _) in thumbnails.items() if folder not in layout or layout[folder]['key'] != key)
+        if not gone and not changed:
+            return False
+
+        for folder in gone:
+            slot = layout.pop(folder)['slot']
+            if self._image is not None and cell_offset(slot)[1] < self._image.height:
+                self._draw(slot, None)
+        # New maps take the first free cells, so the sheet only grows when there's no gap left
+        used = {cell['slot'] for cell in layout.values()}
+        free = (slot for slot in range(len(thumbnails)) if slot not in used)
+        for folder in changed:
+            if folder not in layout:
+                layout[folder] = {'slot': next(free), 'key': None}
+        self._resize(max((cell['slot'] for cell in layout.values()), default=-1) + 1)
+        for folder in changed:
+            key, path = thumbnails[folder]
+            self._draw(layout[folder]['slot'], path)
+            layout[folder]['key'] = key
+        return True
+
+    def current(self, entries=None):
+        """
+        The sheet's layout: its version, size and the [x, y] offset of each map's cell, updated from the
+        catalog first (entries, when the caller has just read them).
+        """
+        entries = self.catalog.maps() if entries is None else entries
+        with self._lock:
+            if self._layout is None:
+                self._load()
+            if self._update(entries):
+                self._save()
+                self._version = self._layout_version()
+                self._encoded = {}
+            width, height = self._image.size if self._image is not None else (0, 0)
+            return {'version': self._version, 'width': width, 'height': height, 'cell_size': CELL_SIZE,
+                    'maps': {folder: list(cell_offset(cell['slot'])) for folder, cell in sorted(self._layout.items())}}
+
+    def encoded(self, fmt):
+        """(sha256 hex digest, bytes) of the current sheet as fmt, encoded once per version."""
+        if fmt not in SHEET_FORMATS or not format_supported(fmt):
+            raise ValueError(f"fmt must be one of {', '.join(f for f in SHEET_FORMATS if format_supported(f))}")
+        with self._lock:
+            if self._layout is None:
+                self._load()
+            if fmt not in self._encoded:
+                image = self._image if self._image is not None else Image.new('RGBA', (CELL_SIZE, CELL_SIZE), (0, 0, 0, 0))
+                if fmt == 'jpeg':
+                    flat = Image.new('RGB', image.size, JPEG_BACKGROUND)
+                    flat.paste(image, mask=image.getchannel('A'))
+                    image = flat
+                pillow_format, _, _, options = DERIVATIVE_FORMATS[fmt]
+                data = io.BytesIO()
+                image.save(data, pillow_format, **options)
+                body = data.getvalue()
+                self._encoded[fmt] = (hashlib.sha256(body).hexdigest(), body)
+            return self._encoded[fmt]
@@ -0,0 +1,553 @@
+"""
+SQLite connection management for the per-map databases (img/<folder>/<folder>.db).
+"""
+
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from collections import OrderedDict, deque
+from gogrow_app.settings import app
+
+class PooledConnection:
+    """Wraps a sqlite3 connection so that close() hands it back to the pool instead of closing it."""
+
+    def __init__(self, manager, db_path, conn):
+        self._manager = manager
+        self._db_path = db_path
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return self._conn.__exit__(exc_type, exc_value, tb)
+
+    def close(self):
+        if self._conn is not None:
+            self._manager.release(self._db_path, self._conn)
+            self._conn = None
+
+class ConnectionManager:
+    """
+    Keeps warm connections for each map database so requests don't pay to reopen the file,
+    re-parse the schema and rebuild the page cache every time.
+
+    Idle connections are kept per database file and the databases are ordered by last use, so when
+    more than max_connections handles are open the least recently used maps are closed first.
+    """
+
+    def __init__(self, max_connections=64, max_idle_per_db=4, timeout=30.0):
+        self.max_connections = max_connections
+        self.max_idle_per_db = max_idle_per_db
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = OrderedDict()  # db_path -> deque of idle connections, least recently used first
+        self._wal_paths = set()  # databases that have already been switched to WAL mode
+        self._open_count = 0
+        self._hits = 0
+        self._misses = 0
+        self._opened = 0
+        self._evicted = 0
+
+    def _key(self, db_path):
+        return os.path.abspath(db_path)
+
+    def _open(self, db_path):
+        conn = sqlite3.connect(db_path, timeout=self.timeout, check_same_thread=False)
+        try:
+            # journal_mode is stored in the database file, so it only needs to be set once per file
+            if db_path not in self._wal_paths:
+                conn.execute('PRAGMA journal_mode=WAL')
+                self._wal_paths.add(db_path)
+            conn.execute('PRAGMA synchronous=NORMAL')
+        except sqlite3.Error:
+            conn.close()
+            raise
+        return conn
+
+    def _evict_idle_locked(self, needed=1):
+        # Close idle connections of the least recently used databases until there is room
+        closing = []
+        while self._open_count + needed > self.max_connections and self._idle:
+            key, pool = next(iter(self._idle.items()))
+            closing.append(pool.popleft())
+            self._open_count -= 1
+            self._evicted += 1
+            if not pool:
+                del self._idle[key]
+        return closing
+
+    def connect(self, db_path):
+        key = self._key(db_path)
+        with self._lock:
+            pool = self._idle.get(key)
+            if pool:
+                conn = pool.pop()
+                if not pool:
+                    del self._idle[key]
+                self._hits += 1
+                return PooledConnection(self, key, conn)
+            self._misses += 1
+            closing = self._evict_idle_locked()
+            self._open_count += 1
+
+        for stale in closing:
+            stale.close()
+
+        try:
+            conn = self._open(key)
+        except Exception:
+            with self._lock:
+                self._open_count -= 1
+            raise
+
+        with self._lock:
+            self._opened += 1
+        return PooledConnection(self, key, conn)
+
+    def release(self, db_path, conn):
+        try:
+            # Never hand a connection with a half-finished transaction to the next request
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+
+        with self._lock:
+            pool = self._idle.get(db_path)
+            over_limit = self._open_count > self.max_connections
+            if not over_limit and (pool is None or len(pool) < self.max_idle_per_db):
+                if pool is None:
+                    pool = self._idle[db_path] = deque()
+                pool.append(conn)
+                self._idle.move_to_end(db_path)
+                return
+        self._discard(conn)
+
+    def _discard(self, conn):
+        with self._lock:
+            self._open_count -= 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def checkpoint(self, db_path):
+        """Copies everything in the write-ahead log back into the main database file."""
+        if not os.path.exists(db_path):
+            return
+        conn = self.connect(db_path)
+        try:
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        finally:
+            conn.close()
+
+    def close_database(self, db_path):
+        """Closes the idle connections of a database, e.g. before its file is replaced or removed."""
+        key = self._key(db_path)
+        with self._lock:
+            pool = self._idle.pop(key, deque())
+            self._open_count -= len(pool)
+            self._wal_paths.discard(key)
+        for conn in pool:
+            conn.close()
+
+    def close_all(self):
+        with self._lock:
+            pools = list(self._idle.values())
+            self._idle.clear()
+            for pool in pools:
+                self._open_count -= len(pool)
+            self._wal_paths.clear()
+        for pool in pools:
+            for conn in pool:
+                conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'opened': self._opened,
+                'evicted': self._evicted,
+                'open': self._open_count,
+                'idle': sum(len(pool) for pool in self._idle.values()),
+                'databases': len(self._idle),
+                'max_connections': self.max_connections
+            }
+
+connection_manager = ConnectionManager(
+    max_connections=app.config['DB_MAX_CONNECTIONS'],
+    max_idle_per_db=app.config['DB_MAX_IDLE_PER_DB']
+)
+
+def get_db_connection(db_path):
+    """Returns a pooled connection for db_path - call close() on it as usual to give it back."""
+    return connection_manager.connect(db_path)
+
+class SchemaRegistry:
+    """
+    Brings map databases up to the current schema version with numbered migrations, once per file.
+
+    The version a database is at lives in PRAGMA user_version. Files already known to be current are
+    remembered by path together with their inode and mtime, so the request paths only pay for an
+    os.stat() - a replaced (restored) or externally modified file is checked again.
+    """
+
+    def __init__(self, manager):
+        self._manager = manager
+        self._lock = threading.Lock()
+        self._migrations = []
+        self._current = {}  # db_path -> (inode, mtime) of the file when it was last seen at the current version
+
+    def migration(self, version, description):
+        def register(func):
+            self._migrations.append((version, description, func))
+            self._migrations.sort(key=lambda migration: migration[0])
+            return func
+        return register
+
+    @property
+    def version(self):
+        return self._migrations[-1][0] if self._migrations else 0
+
+    def _fingerprint(self, db_path):
+        try:
+            st = os.stat(db_path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns)
+
+    def ensure(self, db_path):
+        key = os.path.abspath(db_path)
+        fingerprint = self._fingerprint(key)
+        if fingerprint is not None and self._current.get(key) == fingerprint:
+            return
+
+        with self._lock:
+            conn = None
+            try:
+                conn = self._manager.connect(key)
+                if conn.execute('PRAGMA user_version').fetchone()[0] < self.version:
+                    self._migrate(conn, key)
+                self._current[key] = self._fingerprint(key)
+            except Exception as e:
+                print(f"Error initializing database schema: {e}")
+            finally:
+                if conn:
+                    conn.close()
+
+    def _migrate(self, conn, db_path):
+        # Take the write lock first and re-read the version, another process may have just migrated the file
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            current_version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for version, description, func in self._migrations:
+                if version > current_version:
+                    func(conn)
+                    print(f"Applied migration #{version} ({description}) to {db_path}")
+            conn.execute(f'PRAGMA user_version = {self.version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def forget(self, db_path):
+        self._current.pop(os.path.abspath(db_path), None)
+
+schema_registry = SchemaRegistry(connection_manager)
+
+def _table_columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+@schema_registry.migration(1, 'create markers, lines and journals tables')
+def _create_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS markers
+                    (id TEXT PRIMARY KEY, lat REAL, lng REAL, info TEXT, iconType TEXT, iconColor TEXT, markerNotes TEXT)''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS lines
+        (id TEXT PRIMARY KEY, start_lat REAL, start_lng REAL, end_lat REAL, end_lng REAL, info TEXT, color TEXT, notes TEXT)
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS journals (
+            id TEXT PRIMARY KEY,
+            entry_date TEXT NOT NULL,
+            linked_item_id TEXT,
+            entry_title TEXT NOT NULL,
+            entry_content TEXT NOT NULL
+        )
+    ''')
+
+@schema_registry.migration(2, 'add journals.is_favorite')
+def _add_journal_favorite(conn):
+    # Databases created by older versions of init_journal_db() may already have the column
+    if 'is_favorite' not in _table_columns(conn, 'journals'):
+        conn.execute("ALTER TABLE journals ADD COLUMN is_favorite TEXT NOT NULL DEFAULT 'no'")
+
+@schema_registry.migration(3, 'add R*Tree spatial indexes for markers and lines')
+def _create_spatial_indexes(conn):
+    # The R*Tree ids are the rowids of the markers/lines rows (their TEXT ids can't be used by rtree).
+    # Nothing in GoGrow runs VACUUM, which is the only thing that could renumber them.
+    conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS markers_rtree USING rtree(id, min_lat, max_lat, min_lng, max_lng)')
+    conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS lines_rtree USING rtree(id, min_lat, max_lat, min_lng, max_lng)')
+    # Each statement goes through execute() - executescript() would commit the migration transaction halfway
+    triggers = [
+        '''CREATE TRIGGER IF NOT EXISTS markers_rtree_insert AFTER INSERT ON markers
+           WHEN new.lat IS NOT NULL AND new.lng IS NOT NULL
+           BEGIN
+               INSERT OR REPLACE INTO markers_rtree VALUES (new.rowid, new.lat, new.lat, new.lng, new.lng);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS markers_rtree_update AFTER UPDATE OF lat, lng ON markers
+           BEGIN
+               DELETE FROM markers_rtree WHERE id = old.rowid;
+               INSERT INTO markers_rtree SELECT new.rowid, new.lat, new.lat, new.lng, new.lng
+               WHERE new.lat IS NOT NULL AND new.lng IS NOT NULL;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS markers_rtree_delete AFTER DELETE ON markers
+           BEGIN
+               DELETE FROM markers_rtree WHERE id = old.rowid;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS lines_rtree_insert AFTER INSERT ON lines
+           WHEN new.start_lat IS NOT NULL AND new.start_lng IS NOT NULL AND new.end_lat IS NOT NULL AND new.end_lng IS NOT NULL
+           BEGIN
+               INSERT OR REPLACE INTO lines_rtree VALUES (new.rowid,
+                   min(new.start_lat, new.end_lat), max(new.start_lat, new.end_lat),
+                   min(new.start_lng, new.end_lng), max(new.start_lng, new.end_lng));
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS lines_rtree_update AFTER UPDATE OF start_lat, start_lng, end_lat, end_lng ON lines
+           BEGIN
+               DELETE FROM lines_rtree WHERE id = old.rowid;
+               INSERT INTO lines_rtree SELECT new.rowid,
+                   min(new.start_lat, new.end_lat), max(new.start_lat, new.end_lat),
+                   min(new.start_lng, new.end_lng), max(new.start_lng, new.end_lng)
+               WHERE new.start_lat IS NOT NULL AND new.start_lng IS NOT NULL AND new.end_lat IS NOT NULL AND new.end_lng IS NOT NULL;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS lines_rtree_delete AFTER DELETE ON lines
+           BEGIN
+               DELETE FROM lines_rtree WHERE id = old.rowid;
+           END'''
+    ]
+    for trigger in triggers:
+        conn.execute(trigger)
+
+    # Index the rows that existed before the triggers did
+    conn.execute('''INSERT OR REPLACE INTO markers_rtree
+                    SELECT rowid, lat, lat, lng, lng FROM markers WHERE lat IS NOT NULL AND lng IS NOT NULL''')
+    conn.execute('''INSERT OR REPLACE INTO lines_rtree
+                    SELECT rowid, min(start_lat, end_lat), max(start_lat, end_lat), min(start_lng, end_lng), max(start_lng, end_lng)
+                    FROM lines
+                    WHERE start_lat IS NOT NULL AND start_lng IS NOT NULL AND end_lat IS NOT NULL AND end_lng IS NOT NULL''')
+
+@schema_registry.migration(4, 'add a change counter for markers, lines and journals')
+def _create_change_counter(conn):
+    # Bumped by every insert, update and delete, so readers can tell whether a map changed with one query
+    conn.execute('CREATE TABLE IF NOT EXISTS change_counter (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)')
+    conn.execute('INSERT OR IGNORE INTO change_counter (id, version) VALUES (1, 0)')
+    for table in ('markers', 'lines', 'journals'):
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_change AFTER {event} ON {table}
+                             BEGIN
+                                 UPDATE change_counter SET version = version + 1 WHERE id = 1;
+                             END''')
+
+# Columns whose changes give a row a new revision. revision itself isn't one of them, so the triggers
+# can set it without firing again. A migration that adds a data column must recreate the triggers.
+REVISIONED_COLUMNS = {
+    'markers': ('id', 'lat', 'lng', 'info', 'iconType', 'iconColor', 'markerNotes'),
+    'lines': ('id', 'start_lat', 'start_lng', 'end_lat', 'end_lng', 'info', 'color', 'notes'),
+    'journals': ('id', 'entry_date', 'linked_item_id', 'entry_title', 'entry_content', 'is_favorite')
+}
+
+def _create_revision_triggers(conn, table):
+    bump = 'UPDATE change_counter SET version = version + 1 WHERE id = 1;'
+    current = '(SELECT version FROM change_counter WHERE id = 1)'
+    columns = ', '.join(REVISIONED_COLUMNS[table])
+    # created_revision (migration 6) tells a client whether a changed row is new to it or an update
+    stamp = 'revision = {0}, created_revision = {0}' if 'created_revision' in _table_columns(conn, table) else 'revision = {0}'
+    conn.execute(f'DROP TRIGGER IF EXISTS {table}_revision_insert')
+    conn.execute(f'DROP TRIGGER IF EXISTS {table}_revision_update')
+    conn.execute(f'DROP TRIGGER IF EXISTS {table}_revision_delete')
+    conn.execute(f'''CREATE TRIGGER {table}_revision_insert AFTER INSERT ON {table}
+                     BEGIN
+                         {bump}
+                         UPDATE {table} SET {stamp.format(current)} WHERE rowid = new.rowid;
+                         DELETE FROM tombstones WHERE kind = '{table}' AND id = new.id;
+                     END''')
+    conn.execute(f'''CREATE TRIGGER {table}_revision_update AFTER UPDATE OF {columns} ON {table}
+                     BEGIN
+                         {bump}
+                         UPDATE {table} SET revision = {current} WHERE rowid = new.rowid;
+                     END''')
+    conn.execute(f'''CREATE TRIGGER {table}_revision_delete AFTER DELETE ON {table}
+                     BEGIN
+                         {bump}
+                         INSERT OR REPLACE INTO tombstones (kind, id, revision) VALUES ('{table}', old.id, {current});
+                     END''')
+
+def _restamp_revisions(conn, table):
+    # Gives every row a revision of its own - the next values of the change counter, in rowid order - so
+    # a page of changes that ends at a revision never leaves out rows that share it.
+    count = conn.execute(f'SELECT count(*) FROM {table}').fetchone()[0]
+    if not count:
+        return
+    conn.execute(f'''UPDATE {table} SET revision = (SELECT version FROM change_counter WHERE id = 1) + numbered.n
+                     FROM (SELECT rowid AS row, row_number() OVER (ORDER BY rowid) AS n FROM {table}) AS numbered
+                     WHERE {table}.rowid = numbered.row''')
+    conn.execute('UPDATE change_counter SET version = version + ? WHERE id = 1', (count,))
+
+@schema_registry.migration(5, 'add row revisions and tombstones for delta sync')
+def _add_revisions(conn):
+    # Each write stamps its row with the next value of the change counter and deletes leave a tombstone,
+    # so /maps/<folder>/changes?since=<revision> can answer with only what changed. These triggers
+    # replace the ones from migration 4, so the counter still goes up once per change.
+    conn.execute('''CREATE TABLE IF NOT EXISTS tombstones (
+                        kind TEXT NOT NULL,
+                        id TEXT NOT NULL,
+                        revision INTEGER NOT NULL,
+                        PRIMARY KEY (kind, id)
+                    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS tombstones_revision ON tombstones (revision)')
+    conn.execute('UPDATE change_counter SET version = version + 1 WHERE id = 1')
+    for table in REVISIONED_COLUMNS:
+        for event in ('insert', 'update', 'delete'):
+            conn.execute(f'DROP TRIGGER IF EXISTS {table}_{event}_change')
+        if 'revision' not in _table_columns(conn, table):
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN revision INTEGER NOT NULL DEFAULT 0')
+        # Existing rows get revisions after the current one, so a client syncing from 0 still receives them
+        _restamp_revisions(conn, table)
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_revision ON {table} (revision)')
+        _create_revision_triggers(conn, table)
+
+@schema_registry.migration(6, 'add created_revision to markers, lines and journals')
+def _add_created_revisions(conn):
+    # The revision a row was inserted at, so a change feed can tell inserts from updates. Rows from
+    # before this migration count as created at their last revision.
+    for table in REVISIONED_COLUMNS:
+        if 'created_revision' not in _table_columns(conn, table):
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN created_revision INTEGER NOT NULL DEFAULT 0')
+        conn.execute(f'UPDATE {table} SET created_revision = revision')
+        _create_revision_triggers(conn, table)
+
+@schema_registry.migration(7, 'add the imports table')
+def _create_imports(conn):
+    # Progress of CSV/GeoJSON imports (see importer.py). records is the resume point and is updated in
+    # the same transaction as the rows it covers, so a restarted import never writes a record twice.
+    conn.execute('''CREATE TABLE IF NOT EXISTS imports (
+                        id TEXT PRIMARY KEY,
+                        filename TEXT NOT NULL,
+                        format TEXT NOT NULL,
+                        path TEXT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'queued',
+                        size INTEGER NOT NULL DEFAULT 0,
+                        bytes_read INTEGER NOT NULL DEFAULT 0,
+                        records INTEGER NOT NULL DEFAULT 0,
+                        inserted INTEGER NOT NULL DEFAULT 0,
+                        failed INTEGER NOT NULL DEFAULT 0,
+                        errors TEXT NOT NULL DEFAULT '[]',
+                        message TEXT,
+                        created_at REAL NOT NULL,
+                        updated_at REAL NOT NULL
+                    )''')
+
+# The searchable text of each table - (code, title column, body column). A row's document in the
+# search index has the rowid rowid * 4 + code, so a queued document can be found again after its row is gone.
+SEARCH_COLUMNS = {
+    'markers': (1, 'info', 'markerNotes'),
+    'lines': (2, 'info', 'notes'),
+    'journals': (3, 'entry_title', 'entry_content')
+}
+
+@schema_registry.migration(8, 'add the full-text search index')
+def _create_search_index(conn):
+    # The triggers only queue the rows that changed in search_pending - search.py strips the Quill HTML
+    # and writes the index, so the triggers need no function that only GoGrow's connections have
+    conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS search_index
+                    USING fts5(kind UNINDEXED, item_id UNINDEXED, title, body, tokenize='unicode61 remove_diacritics 2')''')
+    conn.execute('CREATE TABLE IF NOT EXISTS search_pending (doc INTEGER PRIMARY KEY)')
+    for table, (code, title, body) in SEARCH_COLUMNS.items():
+        conn.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_search_insert AFTER INSERT ON {table}
+                         BEGIN
+                             INSERT OR IGNORE INTO search_pending (doc) VALUES (new.rowid * 4 + {code});
+                         END''')
+        conn.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_search_update AFTER UPDATE OF id, {title}, {body} ON {table}
+                         BEGIN
+                             INSERT OR IGNORE INTO search_pending (doc) VALUES (new.rowid * 4 + {code});
+                         END''')
+        conn.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_search_delete AFTER DELETE ON {table}
+                         BEGIN
+                             INSERT OR IGNORE INTO search_pending (doc) VALUES (old.rowid * 4 + {code});
+                         END''')
+        # The existing rows are indexed in the background (see search.py), not in the migration
+        conn.execute(f'INSERT OR IGNORE INTO search_pending (doc) SELECT rowid * 4 + {code} FROM {table}')
+
+JOURNAL_DATE_FORMAT = '%B %d, %Y %H:%M'  # how journals.entry_date is written and shown, e.g. "May 04, 2024 09:30"
+
+def journal_timestamp(entry_date):
+    """
+    journals.entry_time (epoch seconds) of an entry_date in JOURNAL_DATE_FORMAT or ISO-8601 - local time
+    unless it has an offset. Raises ValueError for anything else.
+    """
+    try:
+        return int(datetime.strptime(entry_date, JOURNAL_DATE_FORMAT).timestamp())
+    except (TypeError, ValueError):
+        pass
+    try:
+        return int(datetime.fromisoformat(entry_date).timestamp())
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid date {entry_date!r} - use e.g. {datetime.now().strftime(JOURNAL_DATE_FORMAT)!r} or ISO-8601")
+
+@schema_registry.migration(9, 'add journals.entry_time and indexes for paging journals')
+def _add_journal_times(conn):
+    # entry_date stays the text that is shown. entry_time can be sorted and compared in SQL; dates that
+    # can't be read count as 0, the oldest. It isn't one of REVISIONED_COLUMNS - it only ever changes
+    # together with entry_date, which is.
+    if 'entry_time' not in _table_columns(conn, 'journals'):
+        conn.execute('ALTER TABLE journals ADD COLUMN entry_time INTEGER NOT NULL DEFAULT 0')
+    times = []
+    for rowid, entry_date in conn.execute('SELECT rowid, entry_date FROM journals'):
+        try:
+            times.append((journal_timestamp(entry_date), rowid))
+        except ValueError:
+            print(f"Journal date {entry_date!r} can't be read, it sorts as the oldest")
+    conn.executemany('UPDATE journals SET entry_time = ? WHERE rowid = ?', times)
+    # The orders /journals/<dir> pages through, with id breaking ties
+    conn.execute('CREATE INDEX IF NOT EXISTS journals_entry_time ON journals (entry_time, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS journals_favorite_time ON journals (is_favorite, entry_time, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS journals_linked_item_id ON journals (linked_item_id)')
+
+@schema_registry.migration(10, 'add item counts for the map catalog')
+def _create_item_counts(conn):
+    # Kept by triggers, so the map catalog (catalog.py) reads a map's counts without counting its rows
+    conn.execute('CREATE TABLE IF NOT EXISTS item_counts (kind TEXT PRIMARY KEY, count INTEGER NOT NULL)')
+    for table in ('markers', 'lines', 'journals'):
+        conn.execute(f"INSERT OR REPLACE INTO item_counts (kind, count) VALUES ('{table}', (SELECT count(*) FROM {table}))")
+        conn.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_count_insert AFTER INSERT ON {table}
+                         BEGIN
+                             UPDATE item_counts SET count = count + 1 WHERE kind = '{table}';
+                         END''')
+        conn.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_count_delete AFTER DELETE ON {table}
+                         BEGIN
+                             UPDATE item_counts SET count = count - 1 WHERE kind = '{table}';
+                         END''')
+
+def get_item_counts(conn):
+    """{'markers': n, 'lines': n, 'journals': n} of a map database."""
+    counts = {'markers': 0, 'lines': 0, 'journals': 0}
+    counts.update(conn.execute('SELECT kind, count FROM item_counts'))
+    return counts
+
+def get_change_version(conn):
+    """The map's change counter - it goes up whenever a marker, line or journal is added, changed or deleted."""
+    row = conn.execute('SELECT version FROM change_counter WHERE id = 1').fetchone()
+    return row[0] if row else 0
+
+def ensure_schema(db_path):
+    """Makes sure the map database at db_path has the current tables - cheap once the file has been seen."""
+    schema_registry.ensure(db_path)
@@ -0,0 +1,150 @@
+"""
+Resized, recompressed variants of map and journal images (/img/<folder>/<file>?w=800&fmt=webp).
+
+Variants are made with Pillow the first time they are asked for and kept in the thumbnail directory,
+which is bounded by total size: when it grows past its limit the least recently used variants go first.
+Requested widths are rounded up to a fixed set of sizes (srcset friendly) so one image can't fill the
+cache with hundreds of near identical variants.
+"""
+
+import os
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+from PIL import Image, features
+
+DERIVATIVE_WIDTHS = (100, 200, 400, 800, 1200, 1600, 2400)
+# fmt -> (Pillow format, mimetype, file extension, save options)
+DERIVATIVE_FORMATS = {
+    'avif': ('AVIF', 'image/avif', 'avif', {'quality': 60}),
+    'webp': ('WEBP', 'image/webp', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+    'png': ('PNG', 'image/png', 'png', {'optimize': True})
+}
+# Formats the browser is offered when it didn't ask for one, best compression first
+NEGOTIATED_FORMATS = ('avif', 'webp')
+
+def format_supported(fmt):
+    return fmt in ('jpeg', 'png') or features.check(fmt)
+
+def choose_format(fmt, accept, source_path):
+    """Returns the format asked for with ?fmt=, or the best one the Accept header allows."""
+    if fmt:
+        fmt = 'jpeg' if fmt == 'jpg' else fmt
+        if fmt not in DERIVATIVE_FORMATS or not format_supported(fmt):
+            raise ValueError(f"Unsupported image format: {fmt}")
+        return fmt
+    # Only formats the browser names - */* doesn't mean it can decode AVIF
+    accepted = {mimetype for mimetype, quality in accept if quality > 0}
+    for candidate in NEGOTIATED_FORMATS:
+        if DERIVATIVE_FORMATS[candidate][1] in accepted and format_supported(candidate):
+            return candidate
+    # JPEG can't hold transparency, so images that may have some stay PNG
+    return 'jpeg' if source_path.lower().endswith(('.jpg', '.jpeg')) else 'png'
+
+def choose_width(width):
+    if width is None:
+        return None
+    if width <= 0:
+        raise ValueError("w must be a positive number of pixels")
+    return next((size for size in DERIVATIVE_WIDTHS if size >= width), DERIVATIVE_WIDTHS[-1])
+
+def has_alpha(img):
+    return img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+
+def make_derivative(source_path, output_path, width, fmt):
+    pillow_format, _, _, options = DERIVATIVE_FORMATS[fmt]
+    with Image.open(source_path) as img:
+        if width and width < img.width:
+            height = max(1, round(img.height * width / img.width))
+            # JPEG sources are decoded at a reduced scale right away
+            img.draft('RGB', (width, height))
+            img = img.resize((width, height), Image.LANCZOS, reducing_gap=3.0) if img.size != (width, height) else img
+        keep_alpha = has_alpha(img) and fmt != 'jpeg'
+        img = img.convert('RGBA' if keep_alpha else 'RGB')
+        img.save(output_path, pillow_format, **options)
+
+class DerivativeCache:
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = None  # OrderedDict of cache file path -> size, least recently used first
+        self._total = 0
+        self._build_locks = {}
+
+    def _load(self):
+        # Rebuild the LRU order from the files on disk - hits touch a file's mtime, so it survives restarts
+        os.makedirs(self.root, exist_ok=True)
+        files = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, name)
+                st = os.stat(path)
+                files.append((st.st_mtime, path, st.st_size))
+        self._entries = OrderedDict((path, size) for _, path, size in sorted(files))
+        self._total = sum(self._entries.values())
+
+    def _key(self, source_key, width, fmt):
+        name = hashlib.sha1(f'{source_key}|{width}|{fmt}'.encode()).hexdigest()
+        return os.path.join(self.root, name[:2], f'{name}.{DERIVATIVE_FORMATS[fmt][2]}')
+
+    def get(self, source_path, source_key, width, fmt):
+        """
+        Returns the path of the variant of source_path at width (None keeps the size) in fmt, making it if needed.
+        source_key identifies the image content, e.g. its blob hash or its path, size and mtime.
+        """
+        path = self._key(source_key, width, fmt)
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            if path in self._entries and os.path.exists(path):
+                self._entries.move_to_end(path)
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+                return path
+            build_lock = self._build_locks.setdefault(path, threading.Lock())
+
+        # Requests for the same variant wait for the first one instead of encoding it again
+        with build_lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+                try:
+                    make_derivative(source_path, temp_path, width, fmt)
+                    os.replace(temp_path, path)
+                finally:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+            size = os.path.getsize(path)
+
+        with self._lock:
+            self._build_locks.pop(path, None)
+            self._total += size - self._entries.pop(path, 0)
+            self._entries[path] = size
+            self._evict(keep=path)
+        return path
+
+    def _evict(self, keep):
+        while self._total > self.max_bytes and len(self._entries) > 1:
+            path, size = next(iter(self._entries.items()))
+            if path == keep:
+                self._entries.move_to_end(path)
+                continue
+            del self._entries[path]
+            self._total -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            return {'files': len(self._entries), 'bytes': self._total, 'max_bytes': self.max_bytes}
@@ -0,0 +1,78 @@
+"""
+Long polling for /maps/<folder>/changes?since=<revision>&wait=<seconds>.
+
+A request that finds nothing after since waits in ChangeNotifier.wait() until a write route publishes
+the map, the map's change counter moves or the wait runs out, and is then answered like any other
+/changes request. Write routes call publish() after they commit, which only wakes the waiting
+requests. Writes made by another process are noticed as well: a waiting request checks the change
+counter every poll_interval seconds, which stands in for a message broker when GoGrow runs as
+several processes.
+
+A waiting request holds one of waitress' threads until it is answered, so at most max_waiting
+requests wait at a time and each one waits at most max_wait seconds. Requests beyond that are
+answered straight away (wait() returns False) and the client asks again later - the server's
+threads stay free for ordinary requests however many browsers follow a map.
+"""
+
+import os
+import time
+import threading
+
+class ChangeNotifier:
+    def __init__(self, current_version, max_waiting=2, max_wait=25, poll_interval=1.0):
+        """current_version(db_path) returns the map's change counter."""
+        self.current_version = current_version
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self._changed = threading.Condition()
+        self._published = {}  # db_path -> number of publish() calls, for the maps requests wait on
+        self._waiting = {}  # db_path -> number of requests waiting on it
+        self._declined = 0
+
+    def publish(self, db_path):
+        """Tells the waiting requests a map was written to - cheap, and a no-op for maps nobody waits on."""
+        db_path = os.path.abspath(db_path)
+        with self._changed:
+            if db_path in self._waiting:
+                self._published[db_path] += 1
+                self._changed.notify_all()
+
+    def wait(self, db_path, since, timeout):
+        """
+        Waits up to timeout seconds (at most max_wait) for the map's change counter to differ from since.
+        Returns False without waiting when max_waiting requests are waiting already, True otherwise.
+        """
+        db_path = os.path.abspath(db_path)
+        with self._changed:
+            if sum(self._waiting.values()) >= self.max_waiting:
+                self._declined += 1
+                return False
+            self._waiting[db_path] = self._waiting.get(db_path, 0) + 1
+            self._published.setdefault(db_path, 0)
+
+        try:
+            deadline = time.monotonic() + min(timeout, self.max_wait)
+            while True:
+                # Taken before the counter is read, so a publish() in between ends the wait below at once
+                with self._changed:
+                    published = self._published[db_path]
+                if self.current_version(db_path) != since:
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return True
+                with self._changed:
+                    if self._published[db_path] == published:
+                        self._changed.wait(min(self.poll_interval, remaining))
+        finally:
+            with self._changed:
+                self._waiting[db_path] -= 1
+                if not self._waiting[db_path]:
+                    del self._waiting[db_path]
+                    del self._published[db_path]
+
+    def stats(self):
+        with self._changed:
+            return {'waiting': sum(self._waiting.values()), 'max_waiting': self.max_waiting,
+                    'maps': len(self._waiting), 'declined': self._declined}
@@ -0,0 +1,244 @@
+"""
+Streaming exports of a map's markers, lines and journals for /export/<folder> and /export_journals/<folder>.
+
+Rows are read from a cursor a batch at a time inside one read transaction, so an export is a
+consistent snapshot of the map whatever is written meanwhile, and memory use doesn't grow with the
+map. The encoded text is coalesced into CHUNK_SIZE pieces before it is sent - and optionally
+gzipped on the way - instead of one tiny write per row.
+
+Formats: CSV (the sections import_features reads back), GeoJSON, NDJSON, and the columnar Arrow
+stream and Parquet formats, whose record batches are built from NumPy arrays. The columnar formats
+need pyarrow, which is optional.
+"""
+
+import csv
+import json
+import zlib
+import numpy as np
+from io import StringIO
+from gogrow_app.database import get_db_connection, ensure_schema
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional, only the arrow and parquet formats need it
+    pa = None
+
+CHUNK_SIZE = 64 * 1024
+CURSOR_BATCH_ROWS = 1000
+COLUMNAR_BATCH_ROWS = 64 * 1024  # rows per Arrow record batch / Parquet row group
+GZIP_LEVEL = 6
+
+# format -> (mimetype, file extension, columnar)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv', False),
+    'geojson': ('application/geo+json', 'geojson', False),
+    'ndjson': ('application/x-ndjson', 'ndjson', False),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows', True),
+    'parquet': ('application/vnd.apache.parquet', 'parquet', True)
+}
+
+# table -> database columns, the names exports give them (those the API uses) and the numeric ones
+EXPORT_TABLES = {
+    'markers': {
+        'columns': ('id', 'lat', 'lng', 'info', 'iconType', 'iconColor', 'markerNotes'),
+        'fields': ('markerId', 'lat', 'lng', 'info', 'iconType', 'iconColor', 'markerNotes'),
+        'numeric': ('lat', 'lng')
+    },
+    'lines': {
+        'columns': ('id', 'start_lat', 'start_lng', 'end_lat', 'end_lng', 'info', 'color', 'notes'),
+        'fields': ('lineId', 'start_lat', 'start_lng', 'end_lat', 'end_lng', 'info', 'color', 'notes'),
+        'numeric': ('start_lat', 'start_lng', 'end_lat', 'end_lng')
+    },
+    'journals': {
+        # The CSV export has always left out is_favorite, so it comes last and CSV stops before it
+        'columns': ('id', 'entry_date', 'linked_item_id', 'entry_title', 'entry_content', 'is_favorite'),
+        'fields': ('journalId', 'entry_date', 'linked_item_id', 'entry_title', 'entry_content', 'is_favorite'),
+        'numeric': (),
+        'csv_fields': 5
+    }
+}
+
+encode_json = json.JSONEncoder(separators=(',', ':')).encode
+
+def available_formats():
+    return [fmt for fmt, (_, _, columnar) in EXPORT_FORMATS.items() if pa is not None or not columnar]
+
+def check_export(fmt, tables):
+    """Raises ValueError when tables can't be exported in fmt."""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    if fmt not in available_formats():
+        raise ValueError(f"The {fmt} format needs pyarrow, which isn't installed")
+    if fmt == 'geojson' and 'journals' in tables:
+        raise ValueError("Journals have no geometry - export them as csv, ndjson, arrow or parquet")
+    if EXPORT_FORMATS[fmt][2] and len(tables) > 1:
+        # An Arrow stream or Parquet file has one schema, so it holds one table
+        raise ValueError(f"A {fmt} export holds one kind of item - give kind=markers or kind=lines")
+
+def has_rows(db_path, tables):
+    ensure_schema(db_path)
+    conn = get_db_connection(db_path)
+    try:
+        return any(conn.execute(f'SELECT EXISTS (SELECT 1 FROM {table})').fetchone()[0] for table in tables)
+    finally:
+        conn.close()
+
+def read_batches(conn, table, size=CURSOR_BATCH_ROWS):
+    cursor = conn.execute(f"SELECT {', '.join(EXPORT_TABLES[table]['columns'])} FROM {table} ORDER BY rowid")
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield rows
+
+def coalesce(pieces, size=CHUNK_SIZE):
+    """Joins str and bytes pieces into chunks of about size bytes."""
+    buffer = []
+    buffered = 0
+    for piece in pieces:
+        if isinstance(piece, str):
+            piece = piece.encode('utf-8')
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield b''.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffered:
+        yield b''.join(buffer)
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31: a gzip header and trailer
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def export_csv(conn, tables):
+    data = StringIO()
+    writer = csv.writer(data)
+    for table in tables:
+        spec = EXPORT_TABLES[table]
+        count = spec.get('csv_fields', len(spec['fields']))
+        writer.writerow(spec['fields'][:count])
+        for rows in read_batches(conn, table):
+            writer.writerows(rows if count == len(spec['fields']) else [row[:count] for row in rows])
+            yield data.getvalue()
+            data.seek(0)
+            data.truncate(0)
+    yield data.getvalue()
+
+def feature(table, item):
+    # GeoJSON positions are [x, y], which is [lng, lat] on a map in image coordinates
+    if table == 'markers':
+        geometry = {'type': 'Point', 'coordinates': [item.pop('lng'), item.pop('lat')]}
+        item_id = item.pop('markerId')
+    else:
+        geometry = {'type': 'LineString', 'coordinates': [[item.pop('start_lng'), item.pop('start_lat')],
+                                                          [item.pop('end_lng'), item.pop('end_lat')]]}
+        item_id = item.pop('lineId')
+    return {'type': 'Feature', 'id': item_id, 'geometry': geometry, 'properties': item}
+
+def export_geojson(conn, tables):
+    yield '{"type":"FeatureCollection","features":[\n'
+    separator = ''
+    for table in tables:
+        fields = EXPORT_TABLES[table]['fields']
+        for rows in read_batches(conn, table):
+            yield separator + ',\n'.join(encode_json(feature(table, dict(zip(fields, row)))) for row in rows)
+            separator = ',\n'
+    yield '\n]}\n'
+
+def export_ndjson(conn, tables):
+    for table in tables:
+        fields = EXPORT_TABLES[table]['fields']
+        for rows in read_batches(conn, table):
+            yield ''.join(encode_json({'kind': table, **dict(zip(fields, row))}) + '\n' for row in rows)
+
+def columnar_schema(table):
+    spec = EXPORT_TABLES[table]
+    return pa.schema([(field, pa.float64() if field in spec['numeric'] else pa.string()) for field in spec['fields']])
+
+def record_batch(table, rows, schema):
+    spec = EXPORT_TABLES[table]
+    arrays = []
+    for index, field in enumerate(spec['fields']):
+        if field in spec['numeric']:
+            # NULL coordinates become NaN, which from_pandas turns back into nulls
+            values = np.array([row[index] for row in rows], dtype=np.float64)
+            arrays.append(pa.array(values, type=pa.float64(), from_pandas=True))
+        else:
+            arrays.append(pa.array([row[index] for row in rows], type=pa.string()))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+class ChunkSink:
+    """A write-only file for pyarrow whose output is collected and taken with drain()."""
+
+    def __init__(self):
+        self.closed = False
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return b''.join(chunks)
+
+def export_columnar(conn, tables, fmt):
+    table = tables[0]
+    schema = columnar_schema(table)
+    sink = ChunkSink()
+    writer = pa.ipc.new_stream(sink, schema) if fmt == 'arrow' else pq.ParquetWriter(sink, schema)
+    try:
+        for rows in read_batches(conn, table, COLUMNAR_BATCH_ROWS):
+            batch = record_batch(table, rows, schema)
+            if fmt == 'arrow':
+                writer.write_batch(batch)
+            else:
+                writer.write_batch(batch, row_group_size=COLUMNAR_BATCH_ROWS)
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+EXPORT_WRITERS = {
+    'csv': export_csv,
+    'geojson': export_geojson,
+    'ndjson': export_ndjson
+}
+
+def stream_export(db_path, tables, fmt, gzip=False):
+    """
+    Yields the export of tables as chunks of bytes. The rows come from one read transaction that ends
+    when the generator does - also when the client goes away and the server closes it.
+    """
+    check_export(fmt, tables)
+    ensure_schema(db_path)
+    conn = get_db_connection(db_path)
+    try:
+        conn.execute('BEGIN')
+        try:
+            if EXPORT_FORMATS[fmt][2]:
+                chunks = coalesce(export_columnar(conn, tables, fmt))
+            else:
+                chunks = coalesce(EXPORT_WRITERS[fmt](conn, tables))
+            yield from gzip_chunks(chunks) if gzip else chunks
+        finally:
+            conn.rollback()
+    finally:
+        conn.close()
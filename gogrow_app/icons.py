@@ -0,0 +1,292 @@
+"""
+The icon catalog, and marker icons with their color applied on the server.
+
+IconCatalog loads ICON_DIR once - names, sizes, content hashes and the (minified) SVGs - keeps a search
+index for the icon picker, and polls the directory so added, edited and deleted icons are picked up
+without rescanning it on every request.
+
+Colored icons are memoized in memory and written to the icon cache directory, keyed by the icon's
+content hash, so an edited SVG is colored again. A bundle holds data: URIs for a set of
+(iconType, iconColor) pairs (what SvgIcon in gogrow.js uses); a sprite holds them as <symbol>s.
+"""
+
+import os
+import re
+import json
+import time
+import base64
+import bisect
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+COLOR_PATTERN = re.compile(r'^(#[0-9a-fA-F]{3,8}|[a-zA-Z]{1,32})$')
+SVG_TAG_PATTERN = re.compile(r'<svg\b[^>]*>', re.IGNORECASE)
+STYLE_ATTRIBUTE_PATTERN = re.compile(r'\sstyle="([^"]*)"', re.IGNORECASE)
+DEFAULT_ICON_COLOR = '#000000'
+ICON_POLL_INTERVAL = 5  # seconds between checks of ICON_DIR for changes
+ICON_FULL_CHECK_EVERY = 12  # polls - in-place edits don't touch the directory mtime, so stat every file now and then
+WHITESPACE_BETWEEN_TAGS = re.compile(r'>\s+<')
+
+# One icon of the catalog. data is the minified SVG text, or None when the catalog doesn't keep SVGs in memory.
+IconEntry = namedtuple('IconEntry', ['name', 'size', 'mtime', 'digest', 'data'])
+
+def minify_svg(svg):
+    # Whitespace between tags only - the license comments of the bundled icons stay
+    return WHITESPACE_BETWEEN_TAGS.sub('><', svg.strip())
+
+class IconCatalog:
+    def __init__(self, icon_dir, keep_data=True, poll_interval=ICON_POLL_INTERVAL):
+        self.icon_dir = icon_dir
+        self.keep_data = keep_data
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._entries = {}  # name -> IconEntry
+        self._names = []  # sorted like os.listdir() + sorted() did
+        self._search_keys = []  # (lowercase name, name), sorted, for prefix search
+        self._dir_mtime = None
+        self._loaded = False
+        self._watching = False
+
+    def _read_entry(self, name, st):
+        path = os.path.join(self.icon_dir, name)
+        with open(path, 'rb') as icon_file:
+            raw = icon_file.read()
+        data = None
+        if self.keep_data and name.lower().endswith('.svg'):
+            data = minify_svg(raw.decode('utf-8'))
+        return IconEntry(name, st.st_size, st.st_mtime_ns, hashlib.sha256(raw).hexdigest(), data)
+
+    def refresh(self, full=False):
+        """
+        Brings the catalog up to date with ICON_DIR, only reading icons that were added or changed.
+        Without full, nothing is checked while the directory's mtime hasn't changed.
+        """
+        try:
+            dir_mtime = os.stat(self.icon_dir).st_mtime_ns
+        except OSError:
+            return
+        if not full and self._loaded and dir_mtime == self._dir_mtime:
+            return
+
+        entries = {}
+        changed = 0
+        with os.scandir(self.icon_dir) as scan:
+            for item in scan:
+                if not item.is_file() or item.name.startswith('.'):
+                    continue
+                st = item.stat()
+                old = self._entries.get(item.name)
+                if old and old.size == st.st_size and old.mtime == st.st_mtime_ns:
+                    entries[item.name] = old
+                    continue
+                try:
+                    entries[item.name] = self._read_entry(item.name, st)
+                    changed += 1
+                except (OSError, UnicodeDecodeError) as e:
+                    print(f"Skipping icon {item.name}: {e}")
+
+        removed = len(set(self._entries) - set(entries))
+        names = sorted(entries)
+        search_keys = sorted((name.lower(), name) for name in names)
+        with self._lock:
+            self._entries = entries
+            self._names = names
+            self._search_keys = search_keys
+            self._dir_mtime = dir_mtime
+        if self._loaded and (changed or removed):
+            print(f"Icon catalog updated: {changed} new or changed, {removed} removed")
+        self._loaded = True
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.refresh()
+
+    def start_watching(self):
+        with self._lock:
+            if self._watching:
+                return
+            self._watching = True
+        self._ensure_loaded()
+        thread = threading.Thread(target=self._watch_loop, name='icon-catalog', daemon=True)
+        thread.start()
+
+    def _watch_loop(self):
+        polls = 0
+        while True:
+            time.sleep(self.poll_interval)
+            polls += 1
+            try:
+                self.refresh(full=polls % ICON_FULL_CHECK_EVERY == 0)
+            except Exception as e:
+                print(f"Error refreshing icon catalog: {e}")
+
+    def names(self):
+        self._ensure_loaded()
+        return list(self._names)
+
+    def get(self, name):
+        self._ensure_loaded()
+        return self._entries.get(name)
+
+    def read(self, name):
+        """The SVG text of an icon (from memory when the catalog keeps it), or None if there is no such icon."""
+        entry = self.get(name)
+        if entry is None:
+            return None
+        if entry.data is not None:
+            return entry.data
+        with open(os.path.join(self.icon_dir, name), encoding='utf-8') as icon_file:
+            return icon_file.read()
+
+    def search(self, query, limit=None):
+        """Icon names starting with query first, then the ones containing it, alphabetically within each group."""
+        self._ensure_loaded()
+        query = (query or '').strip().lower()
+        if not query:
+            names = self._names
+            return names[:limit] if limit else list(names)
+
+        search_keys = self._search_keys
+        start = bisect.bisect_left(search_keys, (query,))
+        matches = []
+        for lower, name in search_keys[start:]:
+            if not lower.startswith(query):
+                break
+            matches.append(name)
+            if limit and len(matches) >= limit:
+                return matches
+        for lower, name in search_keys:
+            if query in lower and not lower.startswith(query):
+                matches.append(name)
+                if limit and len(matches) >= limit:
+                    break
+        return matches
+
+    def stats(self):
+        self._ensure_loaded()
+        return {'icons': len(self._entries), 'bytes': sum(entry.size for entry in self._entries.values()),
+                'in_memory': self.keep_data, 'watching': self._watching}
+
+def normalize_color(color):
+    color = (color or DEFAULT_ICON_COLOR).strip()
+    if not COLOR_PATTERN.match(color):
+        raise ValueError(f"Invalid icon color: {color}")
+    return color.lower()
+
+def colorize_svg(svg, color):
+    """Sets the fill of the root <svg> element, like SvgIcon did in the browser with style.fill."""
+    match = SVG_TAG_PATTERN.search(svg)
+    if match is None:
+        raise ValueError("Not an SVG file")
+    tag = match.group(0)
+    style = STYLE_ATTRIBUTE_PATTERN.search(tag)
+    if style:
+        declarations = style.group(1).rstrip('; ')
+        new_style = f' style="{declarations + "; " if declarations else ""}fill: {color}"'
+        new_tag = tag[:style.start()] + new_style + tag[style.end():]
+    else:
+        new_tag = tag[:-2] + f' style="fill: {color}"/>' if tag.endswith('/>') else tag[:-1] + f' style="fill: {color}">'
+    return svg[:match.start()] + new_tag + svg[match.end():]
+
+def parse_icon_pairs(value):
+    """Parses "leaf.svg:#ff0000,tree.svg:#00ff00" into a sorted list of (iconType, iconColor) pairs."""
+    pairs = set()
+    for item in filter(None, (item.strip() for item in (value or '').split(','))):
+        icon_type, _, color = item.partition(':')
+        pairs.add((icon_type, normalize_color(color)))
+    return sorted(pairs)
+
+class IconCache:
+    def __init__(self, catalog, cache_dir, max_bundles=128):
+        self.catalog = catalog
+        self.cache_dir = cache_dir
+        self.max_bundles = max_bundles
+        self._lock = threading.Lock()
+        self._colored = {}  # (icon_type, color) -> (icon digest, colored svg)
+        self._bundles = OrderedDict()  # (kind, pairs, icon versions) -> (etag, body)
+
+    def _icon_entry(self, icon_type):
+        if not icon_type.lower().endswith('.svg'):
+            return None
+        return self.catalog.get(icon_type)
+
+    def colored_icon(self, icon_type, color):
+        """The SVG of icon_type filled with color, or None when there is no such icon."""
+        entry = self._icon_entry(icon_type)
+        if entry is None:
+            return None
+        key = (icon_type, color)
+        cached = self._colored.get(key)
+        if cached and cached[0] == entry.digest:
+            return cached[1]
+
+        svg = self.catalog.read(icon_type)
+        cache_path = os.path.join(self.cache_dir, color.lstrip('#'), f'{os.path.splitext(icon_type)[0]}-{entry.digest[:16]}.svg')
+        try:
+            with open(cache_path, encoding='utf-8') as cache_file:
+                colored = cache_file.read()
+        except OSError:
+            colored = colorize_svg(svg, color)
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            temp_path = f'{cache_path}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as cache_file:
+                cache_file.write(colored)
+            os.replace(temp_path, cache_path)
+
+        with self._lock:
+            self._colored[key] = (entry.digest, colored)
+        return colored
+
+    def _cached_bundle(self, kind, pairs, build):
+        versions = tuple(entry.digest if entry else None for entry in (self._icon_entry(icon_type) for icon_type, _ in pairs))
+        key = (kind, tuple(pairs), versions)
+        with self._lock:
+            cached = self._bundles.get(key)
+            if cached:
+                self._bundles.move_to_end(key)
+                return cached
+        body = build()
+        cached = (hashlib.sha256(body.encode('utf-8')).hexdigest(), body)
+        with self._lock:
+            self._bundles[key] = cached
+            while len(self._bundles) > self.max_bundles:
+                self._bundles.popitem(last=False)
+        return cached
+
+    def bundle(self, pairs):
+        """
+        JSON object of "iconType|iconColor" -> data: URI for every pair whose icon exists, with its ETag.
+        """
+        def build():
+            icons = {}
+            for icon_type, color in pairs:
+                colored = self.colored_icon(icon_type, color)
+                if colored is not None:
+                    icons[f'{icon_type}|{color}'] = 'data:image/svg+xml;base64,' + base64.b64encode(colored.encode('utf-8')).decode('ascii')
+            return json.dumps(icons)
+        return self._cached_bundle('bundle', pairs, build)
+
+    def sprite(self, pairs):
+        """
+        One SVG with a <symbol id="icon-<n>"> per pair, in the order of pairs, with its ETag.
+        """
+        def build():
+            symbols = []
+            for index, (icon_type, color) in enumerate(pairs):
+                colored = self.colored_icon(icon_type, color)
+                if colored is None:
+                    continue
+                match = SVG_TAG_PATTERN.search(colored)
+                attributes = match.group(0)[4:].rstrip('/>').strip()
+                viewbox = re.search(r'viewBox="([^"]*)"', attributes)
+                style = STYLE_ATTRIBUTE_PATTERN.search(' ' + attributes)
+                inner = colored[match.end():colored.rfind('</svg>')]
+                symbol = f'<symbol id="icon-{index}"'
+                if viewbox:
+                    symbol += f' viewBox="{viewbox.group(1)}"'
+                if style:
+                    symbol += f' style="{style.group(1)}"'
+                symbols.append(f'{symbol}>{inner}</symbol>')
+            return '<svg xmlns="http://www.w3.org/2000/svg" style="display: none">' + ''.join(symbols) + '</svg>'
+        return self._cached_bundle('sprite', pairs, build)
@@ -0,0 +1,318 @@
+"""
+Streaming import of markers and lines from CSV (the columns /export/<folder> writes) and GeoJSON.
+
+Records pass through a chain of generators - read, validate, batch - so memory use doesn't grow with
+the file, and every IMPORT_BATCH_SIZE records are written in one transaction (see batch.py) together
+with the import's checkpoint in the map database's imports table. An interrupted import picks up
+after its last checkpoint and never writes a record twice. Imports run as background jobs
+(POST /maps/<folder>/import) or from the command line (import_features.py).
+"""
+
+import io
+import os
+import csv
+import json
+import time
+import uuid
+from itertools import islice
+from gogrow_app.batch import apply_batch
+from gogrow_app.database import get_db_connection, ensure_schema
+from gogrow_app.icons import DEFAULT_ICON_COLOR
+from gogrow_app.ingest import INCOMING_DIR_NAME
+from gogrow_app.validation import sanitize_input, parse_coordinate
+
+IMPORT_FORMATS = {'csv': '.csv', 'geojson': '.geojson'}  # format -> extension the uploaded file is kept under
+IMPORT_BATCH_SIZE = 1000
+MAX_IMPORT_ERRORS = 100  # errors kept per import, the rest are only counted
+READ_CHUNK_SIZE = 64 * 1024
+DEFAULT_ICON_TYPE = 'location-pin.svg'
+DEFAULT_LINE_COLOR = '#000000'
+
+# kind -> coordinate fields, text fields with the defaults used when a file leaves them out, and the
+# id column export writes
+IMPORT_FIELDS = {
+    'markers': {
+        'coordinates': ('lat', 'lng'),
+        'text': {'info': '', 'iconType': DEFAULT_ICON_TYPE, 'iconColor': DEFAULT_ICON_COLOR, 'markerNotes': ''},
+        'id': 'markerId'
+    },
+    'lines': {
+        'coordinates': ('start_lat', 'start_lng', 'end_lat', 'end_lng'),
+        'text': {'info': '', 'color': DEFAULT_LINE_COLOR, 'notes': ''},
+        'id': 'lineId'
+    }
+}
+
+IMPORT_COLUMNS = ['id', 'filename', 'format', 'status', 'size', 'bytes_read', 'records', 'inserted', 'failed',
+                  'errors', 'message', 'created_at', 'updated_at']
+
+def guess_format(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('.geojson', '.json'):
+        return 'geojson'
+    raise ValueError("Can't tell the format from the file name - give format=csv or format=geojson")
+
+def header_kind(names):
+    if 'start_lat' in names:
+        return 'lines'
+    if 'lat' in names and 'lng' in names:
+        return 'markers'
+    return None
+
+def read_csv(stream):
+    """
+    Yields (kind, fields, error) for every data row. A header row starts a section of markers (it has
+    lat and lng columns) or lines (start_lat etc.), like the two sections export writes.
+    """
+    header = kind = None
+    for row in csv.reader(stream):
+        if not any(cell.strip() for cell in row):
+            continue
+        names = [cell.strip() for cell in row]
+        row_kind = header_kind(names)
+        if row_kind:
+            header, kind = names, row_kind
+            continue
+        if header is None:
+            raise ValueError("The CSV file must start with a header row, e.g. markerId,lat,lng,info,iconType,iconColor,markerNotes")
+        yield kind, dict(zip(header, row)), None
+
+class JsonReader:
+    """Decodes a JSON document one value at a time, reading it in chunks."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """The next character that isn't whitespace, or '' at the end of the document."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"Invalid GeoJSON: expected {' or '.join(chars)}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                if self.eof:
+                    raise ValueError(f"Invalid GeoJSON: {e.msg}")
+            else:
+                # A number at the end of the buffer may go on in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            self._fill()
+
+def feature_record(feature):
+    if not isinstance(feature, dict) or feature.get('type') != 'Feature':
+        return None, None, "Not a GeoJSON Feature"
+    geometry = feature.get('geometry') or {}
+    geometry_type = geometry.get('type')
+    coordinates = geometry.get('coordinates')
+    fields = dict(feature.get('properties') or {})
+    if feature.get('id') is not None:
+        fields.setdefault('id', str(feature['id']))
+    # GeoJSON positions are [x, y], which is [lng, lat] on a map in image coordinates
+    try:
+        if geometry_type == 'Point':
+            fields['lng'], fields['lat'] = coordinates[0], coordinates[1]
+            return 'markers', fields, None
+        if geometry_type == 'LineString' and len(coordinates) >= 2:
+            fields['start_lng'], fields['start_lat'] = coordinates[0][0], coordinates[0][1]
+            fields['end_lng'], fields['end_lat'] = coordinates[-1][0], coordinates[-1][1]
+            return 'lines', fields, None
+    except (TypeError, IndexError, KeyError):
+        return None, None, "Invalid coordinates"
+    return None, None, f"Unsupported geometry: {geometry_type}"
+
+def read_geojson(stream):
+    """
+    Yields (kind, fields, error) for every feature of a FeatureCollection - decoded one at a time, so
+    the collection is never in memory as a whole - or for a single Feature. Points become markers and
+    LineStrings lines (from their first to their last position).
+    """
+    reader = JsonReader(stream)
+    reader.expect('{')
+    members = {}
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == 'features':
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.pos += 1
+            else:
+                while True:
+                    yield feature_record(reader.value())
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            # "type", "crs" and the like, or the members of a single Feature
+            members[key] = reader.value()
+        if reader.expect(',}') == '}':
+            break
+    if members.get('type') == 'Feature':
+        yield feature_record(members)
+
+def to_operation(kind, fields):
+    """The batch insert operation for a record, raising ValueError when the record is invalid."""
+    spec = IMPORT_FIELDS[kind]
+    operation = {'op': 'insert', 'kind': kind}
+    item_id = fields.get(spec['id']) or fields.get('id')
+    if item_id not in (None, ''):
+        operation['id'] = str(item_id).strip()
+    for name in spec['coordinates']:
+        operation[name] = parse_coordinate(fields.get(name), name)
+    for name, default in spec['text'].items():
+        value = fields.get(name)
+        operation[name] = sanitize_input(str(value)) if value not in (None, '') else default
+    return operation
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def check_format(fmt):
+    if fmt not in IMPORT_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(IMPORT_FORMATS)}")
+    return fmt
+
+def create_import(db_path, filename, fmt, path):
+    """Registers an import of the file at path and returns its id - run_import() does the work."""
+    check_format(fmt)
+    ensure_schema(db_path)
+    import_id = str(uuid.uuid4())
+    now = time.time()
+    conn = get_db_connection(db_path)
+    try:
+        conn.execute('INSERT INTO imports (id, filename, format, path, size, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (import_id, filename, fmt, os.path.abspath(path), os.path.getsize(path), now, now))
+        conn.commit()
+    finally:
+        conn.close()
+    return import_id
+
+def get_import(db_path, import_id):
+    ensure_schema(db_path)
+    conn = get_db_connection(db_path)
+    try:
+        row = conn.execute(f"SELECT {', '.join(IMPORT_COLUMNS)} FROM imports WHERE id = ?", (import_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    result = dict(zip(IMPORT_COLUMNS, row))
+    result['errors'] = json.loads(result['errors'])
+    result['progress'] = 1.0 if result['status'] == 'done' else (result['bytes_read'] / result['size'] if result['size'] else 0.0)
+    return result
+
+def run_import(db_path, import_id, report_progress=None, remove_file=False):
+    """
+    Imports the records of an import that haven't been imported yet. Returns the import's status.
+    remove_file deletes the file once everything is imported if it is an upload in the map's incoming
+    folder - a file import_features.py was given is left alone, even when the import is resumed as a job.
+    """
+    ensure_schema(db_path)
+    conn = get_db_connection(db_path)
+    try:
+        row = conn.execute('SELECT path, format, size, records, inserted, failed, errors, status FROM imports WHERE id = ?',
+                           (import_id,)).fetchone()
+        if row is None:
+            raise ValueError(f"No import {import_id}")
+        path, fmt, size, records, inserted, failed, errors, status = row
+        if status == 'done':
+            return get_import(db_path, import_id)
+        state = {'records': records, 'inserted': inserted, 'failed': failed, 'errors': json.loads(errors)}
+        conn.execute("UPDATE imports SET status = 'running', message = NULL, updated_at = ? WHERE id = ?", (time.time(), import_id))
+        conn.commit()
+
+        try:
+            with open(path, 'rb') as raw:
+                stream = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+                reader = read_csv(stream) if fmt == 'csv' else read_geojson(stream)
+                # Records up to the checkpoint were imported before an interruption
+                for batch in batched(islice(reader, records, None), IMPORT_BATCH_SIZE):
+                    _import_batch(conn, import_id, batch, state, raw.tell())
+                    if report_progress:
+                        report_progress(min(raw.tell() / size, 1.0) if size else 0.0, f"{state['records']} records imported")
+        except Exception as e:
+            conn.rollback()
+            conn.execute("UPDATE imports SET status = 'failed', message = ?, updated_at = ? WHERE id = ?", (str(e), time.time(), import_id))
+            conn.commit()
+            raise
+
+        conn.execute("UPDATE imports SET status = 'done', bytes_read = size, updated_at = ? WHERE id = ?", (time.time(), import_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+    uploaded = os.path.dirname(path) == os.path.join(os.path.dirname(os.path.abspath(db_path)), INCOMING_DIR_NAME)
+    if remove_file and uploaded and os.path.exists(path):
+        os.remove(path)
+    return get_import(db_path, import_id)
+
+def _import_batch(conn, import_id, batch, state, bytes_read):
+    first = state['records']
+    operations = []
+    invalid = []
+    for offset, (kind, fields, error) in enumerate(batch):
+        if error is None:
+            try:
+                operations.append((first + offset, to_operation(kind, fields)))
+                continue
+            except ValueError as e:
+                error = str(e)
+        invalid.append((first + offset, error))
+
+    def checkpoint(conn, results):
+        # Written in the batch's own transaction, so the rows and the resume point can't disagree
+        failures = invalid + [(operations[result['index']][0], result['error']) for result in results if not result['ok']]
+        state['records'] = first + len(batch)
+        state['inserted'] += len(results) - (len(failures) - len(invalid))
+        state['failed'] += len(failures)
+        for record, error in sorted(failures):
+            if len(state['errors']) >= MAX_IMPORT_ERRORS:
+                break
+            state['errors'].append({'record': record + 1, 'error': error})
+        conn.execute('UPDATE imports SET records = ?, inserted = ?, failed = ?, errors = ?, bytes_read = ?, updated_at = ? WHERE id = ?',
+                     (state['records'], state['inserted'], state['failed'], json.dumps(state['errors']), bytes_read, time.time(), import_id))
+
+    apply_batch(conn, [operation for _, operation in operations], before_commit=checkpoint)
+
+def import_features(payload, report_progress):
+    """Job handler (see jobs.py) - runs or resumes an import of an uploaded file."""
+    result = run_import(payload['db_path'], payload['import_id'], report_progress, remove_file=True)
+    return {key: result[key] for key in ('id', 'status', 'records', 'inserted', 'failed')}
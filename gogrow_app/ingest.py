@@ -0,0 +1,88 @@
+"""
+Image ingestion steps that run as background jobs (see jobs.py): RAW decoding, thumbnails and tiles.
+Results are kept in the blob store (see blobs.py), so an image that was ingested before is only linked.
+"""
+
+import os
+from PIL import Image
+from gogrow_app.tiles import pyramid_info, get_tile, TILE_DIR_NAME
+from gogrow_app.blobs import BlobStore, hash_file, place_link
+from gogrow_app.catalog import MapCatalog
+
+THUMBNAIL_SIZE = (200, 200)
+INCOMING_DIR_NAME = 'incoming'  # uploads waiting for a worker live here, out of get_image_url()'s way
+
+def convert_raw_to_jpeg(raw_path, output_path):
+    import rawpy
+    import imageio
+    with rawpy.imread(raw_path) as raw:
+        rgb = raw.postprocess()
+    imageio.imsave(output_path, rgb)
+
+def save_thumbnail(image_path, thumbnail_path, size=THUMBNAIL_SIZE):
+    with Image.open(image_path) as img:
+        img.draft('RGB', size)
+        img.thumbnail(size)
+        img.save(thumbnail_path, "PNG")
+
+def ingest_image(payload, report_progress):
+    """
+    Finishes an uploaded map image: converts a RAW upload to .jpg, saves the folder thumbnail and
+    cuts every tile level so the map opens without waiting for tiles. With a blob_root in the payload
+    the image is stored by content, and whatever was already done for the same image is reused.
+    """
+    folder_path = payload['folder']
+    image_path = os.path.join(folder_path, payload['filename'])
+    thumbnail_path = os.path.join(folder_path, payload['thumbnail'])
+    store = BlobStore(payload['blob_root']) if payload.get('blob_root') else None
+
+    raw_path = payload.get('raw_path')
+    sha256 = None
+    if raw_path:
+        if store:
+            # The .jpg a RAW file decodes to is remembered by the RAW file's hash
+            report_progress(0.02, 'Hashing RAW image')
+            raw_sha256 = payload.get('sha256') or hash_file(raw_path)
+            sha256 = store.get_derived(raw_sha256, 'jpg')
+            if sha256 and not store.link_blob(sha256, image_path, 'map'):
+                sha256 = None
+        if sha256 is None:
+            report_progress(0.05, 'Decoding RAW image')
+            # Convert next to the RAW file and move the result in place, so a half written .jpg is never served
+            converted_path = os.path.join(os.path.dirname(raw_path), payload['filename'])
+            convert_raw_to_jpeg(raw_path, converted_path)
+            os.replace(converted_path, image_path)
+            if store:
+                sha256, _ = store.add_file(image_path, 'map')
+                store.set_derived(raw_sha256, 'jpg', sha256)
+        os.remove(raw_path)
+    elif store:
+        report_progress(0.02, 'Hashing image')
+        sha256, _ = store.add_file(image_path, 'map', payload.get('sha256'))
+
+    if sha256:
+        stored_thumbnail = store.derived_path(sha256, 'thumbnail.png')
+        if not os.path.exists(stored_thumbnail):
+            report_progress(0.5, 'Creating thumbnail')
+            save_thumbnail(image_path, f'{stored_thumbnail}.tmp')
+            os.replace(f'{stored_thumbnail}.tmp', stored_thumbnail)
+        place_link(stored_thumbnail, thumbnail_path)
+        tiles_dir = store.tiles_dir(sha256)
+    else:
+        report_progress(0.5, 'Creating thumbnail')
+        save_thumbnail(image_path, f'{thumbnail_path}.tmp')
+        os.replace(f'{thumbnail_path}.tmp', thumbnail_path)
+        tiles_dir = os.path.join(folder_path, TILE_DIR_NAME)
+
+    # The map picker shows the new image, its thumbnail and content hash from here on
+    MapCatalog(os.path.dirname(folder_path), store.sha256_of if store else None).refresh(os.path.basename(folder_path))
+
+    # Levels that were cut for another map with the same image are already there
+    info = pyramid_info(image_path)
+    levels = info['max_zoom'] + 1
+    for z in range(levels):
+        report_progress(0.6 + 0.4 * z / levels, f'Cutting tile level {z}')
+        get_tile(tiles_dir, image_path, z, 0, 0)
+
+    print(f"Image ingested: {image_path}")
+    return {'image': payload['filename'], 'thumbnail': payload['thumbnail'], 'max_zoom': info['max_zoom'], 'sha256': sha256}
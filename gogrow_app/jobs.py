@@ -0,0 +1,227 @@
+"""
+Background jobs (image ingestion and the like) that run in a process pool instead of a request thread.
+
+Jobs are kept in a small SQLite table in the img root, so queued jobs survive a restart and their
+status can be looked up with /jobs/<id>. Handlers run in worker processes and report their progress
+by writing to the same table.
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import importlib
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Job kinds and the functions that run them, as "module.function" so worker processes can import them.
+# Handlers are called with the job's payload and a report_progress(fraction, message=None) callback.
+JOB_HANDLERS = {
+    'ingest_image': 'gogrow_app.ingest.ingest_image',
+    'collect_blob_garbage': 'gogrow_app.blobs.collect_blob_garbage',
+    'import_features': 'gogrow_app.importer.import_features',
+    'restore_backup': 'gogrow_app.backups.restore_backup',
+    'index_search': 'gogrow_app.search.index_search'
+}
+
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+def _set_progress(db_path, job_id, progress, message=None):
+    conn = _connect(db_path)
+    try:
+        conn.execute('UPDATE jobs SET progress=?, message=COALESCE(?, message), updated_at=? WHERE id=?',
+                     (progress, message, time.time(), job_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+def run_job(db_path, job_id, kind, payload):
+    """Runs in a worker process - imports the handler for kind and calls it with a progress callback."""
+    module_name, function_name = JOB_HANDLERS[kind].rsplit('.', 1)
+    handler = getattr(importlib.import_module(module_name), function_name)
+
+    def report_progress(progress, message=None):
+        _set_progress(db_path, job_id, progress, message)
+
+    return handler(payload, report_progress)
+
+def _eta(status, progress, started_at):
+    """Seconds a running job has left, assuming it keeps its pace so far - None until it reported progress."""
+    if status != 'running' or not started_at or not progress:
+        return None
+    elapsed = time.time() - started_at
+    return round(elapsed * (1 - progress) / progress, 1)
+
+class JobQueue:
+    def __init__(self, db_path, workers=2):
+        self.db_path = db_path
+        self.workers = max(1, workers)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._executor = None
+        self._running = 0
+        self._started = False
+        self._has_table = False
+
+    def start(self):
+        """Starts running jobs - once, from the server process (runserver.py). Until then jobs are only queued."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+        conn = self._connect()
+        try:
+            # Jobs that were running when the server stopped start over
+            conn.execute("UPDATE jobs SET status='queued', progress=0, started_at=NULL WHERE status='running'")
+            conn.commit()
+        finally:
+            conn.close()
+
+        thread = threading.Thread(target=self._dispatch_loop, name='job-dispatcher', daemon=True)
+        thread.start()
+        self._wakeup.set()
+        print(f"Job queue started with {self.workers} worker(s): {self.db_path}")
+
+    def _connect(self):
+        # A connection to the queue's database, creating its table the first time
+        if self._has_table:
+            return _connect(self.db_path)
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = _connect(self.db_path)
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    progress REAL NOT NULL DEFAULT 0,
+                    message TEXT,
+                    payload TEXT NOT NULL,
+                    result TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    started_at REAL
+                )
+            ''')
+            if 'started_at' not in [row[1] for row in conn.execute('PRAGMA table_info(jobs)')]:
+                conn.execute('ALTER TABLE jobs ADD COLUMN started_at REAL')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)')
+            conn.commit()
+        except Exception:
+            conn.close()
+            raise
+        self._has_table = True
+        return conn
+
+    def submit(self, kind, payload):
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('INSERT INTO jobs (id, kind, status, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                         (job_id, kind, 'queued', json.dumps(payload), now, now))
+            conn.commit()
+        finally:
+            conn.close()
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT id, kind, status, progress, message, result, created_at, updated_at, started_at FROM jobs WHERE id=?',
+                               (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return {
+            'id': row[0],
+            'kind': row[1],
+            'status': row[2],
+            'progress': row[3],
+            'message': row[4],
+            'result': json.loads(row[5]) if row[5] else None,
+            'created_at': row[6],
+            'updated_at': row[7],
+            'started_at': row[8],
+            'eta_seconds': _eta(row[2], row[3], row[8])
+        }
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn rather than fork - forking a process that runs waitress threads can deadlock the child
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def _dispatch_loop(self):
+        while True:
+            self._wakeup.wait(timeout=5)
+            self._wakeup.clear()
+            try:
+                self._dispatch()
+            except Exception as e:
+                print(f"Error dispatching jobs: {e}")
+
+    def _dispatch(self):
+        with self._lock:
+            free = self.workers - self._running
+        if free <= 0:
+            return
+
+        conn = _connect(self.db_path)
+        try:
+            rows = conn.execute("SELECT id, kind, payload FROM jobs WHERE status='queued' ORDER BY created_at LIMIT ?", (free,)).fetchall()
+            for job_id, kind, payload in rows:
+                conn.execute("UPDATE jobs SET status='running', started_at=?, updated_at=? WHERE id=? AND status='queued'", (time.time(), time.time(), job_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+        for job_id, kind, payload in rows:
+            with self._lock:
+                self._running += 1
+            try:
+                future = self._get_executor().submit(run_job, self.db_path, job_id, kind, json.loads(payload))
+            except Exception as e:
+                self._finish(job_id, error=e)
+                continue
+            future.add_done_callback(lambda future, job_id=job_id: self._on_done(job_id, future))
+
+    def _on_done(self, job_id, future):
+        result = error = None
+        try:
+            result = future.result()
+        except BrokenProcessPool as e:
+            # A worker died (e.g. out of memory) - start a new pool for the next jobs
+            self._executor = None
+            error = e
+        except Exception as e:
+            error = e
+        self._finish(job_id, result=result, error=error)
+
+    def _finish(self, job_id, result=None, error=None):
+        with self._lock:
+            self._running -= 1
+        conn = _connect(self.db_path)
+        try:
+            if error is None:
+                conn.execute("UPDATE jobs SET status='done', progress=1, result=?, updated_at=? WHERE id=?",
+                             (json.dumps(result), time.time(), job_id))
+            else:
+                print(f"Job {job_id} failed: {error}")
+                traceback.print_exception(error)
+                conn.execute("UPDATE jobs SET status='failed', message=?, updated_at=? WHERE id=?",
+                             (str(error), time.time(), job_id))
+            conn.commit()
+        finally:
+            conn.close()
+        self._wakeup.set()
@@ -0,0 +1,187 @@
+"""
+Full-text search of a map's journals, markers and lines (/maps/<folder>/search) with SQLite FTS5.
+
+Triggers (migration 8 in database.py) queue every row that is written in search_pending, and
+index_pending() turns queued rows into documents of the search_index table: the title and the text
+of a journal, marker or line, with Quill's HTML stripped so only words are indexed. A search first
+indexes what is queued, so it always sees the latest writes. A database that was just migrated has
+all of its rows queued - those are indexed by the index_search background job, a batch per
+transaction, so neither searches nor writes wait for the whole map.
+"""
+
+import os
+import html
+import heapq
+from html.parser import HTMLParser
+from gogrow_app.database import get_db_connection, ensure_schema, schema_registry, SEARCH_COLUMNS
+
+SEARCH_INDEX_BATCH = 500  # queued rows indexed per transaction
+SEARCH_INLINE_LIMIT = 2000  # queued rows a search indexes itself, the rest is left to the index_search job
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+SNIPPET_TOKENS = 16
+TITLE_WEIGHT = 5.0  # a match in a title ranks higher than one in the text
+
+# snippet() and highlight() put these around matches, and they become <mark> once the text is escaped
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+# code of a document's rowid (see SEARCH_COLUMNS) -> table
+SEARCH_KINDS = {code: table for table, (code, _, _) in SEARCH_COLUMNS.items()}
+
+class TextExtractor(HTMLParser):
+    """Collects the text of an HTML fragment, leaving out tags, attributes and embedded images."""
+
+    # Tags that end a word even without white space around them, like Quill's paragraphs
+    BREAKS = {'p', 'br', 'div', 'li', 'ul', 'ol', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'pre', 'td', 'tr'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.BREAKS:
+            self.parts.append(' ')
+
+    def handle_endtag(self, tag):
+        if tag in self.BREAKS:
+            self.parts.append(' ')
+
+    def handle_data(self, data):
+        self.parts.append(data)
+
+def strip_html(text):
+    """The words of an HTML fragment (journal entries are Quill HTML, other text is escaped by bleach)."""
+    if not text:
+        return ''
+    if '<' not in text and '&' not in text:
+        return text
+    parser = TextExtractor()
+    parser.feed(text)
+    parser.close()
+    return ' '.join(''.join(parser.parts).split())
+
+def pending_count(conn):
+    return conn.execute('SELECT count(*) FROM search_pending').fetchone()[0]
+
+def index_pending(conn, limit=SEARCH_INDEX_BATCH):
+    """Indexes up to limit queued rows in one transaction. Returns how many rows are still queued."""
+    if conn.execute('SELECT EXISTS (SELECT 1 FROM search_pending)').fetchone()[0] == 0:
+        return 0
+    # The write lock is taken before the rows are read, so a write can't slip in between and be lost
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        docs = [row[0] for row in conn.execute('SELECT doc FROM search_pending LIMIT ?', (limit,))]
+        placeholders = ', '.join('?' * len(docs))
+        conn.execute(f'DELETE FROM search_index WHERE rowid IN ({placeholders})', docs)
+        rowids = {}
+        for doc in docs:
+            rowids.setdefault(doc % 4, []).append(doc // 4)
+        for code, kind_rowids in rowids.items():
+            table = SEARCH_KINDS[code]
+            _, title, body = SEARCH_COLUMNS[table]
+            # Rows that are gone (deleted) simply aren't indexed again
+            rows = conn.execute(f"SELECT rowid, id, {title}, {body} FROM {table} WHERE rowid IN ({', '.join('?' * len(kind_rowids))})",
+                                kind_rowids).fetchall()
+            conn.executemany('INSERT INTO search_index (rowid, kind, item_id, title, body) VALUES (?, ?, ?, ?, ?)',
+                             [(rowid * 4 + code, table, item_id, strip_html(title_text), strip_html(body_text))
+                              for rowid, item_id, title_text, body_text in rows])
+        conn.execute(f'DELETE FROM search_pending WHERE doc IN ({placeholders})', docs)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return pending_count(conn)
+
+def catch_up(conn, limit=SEARCH_INLINE_LIMIT):
+    """Indexes up to limit queued rows, a batch at a time. Returns how many rows are still queued."""
+    indexed = 0
+    pending = index_pending(conn)
+    while pending and indexed + SEARCH_INDEX_BATCH < limit:
+        indexed += SEARCH_INDEX_BATCH
+        pending = index_pending(conn)
+    return pending
+
+def needs_indexing(db_path):
+    """Whether the map database at db_path has rows to index, or hasn't been migrated to have an index yet."""
+    conn = get_db_connection(db_path)
+    try:
+        if conn.execute('PRAGMA user_version').fetchone()[0] < schema_registry.version:
+            return True
+        return conn.execute('SELECT EXISTS (SELECT 1 FROM search_pending)').fetchone()[0] == 1
+    finally:
+        conn.close()
+
+def match_query(text):
+    """
+    The FTS5 query for the words of text: every word must match, the last one as a prefix, so results
+    come up while a word is typed. Each word is quoted, so the query syntax can't be used to break it.
+    """
+    words = [word.replace('"', '""') for word in text.split()]
+    if not words:
+        raise ValueError("q must contain a word to search for")
+    return ' '.join([f'"{word}"' for word in words[:-1]] + [f'"{words[-1]}"*'])
+
+def marked(text):
+    """HTML-escapes a snippet and marks its matches with <mark>."""
+    return html.escape(text or '').replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+def search_database(conn, query, limit, offset):
+    """(total, hits) of an FTS5 query on one map database, best matches first."""
+    total = conn.execute('SELECT count(*) FROM search_index WHERE search_index MATCH ?', (query,)).fetchone()[0]
+    rows = conn.execute(f'''SELECT kind, item_id,
+                                   highlight(search_index, 2, '{MATCH_START}', '{MATCH_END}'),
+                                   snippet(search_index, 3, '{MATCH_START}', '{MATCH_END}', '…', {SNIPPET_TOKENS}),
+                                   bm25(search_index, 0, 0, {TITLE_WEIGHT}, 1.0) AS rank
+                            FROM search_index WHERE search_index MATCH ?
+                            ORDER BY rank LIMIT ? OFFSET ?''', (query, limit, offset)).fetchall()
+    # bm25() is lower for better matches - score turns it around
+    hits = [{'kind': kind, 'id': item_id, 'title': marked(title), 'snippet': marked(snippet), 'score': -rank}
+            for kind, item_id, title, snippet, rank in rows]
+    return total, hits
+
+def search(db_paths, text, limit=DEFAULT_SEARCH_LIMIT, offset=0):
+    """
+    Searches the map databases in db_paths ({folder: db_path}) for text. Hits of all maps are ranked
+    together. pending is the number of rows that weren't indexed yet, whose matches are missing.
+    """
+    query = match_query(text)
+    total = pending = 0
+    hits = []
+    for folder, db_path in db_paths.items():
+        ensure_schema(db_path)
+        conn = get_db_connection(db_path)
+        try:
+            pending += catch_up(conn)
+            if len(db_paths) == 1:
+                count, map_hits = search_database(conn, query, limit, offset)
+            else:
+                # Any of the first offset + limit hits of all maps can be one of this map's
+                count, map_hits = search_database(conn, query, offset + limit, 0)
+        finally:
+            conn.close()
+        total += count
+        hits.extend({'folder': folder, **hit} for hit in map_hits)
+    if len(db_paths) > 1:
+        hits = heapq.nlargest(offset + limit, hits, key=lambda hit: hit['score'])[offset:]
+    return {'total': total, 'hits': hits, 'pending': pending}
+
+def index_search(payload, report_progress):
+    """Job handler (see jobs.py) - indexes the queued rows of the map databases in payload['db_paths']."""
+    db_paths = payload['db_paths']
+    indexed = 0
+    for number, db_path in enumerate(db_paths):
+        if not os.path.exists(db_path):
+            continue
+        ensure_schema(db_path)
+        conn = get_db_connection(db_path)
+        try:
+            queued = pending = pending_count(conn)
+            while pending:
+                pending = index_pending(conn)
+                report_progress((number + 1 - pending / queued) / len(db_paths),
+                                f"{os.path.basename(db_path)}: {queued - pending} of {queued} rows indexed")
+            indexed += queued
+        finally:
+            conn.close()
+    return {'maps': len(db_paths), 'indexed': indexed}
@@ -7,12 +7,32 @@ def load_app_settings():
     config = configparser.ConfigParser()
     config.read(os.path.join(app.root_path, 'config.cfg'))
 
+    # GOGROW_DATA_DIR moves the maps, backups and generated caches out of the app directory
+    data_dir = os.environ.get('GOGROW_DATA_DIR') or app.root_path
+    app.config['IMG_DIR'] = os.path.join(data_dir, 'img')
+    app.config['BACKUP_DIR'] = os.path.join(data_dir, 'backups')
+
     app.secret_key = config.get('AppSettings', 'secret_key', fallback=secrets.token_hex(16))
     app.config['ICON_DIR'] = os.path.join(app.root_path, config.get('Directories', 'icon_dir', fallback='icons'))
-    app.config['THUMBNAIL_DIR'] = os.path.join(app.root_path, config.get('Directories', 'thumbnail_dir', fallback='thumbs'))
+    app.config['ICON_CACHE_DIR'] = os.path.join(data_dir, config.get('Directories', 'icon_cache_dir', fallback='icon_cache'))
+    app.config['THUMBNAIL_DIR'] = os.path.join(data_dir, config.get('Directories', 'thumbnail_dir', fallback='thumbs'))
     app.config['IMAGE_FOLDER'] = config.get('ImageSettings', 'image_folder', fallback='default_folder')
+    app.config['DERIVATIVE_CACHE_SIZE'] = config.getint('ImageSettings', 'derivative_cache_mb', fallback=512) * 1024 * 1024
+    app.config['ICONS_IN_MEMORY'] = config.getboolean('Icons', 'keep_in_memory', fallback=True)
+    app.config['ICON_POLL_SECONDS'] = config.getfloat('Icons', 'poll_seconds', fallback=5)
+    app.config['EVENT_MAX_WAITING'] = config.getint('Events', 'max_waiting', fallback=2)
+    app.config['EVENT_MAX_WAIT_SECONDS'] = config.getint('Events', 'max_wait_seconds', fallback=25)
+    app.config['EVENT_POLL_SECONDS'] = config.getfloat('Events', 'poll_seconds', fallback=1)
+    app.config['DB_MAX_CONNECTIONS'] = config.getint('Database', 'max_connections', fallback=64)
+    app.config['DB_MAX_IDLE_PER_DB'] = config.getint('Database', 'max_idle_per_db', fallback=4)
+    app.config['JOB_WORKERS'] = config.getint('Jobs', 'workers', fallback=2)
+    app.config['MAX_UPLOAD_SIZE'] = config.getint('Uploads', 'max_upload_mb', fallback=2048) * 1024 * 1024
+    app.config['BACKUP_WORKERS'] = config.getint('Backups', 'compression_workers', fallback=4)
+    app.config['CATALOG_POLL_SECONDS'] = config.getfloat('Catalog', 'poll_seconds', fallback=5)
 print("Settings.py importing configuration data from config.cfg...")
 load_app_settings()
 IMAGE_FOLDER = app.config['IMAGE_FOLDER']
 ICON_DIR = app.config['ICON_DIR']
-THUMBNAIL_DIR = app.config['THUMBNAIL_DIR']
\ No newline at end of file
+THUMBNAIL_DIR = app.config['THUMBNAIL_DIR']
+IMG_DIR = app.config['IMG_DIR']
+BACKUP_DIR = app.config['BACKUP_DIR']
\ No newline at end of file
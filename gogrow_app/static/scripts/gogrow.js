@@ -2,9 +2,20 @@
 var map = null; // Map object
 var icons = {}; // Object to store icons
 var iconDirectory = '/icons'; // Directory path for icons
+let iconBundle = {}; // Colored icons as data URIs, keyed by "iconType|iconColor" - loaded once per map
+const iconRequests = {}; // Icons missing from the bundle (e.g. a new color), requested once per pair
 var markerListBody = document.querySelector('#marker-list-body'); // DOM element for the marker list
 let markerInstances = []; // Array to store marker instances
 let lineInstances = []; // Array to store line instances
+let mapVersion = null; // Revision of the folder's markers and lines that is shown, see syncFeatures
+let syncFolder = null; // Folder whose changes are followed, see startSync
+let syncTimer = null;
+let syncRun = 0; // Bumped by startSync, so only the latest sync loop goes on
+const SYNC_INTERVAL_MS = 10000;
+const SYNC_WAIT_SECONDS = 25; // How long the server may hold a /changes request open for the next change
+const FEATURE_PAGE_SIZE = 1000; // Markers or lines per request when loading the part of the map in view
+let viewRequest = 0; // Bumped by every loadFeaturesInView, so only the latest one shows what it fetched
+const CLUSTER_BELOW_ZOOM = 0; // Zoomed out further than this, markers are shown as clusters
 
 // Function to set text color based on background color
 function setTextColorBasedOnBgColor(bgColor, element) {
@@ -132,17 +143,91 @@ map.on('moveend zoomend', function () {
     console.log('Map size recalculated after movement or zoom');
 });
 
-// Function to add an image overlay to the map
-function addImageOverlay(imageUrl) {
-    return new Promise((resolve) => {
-        if (imageOverlay) {
-            // If an image overlay already exists, remove it from the map
-            map.removeLayer(imageOverlay);
-
-            // Clear existing markers and lines from the map
-            clearExistingMarkers();
+// Tiles of a map image's pyramid (/tiles/<folder>/info), so only the part of the image in view is loaded,
+// at the resolution it is shown at. Pyramid level max_zoom is map zoom 0
+const MapTileLayer = L.GridLayer.extend({
+    createTile: function (coords, done) {
+        const pyramid = this.options.pyramid;
+        const size = pyramid.tile_size;
+        const level = coords.z + pyramid.max_zoom;
+        const scale = 2 ** (pyramid.max_zoom - level);
+        const levelHeight = pyramid.height / scale;
+        const columns = Math.ceil(pyramid.width / scale / size);
+        const rows = Math.ceil(levelHeight / size);
+
+        // Leaflet counts tile rows from the image's bottom edge (lat 0) and the pyramid from its top, so a
+        // map tile shows the bottom of one pyramid tile and the top of the next
+        const top = coords.y * size + levelHeight;
+        const row = Math.floor(top / size);
+        const offset = Math.round(top - row * size);
+
+        const tile = document.createElement('div');
+        tile.style.overflow = 'hidden';
+        const parts = [row, row + 1].filter(r => r >= 0 && r < rows && coords.x >= 0 && coords.x < columns);
+        let pending = parts.length;
+        if (!pending) {
+            // Leaflet expects done after createTile has returned
+            setTimeout(() => done(null, tile), 0);
         }
+        parts.forEach(r => {
+            const img = document.createElement('img');
+            img.alt = '';
+            img.style.position = 'absolute';
+            img.style.left = '0';
+            img.style.top = `${(r - row) * size - offset}px`;
+            img.style.width = `${size}px`;
+            img.style.height = `${size}px`;
+            img.onload = img.onerror = () => {
+                if (--pending === 0) {
+                    done(null, tile);
+                }
+            };
+            img.src = L.Util.template(pyramid.url, { z: level, x: coords.x, y: r });
+            tile.appendChild(img);
+        });
+        return tile;
+    }
+});
+
+// Function to fetch the tile pyramid of a folder's map image - null when it has none
+async function fetchTileInfo(folderName) {
+    try {
+        const response = await fetch(`/tiles/${folderName}/info`);
+        return response.ok ? await response.json() : null;
+    } catch (err) {
+        console.error('Error loading the map tiles:', err);
+        return null;
+    }
+}
 
+// Function to add the map image to the map - as tiles when the folder's image has a tile pyramid,
+// otherwise as one image overlay
+async function addImageOverlay(imageUrl, folderName) {
+    if (imageOverlay) {
+        // If an image overlay already exists, remove it from the map
+        map.removeLayer(imageOverlay);
+        imageOverlay = null;
+
+        // Clear existing markers and lines from the map
+        clearExistingMarkers();
+    }
+
+    const pyramid = folderName ? await fetchTileInfo(folderName) : null;
+    if (pyramid) {
+        imageOverlay = new MapTileLayer({
+            pyramid: pyramid,
+            tileSize: pyramid.tile_size,
+            bounds: [[0, 0], [pyramid.height, pyramid.width]],
+            minZoom: map.getMinZoom(),
+            minNativeZoom: -pyramid.max_zoom,
+            maxNativeZoom: 0,
+            noWrap: true
+        }).addTo(map);
+        map.setView([pyramid.height / 2, pyramid.width / 2], -2);
+        return;
+    }
+
+    return new Promise((resolve) => {
         // Create an image element to getthe dimensions
         const img = new Image();
         img.src = imageUrl;
@@ -194,6 +279,9 @@ function clearExistingMarkers() {
     lineInstances = [];
     console.log('lineInstances cleared');
 
+    // Remove the marker clusters
+    clusterLayer.clearLayers();
+
     // Clear the marker list table
     while (markerListBody.firstChild) {
         markerListBody.removeChild(markerListBody.firstChild);
@@ -201,58 +289,285 @@ function clearExistingMarkers() {
 
 }
 
-// Function to load markers and lines from a folder
-async function loadFeatures(folderName) {
+// Function to fetch a folder's image URL, version and journals in one request - the markers and lines
+// are loaded for the part of the map in view instead (see loadFeaturesInView)
+async function fetchMapBundle(folderName) {
+    const response = await fetch(`/maps/${folderName}/bundle?features=false`);
+    if (!response.ok) {
+        throw new Error(`Error loading map ${folderName}: ${response.status}`);
+    }
+    return response.json();
+}
+
+// Function to get the map's visible area as the bbox parameter of /markers and /lines (south,west,north,east)
+function viewBbox() {
+    const bounds = map.getBounds();
+    return [bounds.getSouth(), bounds.getWest(), bounds.getNorth(), bounds.getEast()].join(',');
+}
+
+// Function to fetch every marker or line (kind) of a folder in a bbox, a page at a time
+async function fetchFeaturesInBbox(kind, folderName, bbox) {
+    const features = [];
+    let cursor = null;
+    do {
+        const url = `/${kind}/${folderName}?bbox=${bbox}&limit=${FEATURE_PAGE_SIZE}` + (cursor ? `&cursor=${cursor}` : '');
+        const response = await fetch(url);
+        if (!response.ok) {
+            throw new Error(`Error loading ${kind} of ${folderName}: ${response.status}`);
+        }
+        features.push(...await response.json());
+        // Sent when there are more features after this page
+        cursor = response.headers.get('X-Next-Cursor');
+    } while (cursor);
+    return features;
+}
+
+// Clusters of the markers in view, shown instead of the markers themselves when zoomed out
+const clusterLayer = L.layerGroup();
+
+// Function to fetch the marker clusters of a folder in a bbox, for the map's zoom
+async function fetchClustersInBbox(folderName, bbox) {
+    const response = await fetch(`/markers/${folderName}/clusters?zoom=${map.getZoom()}&bbox=${bbox}`);
+    if (!response.ok) {
+        throw new Error(`Error loading marker clusters of ${folderName}: ${response.status}`);
+    }
+    return response.json();
+}
+
+// Function to create the map marker of a cluster - clicking it zooms in to the cluster's markers
+function createCluster(cluster) {
+    const size = cluster.count < 10 ? 30 : cluster.count < 100 ? 36 : 44;
+    const marker = L.marker([cluster.lat, cluster.lng], {
+        icon: L.divIcon({ className: 'marker-cluster', html: `${cluster.count}`, iconSize: [size, size] }),
+        title: `${cluster.count} markers`,
+        opacity: document.getElementById('toggle-markers-btn').dataset.visible === 'false' ? 0 : 1
+    });
+    marker.on('click', () => {
+        const [south, west, north, east] = cluster.bounds;
+        if (south === north && west === east) {
+            map.setView([cluster.lat, cluster.lng], Math.max(map.getZoom() + 1, CLUSTER_BELOW_ZOOM));
+        } else {
+            map.fitBounds([[south, west], [north, east]]);
+        }
+    });
+    return marker;
+}
+
+// Function to switch between showing the markers and their clusters
+function showClusters(clustered) {
+    if (clustered === map.hasLayer(clusterLayer)) {
+        return;
+    }
+    if (clustered) {
+        Object.values(markerInstances).forEach(marker => map.removeLayer(marker));
+        clusterLayer.addTo(map);
+    } else {
+        map.removeLayer(clusterLayer);
+        clusterLayer.clearLayers();
+        Object.values(markerInstances).forEach(marker => marker.addTo(map));
+    }
+}
+
+// Function to show the markers and lines in the part of the map that is in view. Features shown
+// already stay, so panning back doesn't fetch them again. Zoomed out, the markers are shown as clusters
+async function loadFeaturesInView(folderName) {
+    const request = ++viewRequest;
+    const clustered = map.getZoom() < CLUSTER_BELOW_ZOOM;
+    showClusters(clustered);
+    try {
+        const bbox = viewBbox();
+        const [markers, lines, clusters] = await Promise.all([
+            clustered ? [] : fetchFeaturesInBbox('markers', folderName, bbox),
+            fetchFeaturesInBbox('lines', folderName, bbox),
+            clustered ? fetchClustersInBbox(folderName, bbox) : []
+        ]);
+        if (request !== viewRequest || syncFolder !== folderName) {
+            return;
+        }
+        markers.filter(marker => !markerInstances[marker.markerId]).forEach(createMarker);
+        lines.filter(line => !lineInstances[line.lineId]).forEach(createLine);
+        if (clustered) {
+            clusterLayer.clearLayers();
+            clusters.forEach(cluster => clusterLayer.addLayer(createCluster(cluster)));
+        }
+    } catch (err) {
+        console.error('Error loading the markers and lines in view:', err);
+    }
+}
+
+// Load what comes into view as the map is panned and zoomed
+map.on('moveend', function () {
+    if (syncFolder) {
+        loadFeaturesInView(syncFolder);
+    }
+});
+
+// Function to remove a marker or line from the map and the marker list, without deleting it on the server
+function removeFeature(instances, featureId) {
+    const instance = instances[featureId];
+    if (!instance) {
+        return;
+    }
+    map.removeLayer(instance);
+    delete instances[featureId];
+    const rows = Array.from(markerListBody.querySelectorAll('tr'));
+    const row = rows.find(r => r.querySelector('td:first-child').dataset.fullUuid == featureId);
+    if (row) {
+        markerListBody.removeChild(row);
+    }
+}
+
+// Function to apply one change of a marker or line made elsewhere (op is insert, update or delete)
+function applyFeatureChange(kind, op, item) {
+    if (kind === 'markers') {
+        removeFeature(markerInstances, op === 'delete' ? item : item.markerId);
+        if (op !== 'delete') {
+            createMarker(item);
+        }
+    } else if (kind === 'lines') {
+        removeFeature(lineInstances, op === 'delete' ? item : item.lineId);
+        if (op !== 'delete') {
+            createLine(item);
+        }
+    }
+}
+
+// Function to apply the changes made to a folder's markers and lines since the version that is shown
+// (e.g. in another tab or on another device). With wait the server answers once something changed, or
+// after wait seconds. Returns how many milliseconds to wait before asking again
+async function syncFeatures(folderName, wait = 0) {
+    if (mapVersion === null || syncFolder !== folderName || document.hidden) {
+        return SYNC_INTERVAL_MS;
+    }
+    const since = mapVersion;
+    try {
+        const response = await fetch(`/maps/${folderName}/changes?since=${since}&wait=${wait}`);
+        if (!response.ok) {
+            return SYNC_INTERVAL_MS;
+        }
+        const changes = await response.json();
+        if (syncFolder !== folderName || mapVersion !== since) {
+            // The folder was switched or reloaded while the request waited
+            return 0;
+        }
+        if (changes.reset) {
+            // The database was replaced, so the changes can't be applied on top of what is shown
+            await loadFeatures(folderName);
+            return SYNC_INTERVAL_MS;
+        }
+        changes.deleted.markers.forEach(markerId => applyFeatureChange('markers', 'delete', markerId));
+        changes.deleted.lines.forEach(lineId => applyFeatureChange('lines', 'delete', lineId));
+        changes.markers.forEach(marker => applyFeatureChange('markers', 'update', marker));
+        changes.lines.forEach(line => applyFeatureChange('lines', 'update', line));
+        mapVersion = changes.version;
+        if (map.hasLayer(clusterLayer) && (changes.markers.length || changes.deleted.markers.length)) {
+            // The clusters in view were counted before these changes
+            loadFeaturesInView(folderName);
+        }
+        if (changes.more) {
+            return syncFeatures(folderName);
+        }
+        // Sent when the server has enough requests waiting already
+        const retryAfter = parseInt(response.headers.get('Retry-After'), 10);
+        return retryAfter > 0 ? retryAfter * 1000 : 0;
+    } catch (err) {
+        console.error('Error syncing map changes:', err);
+        return SYNC_INTERVAL_MS;
+    }
+}
+
+// Function to follow a folder's changes with long-polled /changes requests: each one comes back as soon
+// as something changed, and the next one is sent straight away
+function startSync(folderName, version) {
+    mapVersion = version;
+    syncFolder = folderName;
+    clearTimeout(syncTimer);
+    syncTimer = null;
+    const run = ++syncRun;
+    const poll = async () => {
+        const delay = await syncFeatures(folderName, SYNC_WAIT_SECONDS);
+        if (run === syncRun) {
+            syncTimer = setTimeout(poll, delay);
+        }
+    };
+    poll();
+}
+
+// Function to load the markers and lines of a folder in view (the map bundle gives the version to follow
+// changes from, and can be one that was already fetched)
+async function loadFeatures(folderName, bundle) {
     if (!folderName) {
         console.warn('loadFeatures called without a folder name');
         return;
     }
 
-    // Clear existing markers and lines from the map
+    // Clear existing markers and lines from the map, and stop following the folder until they are loaded again
     clearExistingMarkers();
+    syncFolder = null;
 
     try {
-        // Fetch markers
-        const markerResponse = await fetch(`/markers/${folderName}`);
-        const markers = await markerResponse.json();
-        for (const marker of markers) {
-            createMarker(marker);
-        }
+        // Fetch the map's version, and the colored icons its markers use alongside
+        const [mapBundle] = await Promise.all([bundle || fetchMapBundle(folderName), loadIconBundle(folderName)]);
 
-        // Fetch lines
-        const lineResponse = await fetch(`/lines/${folderName}`);
-        const lines = await lineResponse.json();
-        // Create lines and add them to the map
-        for (const line of lines) {
-            createLine(line);
-        }
+        // From here on changes are fetched as they are made - anything changed while the features in
+        // view load is applied again, which leaves it as it is
+        startSync(folderName, mapBundle.version);
+        await loadFeaturesInView(folderName);
     } catch (error) {
         console.error('Error fetching markers and lines:', error);
     }
 }
 
+// Function to load the colored icons used by a folder's markers
+async function loadIconBundle(folderName) {
+    try {
+        const response = await fetch(`/markers/${folderName}/icons`);
+        if (response.ok) {
+            iconBundle = await response.json();
+        }
+    } catch (err) {
+        console.error('Error loading icons:', err);
+    }
+}
+
+// Function to get the data URI of an icon in a color, from the bundle or else from the server
+function getIconSrc(iconType, iconColor) {
+    const key = `${iconType}|${iconColor.trim().toLowerCase()}`;
+    if (iconBundle[key]) {
+        return Promise.resolve(iconBundle[key]);
+    }
+    if (!iconRequests[key]) {
+        iconRequests[key] = fetch(`/icons/bundle?icons=${encodeURIComponent(`${iconType}:${iconColor}`)}`)
+            .then(res => res.json())
+            .then(bundle => {
+                Object.assign(iconBundle, bundle);
+                return bundle[key];
+            });
+    }
+    return iconRequests[key];
+}
+
 // Custom Icon class extending L.Icon
 class SvgIcon extends L.Icon {
     constructor(options) {
         super(options);
         this._iconUrl = options.iconUrl;
+        this._iconType = options.iconUrl.split('/').pop();
         this._iconColor = options.iconColor || '#000000'; // Default color is black
     }
 
-    // Override the createIcon method to load SVG icon dynamically
+    // Override the createIcon method to use the icon colored by the server
     createIcon(oldIcon) {
         const icon = (oldIcon && oldIcon.tagName === 'IMG') ? oldIcon : document.createElement('img');
         this._setIconStyles(icon, 'icon');
 
-        // Fetch the SVG icon file
-        fetch(`${'.' + this._iconUrl}`)
-            .then(res => res.text())
-            .then(data => {
-                const parser = new DOMParser();
-                const svg = parser.parseFromString(data, "image/svg+xml");
-                svg.documentElement.style.fill = this._iconColor;
-                icon.src = 'data:image/svg+xml;base64,' + btoa(svg.documentElement.outerHTML);
-            });
+        getIconSrc(this._iconType, this._iconColor)
+            .then(src => {
+                if (src) {
+                    icon.src = src;
+                }
+            })
+            .catch(err => console.error('Error loading icon:', err));
         return icon;
     }
 }
@@ -260,11 +575,12 @@ class SvgIcon extends L.Icon {
 // Function to load folders from the server
 async function loadFolders() {
     try {
-        const response = await fetch('/get_folders');
+        // The catalog lists every map, and all of their thumbnails come in one contact sheet image
+        const response = await fetch('/maps');
         if (response.ok) {
             console.log("Folders Loaded")
-            const folderList = await response.json();
-            displayFolders(folderList);
+            const data = await response.json();
+            displayFolders(data.maps, data.contact_sheet);
         }
     } catch (err) {
         console.error('Error loading folders:', err);
@@ -272,10 +588,13 @@ async function loadFolders() {
 }
 
 // Function to display the folder list on the page
-function displayFolders(folderList) {
+function displayFolders(mapList, contactSheet) {
+    // Thumbnails are 60px squares cut out of the contact sheet, whose cells are cell_size pixels
+    const scale = 60 / contactSheet.cell_size;
     const folderListElement = document.getElementById('folder-list');
     folderListElement.innerHTML = '';
-    folderList.forEach(folder => {
+    mapList.forEach(map => {
+        const folder = map.folder;
         const listItem = document.createElement('li');
         const button = document.createElement('button');
         button.textContent = folder;
@@ -288,10 +607,20 @@ function displayFolders(folderList) {
             button.classList.add('selected-folder');
         });
 
-        // Create the image element for the thumbnail
-        const thumbnail = document.createElement('img');
-        thumbnail.src = `/img/${folder}/thumbnail-${folder}.png`;
-        thumbnail.alt = `${folder} thumbnail`;
+        // Create the element for the thumbnail, showing the map's cell of the contact sheet
+        const thumbnail = document.createElement('span');
+        if (map.sheet_offset) {
+            const [x, y] = map.sheet_offset;
+            thumbnail.style.backgroundImage = `url("${contactSheet.image_url}")`;
+            thumbnail.style.backgroundSize = `${contactSheet.width * scale}px ${contactSheet.height * scale}px`;
+            thumbnail.style.backgroundPosition = `-${x * scale}px -${y * scale}px`;
+            thumbnail.style.backgroundOrigin = 'content-box';
+            thumbnail.style.backgroundClip = 'content-box';
+            thumbnail.style.backgroundRepeat = 'no-repeat';
+        }
+        thumbnail.setAttribute('role', 'img');
+        thumbnail.setAttribute('aria-label', `${folder} thumbnail`);
+        thumbnail.title = `${map.markers} markers, ${map.lines} lines, ${map.journals} journal entries`;
         thumbnail.style.width = '60px'; // Set width for the thumbnail
         thumbnail.style.height = '60px'; // Set height for the thumbnail
         thumbnail.style.padding = '10px'; // Set padding for the thumbnail
@@ -313,16 +642,16 @@ function displayFolders(folderList) {
 // Function to load image and database for a selected folder
 async function loadImageAndDatabase(folderName) {
     try {
-        const response = await fetch(`/get_image_url/${folderName}`);
-        if (response.ok) {
-            const imageUrl = await response.text();
-
+        const bundle = await fetchMapBundle(folderName);
+        if (bundle.image_url) {
             // Clear existing markers and reset the markerCounter before loading new markers
             clearExistingMarkers();
+            syncFolder = null;
             markerCounter = 1;
 
-            // Load the image overlay and features (markers and lines)
-            await Promise.all([addImageOverlay(imageUrl), loadFeatures(folderName)]);
+            // Load the image overlay, then the features (markers and lines) in view
+            await addImageOverlay(bundle.image_url, folderName);
+            await loadFeatures(folderName, bundle);
 
             // Set the selected folder name in the HTML element
             document.getElementById('selected-folder-name').textContent = folderName;
@@ -447,8 +776,10 @@ function createMarker(newMarkerData) {
     // Add the marker instance to the markerInstances object
     markerInstances[marker.options.uuid] = marker;
 
-    // Add the marker to the map
-    marker.addTo(map);
+    // Add the marker to the map, unless the map is zoomed out to clusters
+    if (!map.hasLayer(clusterLayer)) {
+        marker.addTo(map);
+    }
 
     console.log(`Placing marker with UUID: ${newMarkerData.markerId}" - marker icon: ${iconDirectory}/${newMarkerData.iconType}`);
 
@@ -674,7 +1005,7 @@ function toggleMarkers() {
     const toggleButton = document.getElementById('toggle-markers-btn');
     const isVisible = toggleButton.dataset.visible === 'true';
 
-    Object.values(markerInstances).forEach(function (marker) {
+    Object.values(markerInstances).concat(clusterLayer.getLayers()).forEach(function (marker) {
         if (isVisible) {
             marker.setOpacity(0);
         } else {
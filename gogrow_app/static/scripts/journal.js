@@ -13,14 +13,15 @@ document.addEventListener('DOMContentLoaded', function () {
             const icon = (oldIcon && oldIcon.tagName === 'IMG') ? oldIcon : document.createElement('img');
             this._setIconStyles(icon, 'icon');
 
-            // Fetch the SVG icon file and modify its fill color
-            fetch(`${'.' + this._iconUrl}`)
-                .then(res => res.text())
-                .then(data => {
-                    const parser = new DOMParser();
-                    const svg = parser.parseFromString(data, "image/svg+xml");
-                    svg.documentElement.style.fill = this._iconColor;
-                    icon.src = 'data:image/svg+xml;base64,' + btoa(svg.documentElement.outerHTML);
+            // Fetch the icon with its fill color already applied by the server
+            const iconType = this._iconUrl.split('/').pop();
+            const key = `${iconType}|${this._iconColor.trim().toLowerCase()}`;
+            fetch(`/icons/bundle?icons=${encodeURIComponent(`${iconType}:${this._iconColor}`)}`)
+                .then(res => res.json())
+                .then(bundle => {
+                    if (bundle[key]) {
+                        icon.src = bundle[key];
+                    }
                 });
 
             return icon;
@@ -268,6 +269,19 @@ document.addEventListener('DOMContentLoaded', function () {
     }
 
     let allJournalEntries = [];
+    let nextJournalCursor = null; // where the next page of the list starts, null when every entry is loaded
+    const JOURNAL_PAGE_SIZE = 50;
+
+    // The list is loaded a page at a time, favorites first and then the newest, as summaries
+    // (title, date, excerpt) - a journal's content is only fetched when it is selected
+    async function fetchJournalPage(folderName, cursor) {
+        const params = new URLSearchParams({ sort: 'favorites', limit: JOURNAL_PAGE_SIZE });
+        if (cursor) {
+            params.set('cursor', cursor);
+        }
+        const response = await fetch(`/journals/${folderName}?${params}`);
+        return response.json();
+    }
 
     async function loadJournalEntries(folderName) {
         if (!folderName) {
@@ -276,31 +290,24 @@ document.addEventListener('DOMContentLoaded', function () {
         }
 
         try {
-            // Fetch journal entries for the specified folder
-            const response = await fetch(`/journals/${folderName}`);
-            const journalData = await response.json();
-
-            const list = document.getElementById('journal-entry-list');
-            list.innerHTML = ''; // Clear the list
-
-            // Create list items for each journal entry
-            for (const journal of journalData) {
-                console.log(journal);
-                const listItem = document.createElement('li');
-                listItem.textContent = `${journal.entry_date}: ${journal.entry_title}`;
-                listItem.dataset.id = journal.id; // Store the journal entry id on the list item
-                list.appendChild(listItem);
-            }
-
-            allJournalEntries = journalData;
+            const page = await fetchJournalPage(folderName, null);
+            allJournalEntries = page.journals;
+            nextJournalCursor = page.next_cursor;
             displayJournalEntries(allJournalEntries);
+        } catch (error) {
+            console.error('Error fetching journal entries:', error);
+        }
+    }
 
-            // Attach click event listeners to the list items
-            const listItems = list.querySelectorAll('li');
-            for (const listItem of listItems) {
-                listItem.addEventListener('click', selectJournalEntry);
-            }
-
+    async function loadMoreJournalEntries() {
+        if (!nextJournalCursor) {
+            return;
+        }
+        try {
+            const page = await fetchJournalPage(currentFolder, nextJournalCursor);
+            allJournalEntries = allJournalEntries.concat(page.journals);
+            nextJournalCursor = page.next_cursor;
+            displayJournalEntries(allJournalEntries);
         } catch (error) {
             console.error('Error fetching journal entries:', error);
         }
@@ -372,6 +379,15 @@ document.addEventListener('DOMContentLoaded', function () {
         for (const listItem of listItems) {
             listItem.addEventListener('click', selectJournalEntry);
         }
+
+        // The rest of the entries are loaded on request
+        if (journalEntries === allJournalEntries && nextJournalCursor) {
+            const moreItem = document.createElement('li');
+            moreItem.textContent = 'Load more entries...';
+            moreItem.classList.add('load-more');
+            moreItem.addEventListener('click', loadMoreJournalEntries);
+            list.appendChild(moreItem);
+        }
     }
 
     // Delete journal entry button click event listener
@@ -405,7 +421,8 @@ document.addEventListener('DOMContentLoaded', function () {
         const thumbnailContainer = document.getElementById('thumbnail-container');
         thumbnailContainer.innerHTML = ''; // Clear the current thumbnail
         const thumbnail = document.createElement('img');
-        thumbnail.src = `/img/${currentFolder}/thumbnail-${currentFolder}.png`;
+        // ask for a 2x size copy in whatever format the browser handles best (WebP/AVIF) instead of the PNG
+        thumbnail.src = `/img/${currentFolder}/thumbnail-${currentFolder}.png?w=200`;
         thumbnail.alt = `${currentFolder} thumbnail`;
         thumbnail.style.width = '99px';
         thumbnail.style.height = '99px';
@@ -483,9 +500,9 @@ document.addEventListener('DOMContentLoaded', function () {
                 );
                 break;
             case 'Contents':
-                filteredEntries = allJournalEntries.filter(entry =>
-                    entry.entry_content.toLowerCase().includes(searchTerm)
-                );
+                // The list only has excerpts - the server's full-text search looks through the whole entries
+                const matchingIds = await searchJournalContents(searchTerm);
+                filteredEntries = allJournalEntries.filter(entry => matchingIds.has(entry.id));
                 break;
             case 'Dates':
                 filteredEntries = allJournalEntries.filter(entry =>
@@ -493,11 +510,11 @@ document.addEventListener('DOMContentLoaded', function () {
                 );
                 break;
             case 'Linked Item Notes':
-                const itemsNotes = await fetchAllItemsNotes();
+                const itemsNotes = await linkedItemsText('markerNotes', 'notes');
                 filteredEntries = filterByLinkedItems(searchTerm, itemsNotes);
                 break;
             case 'Linked Item Descriptions':
-                const itemsDescriptions = await fetchAllItemsDescriptions();
+                const itemsDescriptions = await linkedItemsText('info', 'info');
                 filteredEntries = filterByLinkedItems(searchTerm, itemsDescriptions);
                 break;
             default:
@@ -507,37 +524,41 @@ document.addEventListener('DOMContentLoaded', function () {
         displayJournalEntries(filteredEntries);
     });
 
-    async function fetchAllItemsNotes() {
-        const markersResponse = await fetch(`/markers/${currentFolder}`);
-        const markersData = await markersResponse.json();
-        const linesResponse = await fetch(`/lines/${currentFolder}`);
-        const linesData = await linesResponse.json();
-
-        const items = new Map();
-        for (const marker of markersData) {
-            items.set(`Marker:${marker.markerId}`, marker.markerNotes.toLowerCase());
+    async function searchJournalContents(searchTerm) {
+        const ids = new Set();
+        if (!searchTerm.trim()) {
+            allJournalEntries.forEach(entry => ids.add(entry.id));
+            return ids;
         }
-        for (const line of linesData) {
-            items.set(`Line:${line.lineId}`, line.notes.toLowerCase());
+        const params = new URLSearchParams({ q: searchTerm, limit: 100 });
+        const response = await fetch(`/maps/${currentFolder}/search?${params}`);
+        const result = await response.json();
+        for (const hit of result.hits || []) {
+            if (hit.kind === 'journals') {
+                ids.add(hit.id);
+            }
         }
-
-        return items;
+        return ids;
     }
 
-    async function fetchAllItemsDescriptions() {
-        const markersResponse = await fetch(`/markers/${currentFolder}`);
-        const markersData = await markersResponse.json();
-        const linesResponse = await fetch(`/lines/${currentFolder}`);
-        const linesData = await linesResponse.json();
+    // The markers and lines the loaded entries link to, looked up together (at most 1000 per request)
+    async function linkedItemsText(markerField, lineField) {
+        const linkedIds = new Set();
+        for (const entry of allJournalEntries) {
+            (entry.linked_item_id || '').split(',').filter(id => id).forEach(id => linkedIds.add(id));
+        }
 
         const items = new Map();
-        for (const marker of markersData) {
-            items.set(`Marker:${marker.markerId}`, marker.info.toLowerCase());
-        }
-        for (const line of linesData) {
-            items.set(`Line:${line.lineId}`, line.info.toLowerCase());
+        const ids = [...linkedIds];
+        for (let start = 0; start < ids.length; start += 1000) {
+            const params = new URLSearchParams({ ids: ids.slice(start, start + 1000).join(',') });
+            const response = await fetch(`/maps/${currentFolder}/items?${params}`);
+            const result = await response.json();
+            for (const [id, item] of Object.entries(result.items || {})) {
+                const field = id.startsWith('Marker:') ? markerField : lineField;
+                items.set(id, (item[field] || '').toLowerCase());
+            }
         }
-
         return items;
     }
 
@@ -609,27 +630,19 @@ document.addEventListener('DOMContentLoaded', function () {
             const linkedItemsContainer = document.getElementById('linked-items-container');
             linkedItemsContainer.innerHTML = ''; // Clear the container
 
-            // Split the string into an array
-            const linkedItems = journalData.linked_item_id.split(',');
-
-            // Loop over the array and fetch details for each item
-            for (const itemId of linkedItems) {
-                // Skip this iteration of the loop if itemId is an empty string
-                if (itemId === '') {
-                    continue;
-                }
-
-                const [itemType, uuid] = itemId.split(':');
+            // The linked markers and lines come with the journal entry (looked up together on the server)
+            for (const linkedItem of journalData.linked_items || []) {
+                const itemId = linkedItem.id;
+                const itemType = linkedItem.type;
+                const uuid = itemId.substring(itemType.length + 1);
+                // A marker or line deleted since it was linked has no details
+                itemDetails = linkedItem.item || {};
                 let itemColor;
                 let itemNotes;
                 if (itemType === 'Marker') {
-                    const markerResponse = await fetch(`/markers/${currentFolder}/${uuid}`);
-                    itemDetails = await markerResponse.json();
                     itemColor = itemDetails.iconColor;
                     itemNotes = itemDetails.markerNotes;
                 } else if (itemType === 'Line') {
-                    const lineResponse = await fetch(`/lines/${currentFolder}/${uuid}`);
-                    itemDetails = await lineResponse.json();
                     itemColor = itemDetails.color;
                     itemNotes = itemDetails.notes;
                 }
@@ -282,6 +282,16 @@ async function fetchBackups() {
     }
 }
 
+function formatBytes(bytes) {
+    const units = ['B', 'KB', 'MB', 'GB', 'TB'];
+    let unit = 0;
+    while (bytes >= 1024 && unit < units.length - 1) {
+        bytes /= 1024;
+        unit++;
+    }
+    return `${bytes.toFixed(unit === 0 ? 0 : 1)} ${units[unit]}`;
+}
+
 // Function to populate the backup dropdown
 function populateBackupDropdown(backupFiles) {
     const select = document.getElementById('backup-select');
@@ -290,11 +300,11 @@ function populateBackupDropdown(backupFiles) {
         // Clear the dropdown
         select.innerHTML = "";
 
-        // Create and append an option for each backup file
-        backupFiles.forEach(file => {
+        // Create and append an option for each backup, newest first
+        backupFiles.forEach(backup => {
             const option = document.createElement('option');
-            option.value = file;
-            option.textContent = file;
+            option.value = backup.name;
+            option.textContent = `${backup.name} (${formatBytes(backup.size)})`;
             select.appendChild(option);
         });
     }
@@ -329,7 +339,20 @@ if (restoreBtn) {
         const data = await response.json();
 
         if (response.ok) {
-            flashMessage(`Backup "${selectedBackup}" restored successfully!`, 'success');
+            // The restore runs in the background - follow its progress
+            restoreBtn.disabled = true;
+            try {
+                const job = await waitForRestore(data.status_url);
+                if (job.status === 'done') {
+                    flashMessage(`Backup "${selectedBackup}" restored successfully!`, 'success');
+                } else {
+                    flashMessage(job.message || 'Error restoring backup.', 'error');
+                    console.error('Error restoring backup:', job.message);
+                }
+            } finally {
+                restoreBtn.disabled = false;
+                restoreBtn.textContent = 'Restore';
+            }
         } else if (response.status === 409) {
             console.error('Error restoring backup:', data.message);
             flashMessage(data.message, 'error');
@@ -340,6 +363,20 @@ if (restoreBtn) {
     });
 }
 
+// Polls a restore job until it is done or failed, showing its progress on the restore button
+async function waitForRestore(statusUrl) {
+    while (true) {
+        const response = await fetch(statusUrl);
+        const job = await response.json();
+        if (!response.ok || job.status === 'done' || job.status === 'failed') {
+            return response.ok ? job : { status: 'failed', message: job.error };
+        }
+        const eta = job.eta_seconds !== null ? `, ${Math.ceil(job.eta_seconds)}s left` : '';
+        restoreBtn.textContent = `Restoring ${Math.floor(job.progress * 100)}%${eta}`;
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+}
+
 // Fetch the available directories and backups on page load
 fetchDirectories();
 fetchBackups();
\ No newline at end of file
@@ -0,0 +1,146 @@
+"""
+Deep-zoom tile pyramids for map images, so the browser only loads the part of a large image it shows.
+
+Tiles live in img/<folder>/tiles/<z>/<x>/<y>.jpg (or .png for tiles with transparency), or next to the
+image's blob when it is in the content-addressed store (see blobs.py) so maps share them. Level max_zoom is
+the image at full resolution and every level below it halves the size, down to level 0 where the whole
+image fits in one tile. x counts columns from the left and y rows from the top of the image.
+Levels are cut the first time one of their tiles is requested and reused until the map image changes.
+"""
+
+import os
+import json
+import math
+import shutil
+import threading
+from PIL import Image
+
+TILE_SIZE = 256
+TILE_DIR_NAME = 'tiles'
+MANIFEST_NAME = 'manifest.json'
+JPEG_QUALITY = 85
+
+_locks = {}
+_locks_lock = threading.Lock()
+_known_sources = {}  # tiles_dir -> fingerprint of the image its tiles were cut from
+_info_cache = {}  # source_path -> (fingerprint, pyramid info)
+
+def _lock_for(key):
+    with _locks_lock:
+        return _locks.setdefault(key, threading.Lock())
+
+def _fingerprint(source_path):
+    st = os.stat(source_path)
+    # The inode rather than the file name, so every hard link to a stored blob matches the same tiles
+    return {'inode': st.st_ino, 'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+def pyramid_info(source_path):
+    fingerprint = _fingerprint(source_path)
+    cached = _info_cache.get(source_path)
+    if cached and cached[0] == fingerprint:
+        return cached[1]
+
+    with Image.open(source_path) as img:
+        width, height = img.size
+    max_zoom = math.ceil(math.log2(max(width, height) / TILE_SIZE)) if max(width, height) > TILE_SIZE else 0
+    info = {
+        'width': width,
+        'height': height,
+        'tile_size': TILE_SIZE,
+        'min_zoom': 0,
+        'max_zoom': max_zoom,
+        'version': f"{fingerprint['size']:x}-{fingerprint['mtime']:x}"
+    }
+    _info_cache[source_path] = (fingerprint, info)
+    return info
+
+def _level_size(info, z):
+    factor = 2 ** (info['max_zoom'] - z)
+    return math.ceil(info['width'] / factor), math.ceil(info['height'] / factor)
+
+def _existing_tile(tiles_dir, z, x, y):
+    for extension in ('.jpg', '.png'):
+        path = os.path.join(tiles_dir, str(z), str(x), f'{y}{extension}')
+        if os.path.exists(path):
+            return path
+    return None
+
+def _ensure_current(tiles_dir, source_path):
+    # Throw the tiles away when they were cut from another (or an older version of the) map image
+    fingerprint = _fingerprint(source_path)
+    if _known_sources.get(tiles_dir) == fingerprint:
+        return
+    with _lock_for(tiles_dir):
+        manifest_path = os.path.join(tiles_dir, MANIFEST_NAME)
+        try:
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            manifest = None
+
+        if manifest != fingerprint:
+            shutil.rmtree(tiles_dir, ignore_errors=True)
+            os.makedirs(tiles_dir)
+            with open(manifest_path, 'w') as manifest_file:
+                json.dump(fingerprint, manifest_file)
+            print(f"Tile cache reset for {source_path}")
+        _known_sources[tiles_dir] = fingerprint
+
+def _build_level(tiles_dir, source_path, info, z):
+    level_width, level_height = _level_size(info, z)
+    with Image.open(source_path) as img:
+        # JPEG sources can be decoded straight at a reduced scale, which is much faster for the low levels
+        img.draft('RGB', (level_width, level_height))
+        has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+        level = img.convert('RGBA' if has_alpha else 'RGB')
+    if level.size != (level_width, level_height):
+        level = level.resize((level_width, level_height), Image.LANCZOS)
+
+    columns = math.ceil(level_width / TILE_SIZE)
+    rows = math.ceil(level_height / TILE_SIZE)
+    for x in range(columns):
+        column_dir = os.path.join(tiles_dir, str(z), str(x))
+        os.makedirs(column_dir, exist_ok=True)
+        for y in range(rows):
+            box = (x * TILE_SIZE, y * TILE_SIZE, min((x + 1) * TILE_SIZE, level_width), min((y + 1) * TILE_SIZE, level_height))
+            tile = level.crop(box)
+            full_tile = tile.size == (TILE_SIZE, TILE_SIZE)
+            if full_tile and tile.mode == 'RGB':
+                path, tile_format = os.path.join(column_dir, f'{y}.jpg'), 'JPEG'
+            else:
+                # Edge tiles are padded with transparency so Leaflet doesn't stretch them
+                padded = Image.new('RGBA', (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0))
+                padded.paste(tile, (0, 0))
+                tile = padded
+                path, tile_format = os.path.join(column_dir, f'{y}.png'), 'PNG'
+
+            temp_path = f'{path}.tmp'
+            if tile_format == 'JPEG':
+                tile.save(temp_path, tile_format, quality=JPEG_QUALITY, optimize=True)
+            else:
+                tile.save(temp_path, tile_format, optimize=True)
+            os.replace(temp_path, path)
+    print(f"Tile level {z} ({columns}x{rows} tiles) built for {source_path}")
+
+def get_tile(tiles_dir, source_path, z, x, y):
+    """Returns the path of tile (z, x, y) of the map image, cutting its level first if needed - None if out of range."""
+    info = pyramid_info(source_path)
+    if not 0 <= z <= info['max_zoom']:
+        return None
+    level_width, level_height = _level_size(info, z)
+    if not (0 <= x < math.ceil(level_width / TILE_SIZE) and 0 <= y < math.ceil(level_height / TILE_SIZE)):
+        return None
+
+    _ensure_current(tiles_dir, source_path)
+
+    path = _existing_tile(tiles_dir, z, x, y)
+    if path:
+        return path
+
+    # One request cuts the whole level, the others wait for it instead of decoding the image again
+    with _lock_for((tiles_dir, z)):
+        path = _existing_tile(tiles_dir, z, x, y)
+        if path is None:
+            _build_level(tiles_dir, source_path, info, z)
+            path = _existing_tile(tiles_dir, z, x, y)
+    return path
@@ -0,0 +1,129 @@
+"""
+Streaming, resumable uploads of large map images.
+
+An upload is created first (POST /uploads) and its bytes are then sent with one or more PUT requests,
+each carrying the next chunk. Chunks are written straight to a .part file in the target map folder's
+incoming directory while the SHA-256 of the file is computed, and the finished file is renamed into
+place - so a multi-hundred-MB orthomosaic never sits in memory or has to arrive in one request.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import threading
+from gogrow_app.ingest import INCOMING_DIR_NAME
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+class UploadError(Exception):
+    """Raised when an upload chunk can't be accepted - carries the HTTP status and the offset to resume from."""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+_locks = {}
+_locks_lock = threading.Lock()
+_hashers = {}  # upload_id -> (offset, sha256 object) for the bytes received so far
+
+def _lock_for(upload_id):
+    with _locks_lock:
+        return _locks.setdefault(upload_id, threading.Lock())
+
+def _paths(folder_path, upload_id):
+    incoming = os.path.join(folder_path, INCOMING_DIR_NAME)
+    return os.path.join(incoming, f'{upload_id}.part'), os.path.join(incoming, f'{upload_id}.json')
+
+def create_upload(folder_path, filename, size, sha256=None):
+    upload_id = uuid.uuid4().hex
+    part_path, meta_path = _paths(folder_path, upload_id)
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    meta = {'id': upload_id, 'filename': filename, 'size': size, 'sha256': sha256, 'created_at': time.time()}
+    open(part_path, 'wb').close()
+    with open(meta_path, 'w') as meta_file:
+        json.dump(meta, meta_file)
+    return meta
+
+def get_upload(folder_path, upload_id):
+    if not UPLOAD_ID_PATTERN.match(upload_id):
+        return None
+    part_path, meta_path = _paths(folder_path, upload_id)
+    try:
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+        meta['offset'] = os.path.getsize(part_path)
+    except (OSError, ValueError):
+        return None
+    return meta
+
+def _hasher_at(upload_id, part_path, offset):
+    # Reuse the running hash when it covers exactly the bytes on disk, otherwise (after a restart or a
+    # broken connection) hash the part file again
+    state = _hashers.get(upload_id)
+    if state and state[0] == offset:
+        return state[1]
+    hasher = hashlib.sha256()
+    with open(part_path, 'rb') as part_file:
+        for chunk in iter(lambda: part_file.read(UPLOAD_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher
+
+def write_chunk(folder_path, upload_id, stream, start, max_size):
+    """
+    Appends the bytes of stream to the upload, which must continue at offset start.
+    Returns the upload with its new offset, plus the hex digest once every byte has arrived.
+    """
+    with _lock_for(upload_id):
+        meta = get_upload(folder_path, upload_id)
+        if meta is None:
+            raise UploadError("Upload not found", 404)
+        offset = meta['offset']
+        if start != offset:
+            raise UploadError(f"Expected the chunk starting at byte {offset}", 409, offset)
+
+        part_path, meta_path = _paths(folder_path, upload_id)
+        hasher = _hasher_at(upload_id, part_path, offset)
+        _hashers.pop(upload_id, None)
+
+        with open(part_path, 'ab') as part_file:
+            try:
+                for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+                    if offset + len(chunk) > min(meta['size'], max_size):
+                        raise UploadError("Upload is larger than its declared size or the size limit", 413, start)
+                    part_file.write(chunk)
+                    hasher.update(chunk)
+                    offset += len(chunk)
+            except UploadError:
+                # Throw away the rejected chunk, the upload can continue from where this request started
+                part_file.truncate(start)
+                raise
+
+        _hashers[upload_id] = (offset, hasher)
+        meta['offset'] = offset
+        if offset == meta['size']:
+            meta['digest'] = hasher.hexdigest()
+        return meta
+
+def finish_upload(folder_path, upload_id, destination):
+    """Moves the completed part file to destination and forgets the upload."""
+    part_path, meta_path = _paths(folder_path, upload_id)
+    with open(part_path, 'rb+') as part_file:
+        os.fsync(part_file.fileno())
+    os.replace(part_path, destination)
+    discard_upload(folder_path, upload_id)
+
+def discard_upload(folder_path, upload_id):
+    part_path, meta_path = _paths(folder_path, upload_id)
+    for path in (part_path, meta_path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    _hashers.pop(upload_id, None)
+    with _locks_lock:
+        _locks.pop(upload_id, None)
@@ -0,0 +1,32 @@
+"""
+Checks and clean-up for values coming from requests and imported files.
+"""
+
+import math
+import bleach
+
+def sanitize_input(input_str):
+    return bleach.clean(input_str)
+
+def validate_latitude(lat):
+    if not -90 <= lat <= 90:
+        raise ValueError("Invalid latitude value")
+
+def validate_longitude(lng):
+    if not -180 <= lng <= 180:
+        raise ValueError("Invalid longitude value")
+
+def parse_coordinate(value, name):
+    """
+    A map coordinate from a number or a numeric string. Maps use the image's pixels as coordinates
+    (L.CRS.Simple), so unlike validate_latitude/validate_longitude any finite number is accepted.
+    """
+    if isinstance(value, bool):
+        raise ValueError(f"{name} must be a number")
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be a number")
+    if not math.isfinite(number):
+        raise ValueError(f"{name} must be a finite number")
+    return number
@@ -1,29 +1,41 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from gogrow_app import app
 import os
-import glob
 import sqlite3
-from sqlite3 import Error
 import json
-from flask import Flask, redirect, jsonify, request, url_for, render_template, send_from_directory, session, flash, send_file, Response, get_flashed_messages
-from werkzeug.utils import secure_filename
-from PIL import Image
+from flask import redirect, jsonify, request, url_for, render_template, session, flash, send_file, Response
+from werkzeug.utils import secure_filename, safe_join
 import traceback
-from logging.handlers import RotatingFileHandler
-from gogrow_app.settings import app, IMAGE_FOLDER, ICON_DIR, THUMBNAIL_DIR  #settings.py imports config data that is pulled from config.cfg in the app's root dir
+from gogrow_app.settings import app, IMAGE_FOLDER, ICON_DIR, THUMBNAIL_DIR, IMG_DIR, BACKUP_DIR  #settings.py imports config data that is pulled from config.cfg in the app's root dir
+from gogrow_app.database import connection_manager, schema_registry, get_db_connection, ensure_schema, get_change_version, JOURNAL_DATE_FORMAT, SEARCH_COLUMNS  #database.py keeps pooled connections to each map's database and its schema up to date
+from gogrow_app.clusters import cluster_cache, clusters_in_bbox, MIN_CLUSTER_ZOOM, MAX_CLUSTER_ZOOM
+from gogrow_app.tiles import get_tile, pyramid_info, TILE_DIR_NAME
+from gogrow_app.jobs import JobQueue
+from gogrow_app.bundles import bundle_cache, choose_encoding
+from gogrow_app.events import ChangeNotifier
+from gogrow_app.batch import apply_batch, MAX_BATCH_OPERATIONS, ID_QUERY_CHUNK
+from gogrow_app.ingest import INCOMING_DIR_NAME
+from gogrow_app.importer import create_import, get_import, guess_format, check_format, IMPORT_FORMATS
+from gogrow_app.exports import EXPORT_FORMATS, check_export, has_rows, stream_export
+from gogrow_app.search import search, needs_indexing, strip_html, DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT
+from gogrow_app.backups import SnapshotStore, is_snapshot, is_backup, tarball_folder
+from gogrow_app.uploads import UploadError, create_upload, get_upload, write_chunk, finish_upload, discard_upload
+from gogrow_app.blobs import BlobStore, BLOB_DIR_NAME
+from gogrow_app.icons import IconCatalog, IconCache, parse_icon_pairs, normalize_color
+from gogrow_app.caching import send_cached, send_cached_data, fingerprinted_url
+from gogrow_app.derivatives import DerivativeCache, DERIVATIVE_FORMATS, choose_format, choose_width
+from gogrow_app.catalog import MapCatalog
+from gogrow_app.contact_sheet import ContactSheet, SHEET_FORMATS, default_format
 import uuid
-import shutil
 import configparser
 from configparser import NoSectionError, NoOptionError
-import csv
-from io import StringIO
-import tarfile
-import bleach
 import pathlib
 from pathlib import Path
 import re
-import rawpy
-import imageio
+import multiprocessing
+import hashlib
+import time
+import base64
 
 app_dir = os.path.dirname(os.path.abspath(__file__))
 config_path = os.path.join(app_dir, 'config.cfg')
@@ -31,12 +43,49 @@ config_path = os.path.join(app_dir, 'config.cfg')
 config = configparser.ConfigParser()
 config.read(config_path)
 
+# Background threads run in the server process - not in the job workers, nor in command line tools
+# like import_features.py, which set GOGROW_BACKGROUND=false before importing the app
+RUN_BACKGROUND = multiprocessing.parent_process() is None and os.environ.get('GOGROW_BACKGROUND', 'true').lower() != 'false'
+
+# Image ingestion and other slow work runs in a process pool, tracked in img/jobs.db. Jobs are only
+# queued here - runserver.py starts running them, together with those left over from the last run
+job_queue = JobQueue(os.path.join(IMG_DIR, 'jobs.db'), workers=app.config['JOB_WORKERS'])
+
+# Uploaded images are stored once by content in img/.blobs, map folders and journals link to them
+blob_store = BlobStore(os.path.join(IMG_DIR, BLOB_DIR_NAME))
+if RUN_BACKGROUND:
+    # Blobs of map images and journal pictures that were deleted or replaced outside GoGrow
+    job_queue.submit('collect_blob_garbage', {'blob_root': blob_store.root})
+
+# Every map's image, thumbnail and counts in img/catalog.db, kept up to date by writes, uploads and a watcher
+map_catalog = MapCatalog(IMG_DIR, sha256_of=blob_store.sha256_of,
+                         poll_interval=app.config['CATALOG_POLL_SECONDS'])
+if RUN_BACKGROUND:
+    map_catalog.start_watching()
+
+# All map thumbnails in one sprite for the map picker, redrawn a cell at a time as the catalog changes
+contact_sheet = ContactSheet(map_catalog)
+
+# Map backups are snapshots of content-addressed chunks in the backups directory, shared between snapshots
+snapshot_store = SnapshotStore(BACKUP_DIR, workers=app.config['BACKUP_WORKERS'])
+
+# Resized and recompressed copies of images (/img/<folder>/<file>?w=&fmt=) live in the thumbnail directory
+derivative_cache = DerivativeCache(THUMBNAIL_DIR, app.config['DERIVATIVE_CACHE_SIZE'])
+
+# The icons in ICON_DIR, loaded once and kept up to date by polling the directory
+icon_catalog = IconCatalog(ICON_DIR, keep_data=app.config['ICONS_IN_MEMORY'], poll_interval=app.config['ICON_POLL_SECONDS'])
+if RUN_BACKGROUND:
+    icon_catalog.start_watching()
+
+# Marker icons with their colors applied, memoized in memory and in the icon cache directory
+icon_cache = IconCache(icon_catalog, app.config['ICON_CACHE_DIR'])
+
 @app.route('/health', methods=['GET'])
 def health_check():
     try:
         # Perform any necessary checks here (database connection, subsystem status, etc.) - will expand on this later
         # If everything is okay, return a successful response
-        return jsonify({"status": "healthy"}), 200
+        return jsonify({"status": "healthy", "database_connections": connection_manager.stats(), "icons": icon_catalog.stats(), "changes": change_notifier.stats()}), 200
     except Exception as e:
         # Print the error and return an error response
         print(f"Health check failed: {e}")
@@ -82,16 +131,35 @@ def journal():
         message='Your shared GoGrow journal'
     )
 
-def sanitize_input(input_str):
-    return bleach.clean(input_str)
+def parse_bbox(bbox):
+    # Map coordinates are image pixels (the map uses L.CRS.Simple), so only the order of the edges is checked
+    if not bbox:
+        return None
+    try:
+        south, west, north, east = [float(value) for value in bbox.split(',')]
+    except ValueError:
+        raise ValueError("bbox must be four numbers: south,west,north,east")
+    if south > north or west > east:
+        raise ValueError("Invalid bbox: south and west must not be greater than north and east")
+    return south, west, north, east
+
+MAX_PAGE_SIZE = 10000
 
-def validate_latitude(lat):
-    if not -90 <= lat <= 90:
-        raise ValueError("Invalid latitude value")
+def parse_page_args(args):
+    try:
+        limit = int(args['limit']) if args.get('limit') else None
+        cursor = int(args['cursor']) if args.get('cursor') else None
+    except ValueError:
+        raise ValueError("limit and cursor must be whole numbers")
+    if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return limit, cursor
 
-def validate_longitude(lng):
-    if not -180 <= lng <= 180:
-        raise ValueError("Invalid longitude value")
+# The map database plus the write-ahead log and shared memory files SQLite keeps next to it in WAL mode
+DATABASE_FILE_EXTENSIONS = ('.db', '.db-wal', '.db-shm', '.db-journal')
+
+def is_database_file(filename):
+    return filename.lower().endswith(DATABASE_FILE_EXTENSIONS)
 
 def is_safe_path(basedir, path, follow_symlinks=True):
     # Create the full path
@@ -205,21 +273,121 @@ def set_image_folder():
     return "OK", 200
 
 def get_icon_files():
-    icon_files = os.listdir(ICON_DIR)
-    
-    # sort the list in alphabetical order
-    icon_files = sorted(icon_files)
-
-    return icon_files
-
-def create_thumbnail(image_path, thumbnail_path, thumbnail_size):
-    try:
-        img = Image.open(image_path)
-        img.thumbnail(thumbnail_size)
-        # Save the thumbnail in the new directory
-        img.save(os.path.join(THUMBNAIL_DIR, thumbnail_path), "JPEG")
-    except Exception as e:
-        app.logger.error(f'Error creating thumbnail: {e}')
+    # sorted in alphabetical order by the icon catalog
+    return icon_catalog.names()
+
+MAX_ICON_RESULTS = 1000
+
+FEATURE_COLUMNS = {
+    'markers': ['id', 'lat', 'lng', 'info', 'iconType', 'iconColor', 'markerNotes'],
+    'lines': ['id', 'start_lat', 'start_lng', 'end_lat', 'end_lng', 'info', 'color', 'notes']
+}
+
+# Exact bounding box tests - the R*Tree stores 32-bit floats, so it can return a few rows just outside the box
+FEATURE_BBOX_FILTERS = {
+    'markers': 't.lat BETWEEN ? AND ? AND t.lng BETWEEN ? AND ?',
+    'lines': 'max(t.start_lat, t.end_lat) >= ? AND min(t.start_lat, t.end_lat) <= ? AND max(t.start_lng, t.end_lng) >= ? AND min(t.start_lng, t.end_lng) <= ?'
+}
+
+def marker_to_dict(marker):
+    return {
+        'markerId': marker[0],
+        'lat': marker[1],
+        'lng': marker[2],
+        'info': marker[3],
+        'iconType': marker[4],
+        'iconColor': marker[5],
+        'markerNotes': marker[6]
+    }
+
+def line_to_dict(line):
+    return {
+        'lineId': line[0],
+        'start_lat': line[1],
+        'start_lng': line[2],
+        'end_lat': line[3],
+        'end_lng': line[4],
+        'info': line[5],
+        'color': line[6],
+        'notes': line[7]
+    }
+
+JOURNAL_COLUMNS = ['id', 'entry_date', 'linked_item_id', 'entry_title', 'entry_content', 'is_favorite']
+
+def journal_to_dict(journal):
+    return dict(zip(JOURNAL_COLUMNS, journal))
+
+# The prefixes of journals.linked_item_id ("Marker:<id>,Line:<id>,...") -> table and how its rows are returned
+ITEM_TYPES = {
+    'Marker': ('markers', marker_to_dict),
+    'Line': ('lines', line_to_dict)
+}
+MAX_ITEM_LOOKUP = 1000
+
+def parse_item_refs(value):
+    """[(type, id)] of a "Marker:<id>,Line:<id>,..." string, leaving out empty and unknown parts."""
+    refs = []
+    for part in (value or '').split(','):
+        item_type, _, item_id = part.strip().partition(':')
+        if item_type in ITEM_TYPES and item_id:
+            refs.append((item_type, item_id))
+    return refs
+
+def lookup_items(conn, refs):
+    """Finds the items of [(type, id)] with one id IN (...) query per table. Returns {"Type:id": item}."""
+    found = {}
+    for item_type, (table, to_dict) in ITEM_TYPES.items():
+        ids = list({item_id for ref_type, item_id in refs if ref_type == item_type})
+        columns = ', '.join(FEATURE_COLUMNS[table])
+        for start in range(0, len(ids), ID_QUERY_CHUNK):
+            chunk = ids[start:start + ID_QUERY_CHUNK]
+            for row in conn.execute(f"SELECT {columns} FROM {table} WHERE id IN ({', '.join('?' * len(chunk))})", chunk):
+                found[f'{item_type}:{row[0]}'] = to_dict(row)
+    return found
+
+def linked_items(refs, found):
+    # In the order they were linked - item is None when the marker or line was deleted since
+    return [{'id': f'{item_type}:{item_id}', 'type': item_type, 'item': found.get(f'{item_type}:{item_id}')}
+            for item_type, item_id in refs]
+
+def query_features(conn, table, bbox=None, limit=None, cursor=None):
+    """
+    Reads rows of the markers or lines table in rowid order, optionally only those inside bbox
+    (south, west, north, east) using the table's R*Tree index, and a page of limit rows after cursor.
+    Returns the rows and the cursor of the next page (None when there are no more rows).
+    """
+    columns = ', '.join(f't.{column}' for column in FEATURE_COLUMNS[table])
+    sql = f'SELECT t.rowid, {columns} FROM {table} t'
+    conditions = []
+    params = []
+
+    if bbox is not None:
+        south, west, north, east = bbox
+        sql += f' JOIN {table}_rtree r ON r.id = t.rowid'
+        conditions.append('r.max_lat >= ? AND r.min_lat <= ? AND r.max_lng >= ? AND r.min_lng <= ?')
+        conditions.append(FEATURE_BBOX_FILTERS[table])
+        params += [south, north, west, east] * 2
+
+    if cursor is not None:
+        conditions.append('t.rowid > ?')
+        params.append(cursor)
+
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY t.rowid'
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit)
+
+    rows = conn.execute(sql, params).fetchall()
+    next_cursor = rows[-1][0] if limit is not None and len(rows) == limit else None
+    return [row[1:] for row in rows], next_cursor
+
+def feature_list_response(items, next_cursor):
+    response = jsonify(items)
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = str(next_cursor)
+    return response
 
 def update_image_folder_path(new_image_folder):
     config = configparser.ConfigParser()
@@ -228,50 +396,16 @@ def update_image_folder_path(new_image_folder):
     with open(os.path.join(app.root_path, 'config.cfg'), 'w') as configfile:
         config.write(configfile)
 
-def init_markers_db(db_path):
-    conn = None
-    try:
-        # Check if the database already exists
-        if not os.path.exists(db_path):
-            conn = sqlite3.connect(db_path)
-            c = conn.cursor()
-
-            c.execute('''CREATE TABLE IF NOT EXISTS markers
-                         (id TEXT PRIMARY KEY, lat REAL, lng REAL, info TEXT, iconType TEXT, iconColor TEXT, markerNotes TEXT)''')
-            conn.commit()
-            print(f"init_markers_db() will attempt to create a 'markers' table in the database, if the table does not exist : {db_path}")
-    except Exception as e:
-        print(f"Error initializing markers database: {e}")
-    finally:
-        if conn:
-            conn.close()
-
-def init_lines_db(db_path):
-    conn = None
-    try:
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS lines
-            (id TEXT PRIMARY KEY, start_lat REAL, start_lng REAL, end_lat REAL, end_lng REAL, info TEXT, color TEXT, notes TEXT)
-        ''')
-
-        conn.commit()
-        print(f"init_lines_db() will attempt to create a 'lines' table in the database, if the table does not exist : {db_path}")
-
-    except Exception as e:
-        print(f"Error initializing lines database: {e}")
-    finally:
-        if conn:
-            conn.close()
-
 @app.route('/lines/<selected_dir>', methods=['GET', 'POST'])
 def lines(selected_dir=None):
     if selected_dir is not None:
         if not is_safe_path(app.root_path, selected_dir):
             raise InvalidDirectoryError("Invalid directory")
     
+    # Optional viewport and paging parameters (?bbox=south,west,north,east&limit=&cursor=)
+    bbox = parse_bbox(request.args.get('bbox'))
+    limit, cursor = parse_page_args(request.args)
+
     conn = None
     try:
         if request.method == 'GET':
@@ -279,12 +413,12 @@ def lines(selected_dir=None):
             session['image_folder'] = selected_dir
 
             # Pass the folder name to get_lines function
-            return get_lines(image_folder=selected_dir)
+            return get_lines(image_folder=selected_dir, bbox=bbox, limit=limit, cursor=cursor)
         elif request.method == 'POST':
             image_folder = session.get('image_folder', get_image_folder_path())
-            db_path = os.path.join(app.root_path, 'img', image_folder, f'{image_folder}.db')
+            db_path = os.path.join(IMG_DIR, image_folder, f'{image_folder}.db')
 
-            init_lines_db(db_path)
+            ensure_schema(db_path)
 
             data = request.get_json()
             start_lat = data['start_lat']
@@ -297,13 +431,14 @@ def lines(selected_dir=None):
 
             line_id = str(uuid.uuid4())
 
-            conn = sqlite3.connect(db_path)
+            conn = get_db_connection(db_path)
             c = conn.cursor()
             c.execute('''
                 INSERT INTO lines (id, start_lat, start_lng, end_lat, end_lng, info, color, notes)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
             ''', (line_id, start_lat, start_lng, end_lat, end_lng, info, color, notes))
             conn.commit()
+            map_written(db_path)
 
             return jsonify({'line_id': line_id}), 200
     except Exception as e:
@@ -323,12 +458,13 @@ def update_line():
         color = data['color']
         notes = data['notes']
         image_folder = session.get('image_folder', get_image_folder_path())
-        db_path = os.path.join(app.root_path, 'img', image_folder, f'{image_folder}.db')
+        db_path = os.path.join(IMG_DIR, image_folder, f'{image_folder}.db')
 
-        conn = sqlite3.connect(db_path)
+        conn = get_db_connection(db_path)
         c = conn.cursor()
         c.execute('UPDATE lines SET info=?, color=?, notes=? WHERE id=?', (info, color, notes, line_id))
         conn.commit()
+        map_written(db_path)
         print(f"Line(s) Updated")
         return 'OK', 200
     except Exception as e:
@@ -338,37 +474,24 @@ def update_line():
         if conn:
             conn.close()
 
-def get_lines(image_folder=None):
+def get_lines(image_folder=None, bbox=None, limit=None, cursor=None):
     conn = None
     try:
         if image_folder is None:
             image_folder = get_image_folder_path()
 
         image_folder = session.get('image_folder', image_folder)
-        db_path = os.path.join(app.root_path, 'img', image_folder, f'{image_folder}.db')
+        db_path = os.path.join(IMG_DIR, image_folder, f'{image_folder}.db')
 
-        # Initialize the lines database
-        init_lines_db(db_path)
+        # Make sure the database has the current schema
+        ensure_schema(db_path)
 
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        c.execute('SELECT * FROM lines')
-        lines = c.fetchall()
+        conn = get_db_connection(db_path)
+        lines, next_cursor = query_features(conn, 'lines', bbox, limit, cursor)
 
         # Convert the tuples to JSON objects
-        line_list = [
-            {
-                'lineId': line[0],
-                'start_lat': line[1],
-                'start_lng': line[2],
-                'end_lat': line[3],
-                'end_lng': line[4],
-                'info': line[5],
-                'color': line[6],
-                'notes': line[7]
-            } for line in lines
-        ]
-        return jsonify(line_list)  # Return the JSON object
+        line_list = [line_to_dict(line) for line in lines]
+        return feature_list_response(line_list, next_cursor)  # Return the JSON object
 
     except sqlite3.OperationalError as e:
         app.logger.error(f"Error getting lines from database: {e}")
@@ -385,13 +508,14 @@ def delete_line():
         data = request.get_json()
         line_id = data['id']
         image_folder = session.get('image_folder', get_image_folder_path())
-        db_path = os.path.join(app.root_path, 'img', image_folder, f'{image_folder}.db')
+        db_path = os.path.join(IMG_DIR, image_folder, f'{image_folder}.db')
         print(f"Deleting line from DB: {db_path}")
 
-        conn = sqlite3.connect(db_path)
+        conn = get_db_connection(db_path)
         c = conn.cursor()
         c.execute('DELETE FROM lines WHERE id=?', (line_id,))
         conn.commit()
+        map_written(db_path)
 
         print(f"Line {line_id} deleted")
         return 'OK', 200
@@ -409,66 +533,60 @@ def get_icon_directory():
 
 @app.route('/icon_filenames')
 def icon_filenames():
-    icon_files = get_icon_files()
-    return jsonify(icon_files)
+    # ?q=leaf&limit=50 searches the catalog for the icon picker - names starting with q come first
+    query = request.args.get('q', '')
+    limit = request.args.get('limit')
+    try:
+        limit = int(limit) if limit else None
+    except ValueError:
+        raise ValueError("limit must be a whole number")
+    if limit is not None and not 0 < limit <= MAX_ICON_RESULTS:
+        raise ValueError(f"limit must be between 1 and {MAX_ICON_RESULTS}")
+    if not query and limit is None:
+        return jsonify(get_icon_files())
+    return jsonify(icon_catalog.search(query, limit))
+
+def catalog_file_url(entry, filename, digest=None):
+    # The content hash in the URL lets the browser keep the file until it is replaced
+    return fingerprinted_url(f"img/{entry['folder']}/{filename}", os.path.join(IMG_DIR, entry['folder'], filename), digest)
+
+def catalog_image_url(entry):
+    return catalog_file_url(entry, entry['image'], entry['image_sha256']) if entry and entry['image'] else None
 
 @app.route('/get_image_url/<selected_dir>')
 def get_image_url(selected_dir=None):
     try:
-        image_directory = os.path.join(os.path.dirname(__file__), "img")
-        print(f"Image directory: {image_directory}")
-        image_dirs = os.listdir(image_directory)
-        print(f"Image subdirectories: {image_dirs}")
-
-        if selected_dir in image_dirs:
-            # Get the most recent image in the directory based on its creation time
-            image_files = glob.glob(os.path.join(image_directory, selected_dir, "*"))
-            print(f"Files in image directory: {image_files}")
-
-            # Filter out any database file, thumbnail and subdirectories in the directory
-            image_files = [file for file in image_files if os.path.isfile(file) and not file.endswith(".db") and 'thumbnail-' not in file]
-
-            latest_image = max(image_files, key=os.path.getctime)
-            print(f"Latest image: {os.path.relpath(latest_image, os.path.dirname(__file__))}")
-            return os.path.relpath(latest_image, os.path.dirname(__file__)), 200
-        else:
+        # The map's image comes from the catalog, its folder isn't listed or globbed
+        entry = map_catalog.get(selected_dir) if is_valid_folder_name(selected_dir) else None
+        image_url = catalog_image_url(entry)
+        if image_url is None:
             return "", 404
+        print(f"Latest image: {image_url}")
+        return image_url, 200
 
     except Exception as e:
         print(f"Error getting image URL: {e}")
         return "", 500
 
 
-def get_markers(image_folder=None):
+def get_markers(image_folder=None, bbox=None, limit=None, cursor=None):
     conn = None
     try:
         if image_folder is None:
             image_folder = get_image_folder_path()
 
         image_folder = session.get('image_folder', image_folder)
-        db_path = os.path.join(app.root_path, 'img', image_folder, f'{image_folder}.db')
+        db_path = os.path.join(IMG_DIR, image_folder, f'{image_folder}.db')
 
-        # Initialize the markers database
-        init_markers_db(db_path)
+        # Make sure the database has the current schema
+        ensure_schema(db_path)
 
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        c.execute('SELECT * FROM markers')
-        markers = c.fetchall()
+        conn = get_db_connection(db_path)
+        markers, next_cursor = query_features(conn, 'markers', bbox, limit, cursor)
 
         # Convert the tuples to JSON objects
-        marker_list = [
-            {
-                'markerId': marker[0],
-                'lat': marker[1],
-                'lng': marker[2],
-                'info': marker[3],
-                'iconType': marker[4],
-                'iconColor': marker[5],
-                'markerNotes': marker[6]
-            } for marker in markers
-        ]
-        return jsonify(marker_list)  # Return the JSON object
+        marker_list = [marker_to_dict(marker) for marker in markers]
+        return feature_list_response(marker_list, next_cursor)  # Return the JSON object
 
     except sqlite3.OperationalError as e:
         app.logger.error(f"Error getting markers from database: {e}")
@@ -480,7 +598,7 @@ def get_markers(image_folder=None):
 
 @app.route('/markers/<selected_dir>', methods=['GET', 'POST'])  
 def markers(selected_dir=None):
-    image_base_path = os.path.join(app.root_path, 'img')
+    image_base_path = IMG_DIR
     
     if selected_dir is not None:
         print(f"selected_dir: {selected_dir}")
@@ -488,19 +606,23 @@ def markers(selected_dir=None):
         if not is_safe_path(image_base_path, selected_dir):
             raise InvalidDirectoryError("Invalid directory")    
         conn = None
+
+    # Optional viewport and paging parameters (?bbox=south,west,north,east&limit=&cursor=)
+    bbox = parse_bbox(request.args.get('bbox'))
+    limit, cursor = parse_page_args(request.args)
+
     try:
         if request.method == 'GET':
             # Update the session's image_folder with the new selected folder
             session['image_folder'] = selected_dir
 
             # Pass the folder name to get_markers function
-            return get_markers(image_folder=selected_dir)
+            return get_markers(image_folder=selected_dir, bbox=bbox, limit=limit, cursor=cursor)
         elif request.method == 'POST':
-            # Call init_markers_db before adding a new marker
+            # Make sure the markers table exists before adding a new marker
             image_folder = session.get('image_folder', get_image_folder_path())
-            db_path = os.path.join(app.root_path, 'img', image_folder, f'{image_folder}.db')
-            print(f"initializing database {image_folder}")
-            init_markers_db(db_path)
+            db_path = os.path.join(IMG_DIR, image_folder, f'{image_folder}.db')
+            ensure_schema(db_path)
 
             data = request.get_json()
             lat = data['lat']
@@ -513,11 +635,13 @@ def markers(selected_dir=None):
             # Generate a UUID for the new marker
             marker_id = str(uuid.uuid4())
 
-            conn = sqlite3.connect(db_path)
+            conn = get_db_connection(db_path)
             c = conn.cursor()
             c.execute('INSERT INTO markers (id, lat, lng, info, iconType, iconColor, markerNotes) VALUES (?, ?, ?, ?, ?, ?, ?)', (marker_id, lat, lng, info, iconType, iconColor, markerNotes))
 
             conn.commit()
+            cluster_cache.invalidate(db_path)
+            map_written(db_path)
             return jsonify({'marker_id': marker_id}), 200
 
     except Exception as e:
@@ -545,12 +669,14 @@ def update_marker():
         icon_color = data['iconColor']
         marker_notes = data['markerNotes']
         image_folder = session.get('image_folder', get_image_folder_path())
-        db_path = os.path.join(app.root_path, 'img', image_folder, f'{image_folder}.db')
+        db_path = os.path.join(IMG_DIR, image_folder, f'{image_folder}.db')
 
-        conn = sqlite3.connect(db_path)
+        conn = get_db_connection(db_path)
         c = conn.cursor()
         c.execute('UPDATE markers SET info=?, iconType=?, iconColor=?, markerNotes=? WHERE id=?', (info, icon_type, icon_color, marker_notes, marker_id))
         conn.commit()
+        cluster_cache.invalidate(db_path)
+        map_written(db_path)
 
         print(f"Marker(s) Updated")
         return 'OK', 200
@@ -569,13 +695,15 @@ def delete_marker():
         data = request.get_json()
         marker_id = data['id']
         image_folder = session.get('image_folder', get_image_folder_path())
-        db_path = os.path.join(app.root_path, 'img', image_folder, f'{image_folder}.db')
+        db_path = os.path.join(IMG_DIR, image_folder, f'{image_folder}.db')
         print(f"Deleting marker from DB: {db_path}")
 
-        conn = sqlite3.connect(db_path)
+        conn = get_db_connection(db_path)
         c = conn.cursor()
         c.execute('DELETE FROM markers WHERE id=?', (marker_id,))
         conn.commit()
+        cluster_cache.invalidate(db_path)
+        map_written(db_path)
 
         print(f"Marker {marker_id} deleted")
         return 'OK', 200
@@ -587,6 +715,84 @@ def delete_marker():
         if conn:
             conn.close()
 
+@app.route('/markers/<selected_dir>/clusters', methods=['GET'])
+def marker_clusters(selected_dir):
+    image_base_path = IMG_DIR
+    if not is_safe_path(image_base_path, selected_dir):
+        raise InvalidDirectoryError("Invalid directory")
+
+    try:
+        zoom = int(round(float(request.args.get('zoom', 0))))
+    except ValueError:
+        raise ValueError("zoom must be a number")
+    zoom = min(max(zoom, MIN_CLUSTER_ZOOM), MAX_CLUSTER_ZOOM)
+    bbox = parse_bbox(request.args.get('bbox'))
+
+    db_path = os.path.join(image_base_path, selected_dir, f'{selected_dir}.db')
+    if not os.path.exists(db_path):
+        return jsonify([])
+    ensure_schema(db_path)
+
+    def load_markers():
+        conn = get_db_connection(db_path)
+        try:
+            rows = conn.execute('SELECT id, lat, lng, iconType FROM markers WHERE lat IS NOT NULL AND lng IS NOT NULL').fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return [], [], [], []
+        ids, lats, lngs, icon_types = zip(*rows)
+        return ids, lats, lngs, [icon_type or '' for icon_type in icon_types]
+
+    try:
+        clusters = cluster_cache.get(db_path, zoom, load_markers, version=map_change_version(db_path))
+        return jsonify(clusters_in_bbox(clusters, bbox))
+    except sqlite3.OperationalError as e:
+        app.logger.error(f"Error clustering markers: {e}")
+        app.logger.error(traceback.format_exc())
+        return jsonify([])
+
+def icon_response(etag, body, mimetype):
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+@app.route('/markers/<selected_dir>/icons', methods=['GET'])
+def marker_icons(selected_dir):
+    # Every (iconType, iconColor) pair the map's markers use, colored on the server - one request per map
+    image_base_path = IMG_DIR
+    if not is_safe_path(image_base_path, selected_dir):
+        raise InvalidDirectoryError("Invalid directory")
+
+    db_path = os.path.join(image_base_path, selected_dir, f'{selected_dir}.db')
+    pairs = set()
+    if os.path.exists(db_path):
+        ensure_schema(db_path)
+        conn = get_db_connection(db_path)
+        try:
+            for icon_type, icon_color in conn.execute('SELECT DISTINCT iconType, iconColor FROM markers'):
+                try:
+                    pairs.add((icon_type or '', normalize_color(icon_color)))
+                except ValueError:
+                    continue
+        finally:
+            conn.close()
+
+    etag, body = icon_cache.bundle(sorted(pairs))
+    return icon_response(etag, body, 'application/json')
+
+@app.route('/icons/bundle', methods=['GET'])
+def icon_bundle():
+    # ?icons=leaf.svg:#ff0000,tree.svg:#00ff00 - a JSON object of "iconType|iconColor" -> data: URI
+    etag, body = icon_cache.bundle(parse_icon_pairs(request.args.get('icons')))
+    return icon_response(etag, body, 'application/json')
+
+@app.route('/icons/sprite', methods=['GET'])
+def icon_sprite():
+    # Same pairs as /icons/bundle, as one SVG with a <symbol id="icon-<n>"> per pair (sorted by iconType, then color)
+    etag, body = icon_cache.sprite(parse_icon_pairs(request.args.get('icons')))
+    return icon_response(etag, body, 'image/svg+xml')
+
 @app.route('/markers/<selected_dir>/<marker_id>', methods=['GET'])
 def get_marker(selected_dir=None, marker_id=None):
     if selected_dir is not None and marker_id is not None:
@@ -596,11 +802,11 @@ def get_marker(selected_dir=None, marker_id=None):
         conn = None
         try:
             session['image_folder'] = selected_dir
-            db_path = os.path.join(app.root_path, 'img', selected_dir, f'{selected_dir}.db')
+            db_path = os.path.join(IMG_DIR, selected_dir, f'{selected_dir}.db')
 
-            init_markers_db(db_path)
+            ensure_schema(db_path)
 
-            conn = sqlite3.connect(db_path)
+            conn = get_db_connection(db_path)
             c = conn.cursor()
             c.execute('SELECT * FROM markers WHERE id = ?', (marker_id, ))
             marker = c.fetchone()
@@ -635,11 +841,11 @@ def get_line(selected_dir=None, line_id=None):
         conn = None
         try:
             session['image_folder'] = selected_dir
-            db_path = os.path.join(app.root_path, 'img', selected_dir, f'{selected_dir}.db')
+            db_path = os.path.join(IMG_DIR, selected_dir, f'{selected_dir}.db')
 
-            init_lines_db(db_path)
+            ensure_schema(db_path)
 
-            conn = sqlite3.connect(db_path)
+            conn = get_db_connection(db_path)
             c = conn.cursor()
             c.execute('SELECT * FROM lines WHERE id = ?', (line_id, ))
             line = c.fetchone()
@@ -669,13 +875,13 @@ def get_line(selected_dir=None, line_id=None):
 @app.route('/', methods=['GET', 'POST'])
 def index():
     # Create the image directory if it doesn't exist
-    image_directory = os.path.join(app.root_path, 'img')
+    image_directory = IMG_DIR
     if not os.path.exists(image_directory):
         os.makedirs(image_directory)
         print("Base image directory not detected - creating /img directory")
 
     # Create the backups directory if it doesn't exist
-    backup_directory = os.path.join(app.root_path, 'backups')
+    backup_directory = BACKUP_DIR
     if not os.path.exists(backup_directory):
         os.makedirs(backup_directory)
         print("Backups directory not detected - creating /backups directory")
@@ -725,21 +931,48 @@ def process_image_upload(image, image_directory):
 
         file_directory = create_directories_if_needed(image_directory, filename)
 
-        # Check if the uploaded file is a .dng or .raw file
-        if filename.lower().endswith(('.dng', '.raw')):
-            # Convert the .dng or .raw file to a .jpg file
-            converted_filename = os.path.splitext(filename)[0] + '.jpg'
-            save_dng_raw_image_as_jpeg(image, file_directory, converted_filename)
-        else:
-            save_image_and_thumbnail(image, file_directory, filename)
-
-        update_session_variables(filename, file_directory)
-        init_markers_db(os.path.join(file_directory, f'{os.path.splitext(filename)[0]}.db'))
+        # Only the upload itself is saved here - decoding, the thumbnail and tiles are done by a background job
+        upload_path = get_upload_destination(file_directory, filename)
+        save_replacing(image, upload_path)
+        finish_image_upload(file_directory, filename, upload_path)
     except Exception as e:
         # Log the error and show a flash message
         app.logger.error(f'Error saving image: {e}')
         flash('An error occurred while saving the image. Please try again.', 'danger')
 
+def save_replacing(file, path):
+    # Write next to the target and swap it in - writing into the old file would change every map or
+    # journal that shares its blob through a hard link
+    temp_path = os.path.join(os.path.dirname(path), f'.{uuid.uuid4().hex}.tmp')
+    file.save(temp_path)
+    os.replace(temp_path, path)
+
+def is_raw_file(filename):
+    return filename.lower().endswith(('.dng', '.raw'))
+
+def get_upload_destination(file_directory, filename):
+    if is_raw_file(filename):
+        # The .dng or .raw file waits in the incoming folder until a worker has converted it to a .jpg file
+        incoming_directory = os.path.join(file_directory, INCOMING_DIR_NAME)
+        os.makedirs(incoming_directory, exist_ok=True)
+        return os.path.join(incoming_directory, filename)
+    return os.path.join(file_directory, filename)
+
+def finish_image_upload(file_directory, filename, upload_path, sha256=None):
+    # Queue the background job that converts, thumbnails and tiles the saved upload, and select its folder
+    payload = {'folder': file_directory, 'filename': filename, 'thumbnail': f"thumbnail-{os.path.splitext(filename)[0]}.png",
+               'blob_root': blob_store.root, 'sha256': sha256}
+    if is_raw_file(filename):
+        payload.update(filename=os.path.splitext(filename)[0] + '.jpg', raw_path=upload_path)
+    job_id = job_queue.submit('ingest_image', payload)
+    session['ingest_job_id'] = job_id
+    print(f"Image saved, processing it in background job {job_id}")
+
+    update_session_variables(filename, file_directory)
+    ensure_schema(os.path.join(file_directory, f'{os.path.splitext(filename)[0]}.db'))
+    map_catalog.refresh(os.path.basename(file_directory))
+    return job_id
+
 def allowed_file(filename):
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'dng', 'raw'}
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -753,12 +986,6 @@ def create_directories_if_needed(image_directory, filename):
         print("New file directory created")
     return file_directory
 
-def save_image_and_thumbnail(image, file_directory, filename):
-    image.save(os.path.join(file_directory, filename))
-    thumbnail_filename = f"thumbnail-{os.path.splitext(filename)[0]}.png"
-    create_thumbnail(os.path.join(file_directory, filename), os.path.join(file_directory, thumbnail_filename), (200, 200))
-    print("New thumbnail image saved")
-
 def update_session_variables(filename, file_directory):
     image_url = f'/img/{os.path.splitext(filename)[0]}/{filename}'
     session['uploaded_image_url'] = image_url
@@ -767,28 +994,53 @@ def update_session_variables(filename, file_directory):
     print("Setting image URL, image_folder, and image_filename to this session")
     session['image_folder'] = session.get('uploaded_image_folder')
 
-def create_thumbnail(input_path, output_path, size):
-    image = Image.open(input_path)
-    image.thumbnail(size)
-    image.save(output_path, "PNG")
+def parse_width(width):
+    try:
+        return choose_width(int(width)) if width else None
+    except ValueError:
+        raise ValueError("w must be a positive number of pixels")
+
+def serve_image_variant(filename):
+    # A resized, recompressed copy of the image - in the format asked for with ?fmt=, or else the best one the browser accepts
+    width = parse_width(request.args.get('w'))
+    source_path = safe_join(IMG_DIR, filename)
+    if source_path is None or not os.path.isfile(source_path):
+        return render_template('error.html', error='File not found'), 404
+    fmt = choose_format(request.args.get('fmt'), request.accept_mimetypes, source_path)
+
+    # Images in the blob store are cached once by content, whichever map or journal they are requested from
+    st = os.stat(source_path)
+    source_key = blob_store.sha256_of(source_path) or f'{source_path}|{st.st_size}|{st.st_mtime_ns}'
+    try:
+        variant_path = derivative_cache.get(source_path, source_key, width, fmt)
+    except OSError as e:
+        app.logger.error(f'Error resizing image {filename}: {e}')
+        return jsonify({'error': 'File is not an image that can be resized'}), 415
+
+    # The cache file is named by the source's content, the width and the format - cache hits touch its mtime, so that can't be the ETag
+    response = send_file(variant_path, mimetype=DERIVATIVE_FORMATS[fmt][1], conditional=True,
+                         etag=os.path.splitext(os.path.basename(variant_path))[0])
+    if not request.args.get('fmt'):
+        response.vary.add('Accept')
+    return response
 
 @app.route('/img/<path:filename>')
 def serve_image(filename):
+    if ('w' in request.args or 'fmt' in request.args) and not is_database_file(filename):
+        return serve_image_variant(filename)
     try:
         # Check if the requested file is a db file
-        if os.path.splitext(filename)[1] == '.db':
+        if is_database_file(filename):
             return render_template('error.html', error='File not found'), 404
 
         # Serve images from subdirectories
-        img_folder, subpath = os.path.split(filename)
-        response = send_from_directory(os.path.join(app.root_path, 'img', img_folder), subpath)
+        image_path = safe_join(IMG_DIR, filename)
+        if image_path is None or not os.path.isfile(image_path):
+            raise FileNotFoundError(filename)
 
-        # Add a cache busting parameter
-        response.cache_control.no_cache = True
-        response.cache_control.no_store = True
-        response.cache_control.must_revalidate = True
-        response.cache_control.public = True
-        return response
+        # Browsers revalidate with the ETag and get a 304 while the image is unchanged - the fingerprinted
+        # URLs from get_image_url() change with the image, so those are cached for good
+        return send_cached(image_path, digest=blob_store.sha256_of(image_path))
         
     except FileNotFoundError:
         return render_template('error.html', error='File not found'), 404
@@ -799,11 +1051,492 @@ def serve_image(filename):
         flash('An error occurred while serving the image. Please try again.', 'danger')
         return redirect(url_for('index'))
 
+def get_map_image_source(folder):
+    if not is_valid_folder_name(folder):
+        raise InvalidDirectoryError("Invalid directory")
+    folder_path = os.path.join(IMG_DIR, folder)
+    entry = map_catalog.get(folder)
+    return folder_path, os.path.join(folder_path, entry['image']) if entry and entry['image'] else None
+
+@app.route('/tiles/<folder>/info')
+def tile_info(folder):
+    folder_path, source_path = get_map_image_source(folder)
+    if source_path is None:
+        return jsonify({'error': 'No image in this folder'}), 404
+    info = pyramid_info(source_path)
+    return jsonify(dict(info, url=f"/tiles/{folder}/{{z}}/{{x}}/{{y}}?v={info['version']}"))
+
+@app.route('/tiles/<folder>/<int:z>/<int:x>/<int:y>')
+def serve_tile(folder, z, x, y):
+    folder_path, source_path = get_map_image_source(folder)
+    if source_path is None:
+        return "", 404
+    try:
+        tiles_dir = blob_store.tiles_dir_for(source_path, os.path.join(folder_path, TILE_DIR_NAME))
+        tile_path = get_tile(tiles_dir, source_path, z, x, y)
+    except Exception as e:
+        app.logger.error(f'Error building tile {z}/{x}/{y} for {folder}: {e}')
+        app.logger.error(traceback.format_exc())
+        return "", 500
+    if tile_path is None:
+        return "", 404
+
+    # Versioned URLs change whenever the map image does, so they can be cached for good -
+    # otherwise the browser revalidates and send_file answers If-None-Match/If-Modified-Since with a 304
+    versioned = request.args.get('v') == pyramid_info(source_path)['version']
+    response = send_file(tile_path, conditional=True, etag=True, max_age=31536000 if versioned else None)
+    if versioned:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
+
+@app.errorhandler(UploadError)
+def handle_upload_error(error):
+    return jsonify(error=str(error), offset=error.offset), error.status
+
+def get_upload_folder(folder):
+    if not is_valid_folder_name(folder):
+        raise InvalidDirectoryError("Invalid directory")
+    return os.path.join(IMG_DIR, folder)
+
+@app.route('/uploads', methods=['POST'])
+def start_upload():
+    data = request.get_json()
+    filename = secure_filename(data.get('filename', ''))
+    size = data.get('size')
+    sha256 = data.get('sha256')
+
+    if not filename or not allowed_file(filename):
+        return jsonify({'error': 'Invalid file type. Please upload a PNG, JPG, DNG or RAW file.'}), 400
+    if not isinstance(size, int) or size <= 0:
+        return jsonify({'error': 'size must be the file size in bytes'}), 400
+    if size > app.config['MAX_UPLOAD_SIZE']:
+        return jsonify({'error': f"File is larger than the {app.config['MAX_UPLOAD_SIZE']} byte upload limit"}), 413
+    if sha256 is not None and not re.match(r'^[0-9a-fA-F]{64}$', sha256):
+        return jsonify({'error': 'sha256 must be a hex digest'}), 400
+
+    image_directory = IMG_DIR
+    if not is_safe_path(image_directory, filename):
+        raise InvalidDirectoryError("Invalid directory")
+    file_directory = create_directories_if_needed(image_directory, filename)
+    folder = os.path.basename(file_directory)
+
+    upload = create_upload(file_directory, filename, size, sha256.lower() if sha256 else None)
+    return jsonify({'upload_id': upload['id'], 'folder': folder, 'offset': 0, 'url': f"/uploads/{folder}/{upload['id']}"}), 201
+
+@app.route('/uploads/<folder>/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+def upload_chunk(folder, upload_id):
+    file_directory = get_upload_folder(folder)
+    upload = get_upload(file_directory, upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    if request.method == 'GET':
+        # Tells a client resuming an interrupted upload where to continue
+        return jsonify({'upload_id': upload_id, 'offset': upload['offset'], 'size': upload['size']})
+
+    if request.method == 'DELETE':
+        discard_upload(file_directory, upload_id)
+        return 'OK', 200
+
+    # Chunks carry a "Content-Range: bytes <start>-<end>/<total>" header - without one the body continues at byte 0
+    start = 0
+    content_range = request.headers.get('Content-Range')
+    if content_range:
+        match = re.match(r'^bytes (\d+)-(\d+)/(\d+)$', content_range.strip())
+        if not match or int(match.group(3)) != upload['size'] or int(match.group(2)) < int(match.group(1)):
+            return jsonify({'error': 'Invalid Content-Range header', 'offset': upload['offset']}), 400
+        start = int(match.group(1))
+
+    upload = write_chunk(file_directory, upload_id, request.stream, start, app.config['MAX_UPLOAD_SIZE'])
+    if upload['offset'] < upload['size']:
+        return jsonify({'upload_id': upload_id, 'offset': upload['offset'], 'size': upload['size']}), 202
+
+    if upload['sha256'] and upload['sha256'] != upload['digest']:
+        discard_upload(file_directory, upload_id)
+        return jsonify({'error': 'Checksum mismatch, the upload was discarded', 'sha256': upload['digest']}), 422
+
+    upload_path = get_upload_destination(file_directory, upload['filename'])
+    finish_upload(file_directory, upload_id, upload_path)
+    job_id = finish_image_upload(file_directory, upload['filename'], upload_path, upload['digest'])
+    return jsonify({'status': 'OK', 'folder': folder, 'sha256': upload['digest'], 'job_id': job_id}), 200
+
+@app.route('/blobs/collect_garbage', methods=['POST'])
+def collect_blob_garbage():
+    # After map folders or journal pictures were deleted by hand - blobs nothing references any more are deleted
+    job_id = job_queue.submit('collect_blob_garbage', {'blob_root': blob_store.root})
+    return jsonify({'job_id': job_id, 'status_url': f'/jobs/{job_id}'}), 202
+
+def map_bundle_etag(version, image_url, folders, features=True):
+    return hashlib.sha1(json.dumps([version, image_url, folders] + ([] if features else ['no features'])).encode()).hexdigest()
+
+@app.route('/maps/<folder>/bundle', methods=['GET'])
+def map_bundle(folder):
+    # The image URL, markers, lines, journals and folder list of a map, read in one transaction. With
+    # ?features=false the markers and lines are left out - gogrow.js loads those for the part of the map in view
+    if not is_valid_folder_name(folder):
+        raise InvalidDirectoryError("Invalid directory")
+    folder_path = os.path.join(IMG_DIR, folder)
+    if not os.path.isdir(folder_path):
+        return jsonify({'error': 'Map not found'}), 404
+    db_path = os.path.join(folder_path, f'{folder}.db')
+    ensure_schema(db_path)
+
+    entry = map_catalog.get(folder)
+    image_url = '/' + catalog_image_url(entry) if entry and entry['image'] else None
+    folders = list_map_folders()
+    features = request.args.get('features', 'true').lower() != 'false'
+
+    conn = get_db_connection(db_path)
+    try:
+        # An unchanged map is answered from its change counter alone
+        etag = map_bundle_etag(get_change_version(conn), image_url, folders, features)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        def build():
+            conn.execute('BEGIN')
+            try:
+                version = get_change_version(conn)
+                markers, _ = query_features(conn, 'markers') if features else ([], None)
+                lines, _ = query_features(conn, 'lines') if features else ([], None)
+                journals = conn.execute(f"SELECT {', '.join(JOURNAL_COLUMNS)} FROM journals ORDER BY rowid").fetchall()
+            finally:
+                conn.rollback()
+            bundle = {
+                'folder': folder,
+                'version': version,
+                'image_url': image_url,
+                'folders': folders,
+                'journals': [journal_to_dict(journal) for journal in journals]
+            }
+            if features:
+                bundle['markers'] = [marker_to_dict(marker) for marker in markers]
+                bundle['lines'] = [line_to_dict(line) for line in lines]
+            return map_bundle_etag(version, image_url, folders, features), json.dumps(bundle, separators=(',', ':')).encode('utf-8')
+
+        encoding = choose_encoding(request.accept_encodings)
+        etag, body = bundle_cache.get(db_path, etag, encoding, build)
+    finally:
+        conn.close()
+
+    response = Response(body, mimetype='application/json')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+CHANGE_TABLES = {
+    'markers': (FEATURE_COLUMNS['markers'], marker_to_dict),
+    'lines': (FEATURE_COLUMNS['lines'], line_to_dict),
+    'journals': (JOURNAL_COLUMNS, journal_to_dict)
+}
+DEFAULT_CHANGES_LIMIT = 1000
+
+def read_changes(conn, since, limit):
+    """
+    The rows and tombstones with a revision after since, oldest first, at most limit of them in total, as
+    (revision, table, op, item) - op is insert, update or delete (item is then the id) as seen from since.
+    Returns the changes, the revision up to which they are complete (None when they all are) and whether there are more.
+    """
+    changes = []
+    for table, (columns, to_dict) in CHANGE_TABLES.items():
+        rows = conn.execute(f"SELECT revision, created_revision, {', '.join(columns)} FROM {table} WHERE revision > ? ORDER BY revision LIMIT ?",
+                            (since, limit + 1)).fetchall()
+        changes.extend((row[0], table, 'insert' if row[1] > since else 'update', to_dict(row[2:])) for row in rows)
+        tombstones = conn.execute('SELECT revision, id FROM tombstones WHERE kind = ? AND revision > ? ORDER BY revision LIMIT ?',
+                                  (table, since, limit + 1)).fetchall()
+        changes.extend((revision, table, 'delete', item_id) for revision, item_id in tombstones)
+    # Every change has its own revision (migration 5 sees to it for rows from before revisions), so
+    # cutting the merged list after limit entries never splits one
+    changes.sort(key=lambda change: change[0])
+    if len(changes) > limit:
+        changes = changes[:limit]
+        return changes, changes[-1][0], True
+    return changes, None, False
+
+@app.route('/maps/<folder>/items', methods=['GET'])
+def map_items(folder):
+    # ?ids=Marker:<id>,Line:<id>,... (like journals.linked_item_id) - any number of markers and lines in one request
+    if not is_valid_folder_name(folder):
+        raise InvalidDirectoryError("Invalid directory")
+    refs = parse_item_refs(request.args.get('ids'))
+    if len(refs) > MAX_ITEM_LOOKUP:
+        raise ValueError(f"At most {MAX_ITEM_LOOKUP} ids can be looked up at once")
+    db_path = os.path.join(IMG_DIR, folder, f'{folder}.db')
+    ensure_schema(db_path)
+
+    conn = get_db_connection(db_path)
+    try:
+        found = lookup_items(conn, refs)
+    finally:
+        conn.close()
+    missing = list(dict.fromkeys(f'{item_type}:{item_id}' for item_type, item_id in refs if f'{item_type}:{item_id}' not in found))
+    return jsonify({'items': found, 'missing': missing})
+
+@app.route('/maps/<folder>/changes', methods=['GET'])
+def map_changes(folder):
+    # What changed in a map since the revision a client last saw (the bundle's or a previous response's version).
+    # With ?wait=<seconds> a request that finds nothing new waits for the next change first (see events.py)
+    if not is_valid_folder_name(folder):
+        raise InvalidDirectoryError("Invalid directory")
+    folder_path = os.path.join(IMG_DIR, folder)
+    if not os.path.isdir(folder_path):
+        return jsonify({'error': 'Map not found'}), 404
+    try:
+        since = int(request.args.get('since', 0))
+        limit = int(request.args['limit']) if request.args.get('limit') else DEFAULT_CHANGES_LIMIT
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        raise ValueError("since and limit must be whole numbers and wait a number of seconds")
+    if since < 0 or wait < 0:
+        raise ValueError("since and wait must not be negative")
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    db_path = os.path.join(folder_path, f'{folder}.db')
+    ensure_schema(db_path)
+    # Turned away when too many requests wait already - answered now, and told when to ask again
+    waited = change_notifier.wait(db_path, since, wait) if wait else True
+
+    conn = get_db_connection(db_path)
+    try:
+        conn.execute('BEGIN')
+        try:
+            version = get_change_version(conn)
+            # A revision the map never reached means the database was replaced (e.g. restored from a backup)
+            if since > version:
+                return jsonify({'reset': True, 'version': version})
+            changes, upto, more = read_changes(conn, since, limit) if since < version else ([], None, False)
+        finally:
+            conn.rollback()
+    finally:
+        conn.close()
+
+    result = {'since': since, 'version': upto if more else version, 'more': more,
+              'deleted': {table: [] for table in CHANGE_TABLES}}
+    for table in CHANGE_TABLES:
+        result[table] = []
+    for revision, table, op, item in changes:
+        if op == 'delete':
+            result['deleted'][table].append(item)
+        else:
+            result[table].append(item)
+    response = jsonify(result)
+    response.cache_control.no_cache = True
+    if not waited:
+        response.headers['Retry-After'] = str(change_notifier.max_wait)
+    return response
+
+def map_change_version(db_path):
+    conn = get_db_connection(db_path)
+    try:
+        return get_change_version(conn)
+    finally:
+        conn.close()
+
+# Wakes the /maps/<folder>/changes requests waiting for a map's next change
+change_notifier = ChangeNotifier(map_change_version, max_waiting=app.config['EVENT_MAX_WAITING'],
+                                 max_wait=app.config['EVENT_MAX_WAIT_SECONDS'], poll_interval=app.config['EVENT_POLL_SECONDS'])
+
+def map_written(db_path):
+    # Waiting /changes requests and the catalog's counts follow the map that was written to
+    change_notifier.publish(db_path)
+    map_catalog.touch(os.path.basename(os.path.dirname(db_path)))
+
+@app.route('/maps/<folder>/batch', methods=['POST'])
+def map_batch(folder):
+    # Many marker, line and journal inserts, updates and deletes in one transaction (see batch.py)
+    if not is_valid_folder_name(folder):
+        raise InvalidDirectoryError("Invalid directory")
+    folder_path = os.path.join(IMG_DIR, folder)
+    if not os.path.isdir(folder_path):
+        return jsonify({'error': 'Map not found'}), 404
+    data = request.get_json(silent=True)
+    operations = data.get('operations') if isinstance(data, dict) else data
+    atomic = isinstance(data, dict) and bool(data.get('atomic'))
+    if not isinstance(operations, list):
+        raise ValueError("Expected a JSON array of operations, or an object with an operations array")
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        raise ValueError(f"A batch can have at most {MAX_BATCH_OPERATIONS} operations")
+    db_path = os.path.join(folder_path, f'{folder}.db')
+    ensure_schema(db_path)
+
+    conn = get_db_connection(db_path)
+    try:
+        results, changed = apply_batch(conn, operations, atomic)
+        version = get_change_version(conn)
+    finally:
+        conn.close()
+    if 'markers' in changed:
+        cluster_cache.invalidate(db_path)
+    if changed:
+        map_written(db_path)
+
+    failed = sum(1 for result in results if not result['ok'])
+    status = 400 if atomic and failed else 200
+    return jsonify({'applied': len(results) - failed, 'failed': failed, 'version': version, 'results': results}), status
+
+STALLED_IMPORT_SECONDS = 120
+
+@app.route('/maps/<folder>/import', methods=['POST'])
+def import_map_features(folder):
+    # Queues an import of markers and lines from an uploaded CSV or GeoJSON file (see importer.py)
+    if not is_folder_name(folder):
+        raise InvalidDirectoryError("Invalid directory")
+    file = request.files.get('file')
+    if file is None or not file.filename:
+        raise ValueError("No file to import - send it as the file field of a multipart form")
+    fmt = check_format(request.values.get('format') or guess_format(file.filename))
+    folder_path = os.path.join(IMG_DIR, folder)
+    if not os.path.isdir(folder_path):
+        return jsonify({'error': 'Map not found'}), 404
+    db_path = os.path.join(folder_path, f'{folder}.db')
+
+    # The file is kept until the import is done, so an interrupted import can resume from it
+    incoming_dir = os.path.join(folder_path, INCOMING_DIR_NAME)
+    os.makedirs(incoming_dir, exist_ok=True)
+    path = os.path.join(incoming_dir, f'import-{uuid.uuid4().hex}{IMPORT_FORMATS[fmt]}')
+    file.save(path)
+    try:
+        import_id = create_import(db_path, secure_filename(file.filename), fmt, path)
+    except Exception:
+        os.remove(path)
+        raise
+    job_id = job_queue.submit('import_features', {'db_path': db_path, 'import_id': import_id})
+    return jsonify({'import_id': import_id, 'job_id': job_id, 'status_url': f'/maps/{folder}/imports/{import_id}'}), 202
+
+@app.route('/maps/<folder>/imports/<import_id>', methods=['GET'])
+def import_status(folder, import_id):
+    if not is_valid_folder_name(folder):
+        raise InvalidDirectoryError("Invalid directory")
+    result = get_import(os.path.join(IMG_DIR, folder, f'{folder}.db'), import_id)
+    if result is None:
+        return jsonify({'error': 'Import not found'}), 404
+    return jsonify(result)
+
+@app.route('/maps/<folder>/imports/<import_id>/resume', methods=['POST'])
+def resume_import(folder, import_id):
+    # Imports that were running when the server stopped resume by themselves; this restarts failed ones
+    if not is_valid_folder_name(folder):
+        raise InvalidDirectoryError("Invalid directory")
+    db_path = os.path.join(IMG_DIR, folder, f'{folder}.db')
+    result = get_import(db_path, import_id)
+    if result is None:
+        return jsonify({'error': 'Import not found'}), 404
+    # A running import checkpoints every batch - one that stopped doing so lost its worker
+    stalled = result['status'] == 'running' and time.time() - result['updated_at'] > STALLED_IMPORT_SECONDS
+    if result['status'] != 'failed' and not stalled:
+        return jsonify({'error': f"The import is {result['status']}"}), 409
+    job_id = job_queue.submit('import_features', {'db_path': db_path, 'import_id': import_id})
+    return jsonify({'import_id': import_id, 'job_id': job_id, 'status_url': f'/maps/{folder}/imports/{import_id}'}), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+def list_map_folders():
+    # Hidden directories like the blob store aren't maps, and aren't in the catalog
+    return map_catalog.folders()
+
+def map_databases():
+    image_directory = IMG_DIR
+    paths = {folder: os.path.join(image_directory, folder, f'{folder}.db') for folder in list_map_folders()}
+    return {folder: path for folder, path in paths.items() if os.path.isfile(path)}
+
+# db_path -> the index_search job indexing it, so a map that is still being indexed doesn't get another one
+search_index_jobs = {}
+
+def index_in_background(db_paths):
+    db_paths = [path for path in db_paths if search_index_jobs.get(path) is None
+                or (job_queue.get(search_index_jobs[path]) or {}).get('status') not in ('queued', 'running')]
+    if db_paths:
+        job_id = job_queue.submit('index_search', {'db_paths': db_paths})
+        for path in db_paths:
+            search_index_jobs[path] = job_id
+
+if RUN_BACKGROUND:
+    # Index the rows of maps that had them before they had a search index (or were changed by another version since)
+    try:
+        unindexed = [path for path in map_databases().values() if needs_indexing(path)]
+        if unindexed:
+            index_in_background(unindexed)
+    except OSError as e:
+        print(f"Error looking for maps to index: {e}")
+
+@app.route('/maps/<folder>/search', methods=['GET'])
+def search_maps(folder):
+    # ?q=<words>&limit=&offset= - ranked journals, markers and lines of the map, or of every map with all=true
+    if not is_valid_folder_name(folder):
+        raise InvalidDirectoryError("Invalid directory")
+    try:
+        limit = int(request.args['limit']) if request.args.get('limit') else DEFAULT_SEARCH_LIMIT
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        raise ValueError("limit and offset must be whole numbers")
+    if not 0 < limit <= MAX_SEARCH_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_SEARCH_LIMIT}")
+    if offset < 0:
+        raise ValueError("offset must not be negative")
+
+    if request.args.get('all', '').lower() in ('1', 'true', 'yes'):
+        db_paths = map_databases()
+    else:
+        db_paths = {folder: os.path.join(IMG_DIR, folder, f'{folder}.db')}
+    result = search(db_paths, request.args.get('q', ''), limit, offset)
+    if result['pending']:
+        # Rows a search doesn't index itself (e.g. a large map that was just migrated) are indexed by a job
+        index_in_background([path for path in db_paths.values() if needs_indexing(path)])
+    return jsonify({'q': request.args.get('q', ''), 'limit': limit, 'offset': offset, **result})
+
+@app.route('/maps', methods=['GET'])
+def map_list():
+    # The map picker: every map with its image, thumbnail and counts, straight from the catalog, and the
+    # contact sheet holding the thumbnails (?fmt=webp|jpeg) - the picker needs no other request but the sheet's
+    entries = map_catalog.maps()
+    sheet = contact_sheet_layout(request.args.get('fmt'), entries)
+    maps = []
+    for entry in entries:
+        # A thumbnail is made from the image, so the image's hash tells its versions apart too
+        thumbnail_url = catalog_file_url(entry, entry['thumbnail'], entry['image_sha256']) if entry['thumbnail'] else None
+        maps.append({'folder': entry['folder'],
+                     'image_url': '/' + catalog_image_url(entry) if entry['image'] else None,
+                     'thumbnail_url': '/' + thumbnail_url if thumbnail_url else None,
+                     'width': entry['width'], 'height': entry['height'], 'size': entry['image_size'],
+                     'markers': entry['markers'], 'lines': entry['lines'], 'journals': entry['journals'],
+                     'revision': entry['revision'],
+                     'sheet_offset': sheet['maps'].get(entry['folder'])})
+    return jsonify({'maps': maps, 'contact_sheet': sheet})
+
+def contact_sheet_layout(fmt, entries=None):
+    fmt = 'jpeg' if fmt == 'jpg' else (fmt or default_format())
+    layout = contact_sheet.current(entries)
+    digest, _ = contact_sheet.encoded(fmt)
+    return {'image_url': fingerprinted_url(f'/maps/contact_sheet.{SHEET_FORMATS[fmt]}', None, digest), **layout}
+
+@app.route('/maps/contact_sheet', methods=['GET'])
+def contact_sheet_info():
+    # The contact sheet's image URL, size and the [x, y] offset of each map's cell_size square in it
+    return jsonify(contact_sheet_layout(request.args.get('fmt')))
+
+@app.route('/maps/contact_sheet.<ext>', methods=['GET'])
+def contact_sheet_image(ext):
+    fmt = next((fmt for fmt, sheet_ext in SHEET_FORMATS.items() if sheet_ext == ext), None)
+    if fmt is None:
+        return jsonify({'error': 'Not found'}), 404
+    digest, body = contact_sheet.encoded(fmt)
+    return send_cached_data(body, digest, f'image/{fmt}')
+
 @app.route('/get_folders')
 def image_folders():
     try:
-        image_directory = os.path.join(app.root_path, 'img')
-        folder_list = [f for f in os.listdir(image_directory) if os.path.isdir(os.path.join(image_directory, f))]
+        folder_list = list_map_folders()
         return json.dumps(folder_list)
     except Exception as e:
         return render_template('error.html', error=str(e)), 500
@@ -811,9 +1544,12 @@ def image_folders():
 @app.route('/icons/<path:icon_name>')
 def serve_icon(icon_name):
     try:
-        icon_path = os.path.join(ICON_DIR, icon_name)
-        print(f"Serving icon: {icon_name} at {icon_path} ")
-        return send_file(icon_path, mimetype='image/svg+xml')
+        entry = icon_catalog.get(icon_name)
+        if entry is None:
+            raise FileNotFoundError(icon_name)
+        if entry.data is not None:
+            return send_cached_data(entry.data, entry.digest, 'image/svg+xml', last_modified=entry.mtime / 1e9)
+        return send_cached(os.path.join(ICON_DIR, icon_name), mimetype='image/svg+xml', digest=entry.digest)
     except FileNotFoundError:
         return render_template('error.html', error='File not found'), 404
     except Exception as e:
@@ -824,72 +1560,72 @@ def serve_icon(icon_name):
 
 @app.route('/export/<folder>', methods=['GET'])
 def export(folder):
-    
+    # ?format=csv|geojson|ndjson|arrow|parquet, ?kind=markers|lines to export one of them, ?compress=gzip for a .gz file
+
     # Validate the folder name
     if not is_valid_folder_name(folder):
         return jsonify({'error': 'Invalid folder name.'}), 400
 
     # Use the folder name to get the corresponding database
-    db_path = os.path.join(app.root_path, 'img', folder, f'{folder}.db')
+    db_path = os.path.join(IMG_DIR, folder, f'{folder}.db')
     
     # Check if the directory exists
     if not os.path.isdir(os.path.dirname(db_path)):
         return jsonify({'error': 'No image directory exists.'}), 400
-        
-    # Initialize the markers database
-    init_markers_db(db_path)
 
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    markers = c.execute('SELECT * FROM markers').fetchall()
-    lines = c.execute('SELECT * FROM lines').fetchall()  # Fetch data from lines table
-    conn.close()
+    kind = request.args.get('kind')
+    if kind not in (None, 'markers', 'lines'):
+        raise ValueError("kind must be markers or lines")
+    tables = [kind] if kind else ['markers', 'lines']
+    fmt = request.args.get('format', 'csv')
+    check_export(fmt, tables)
 
     # Check if there are any markers or lines
-    if not markers and not lines:
+    if not has_rows(db_path, tables):
         return jsonify({'error': 'No markers or lines data to export.'}), 400
 
-    def generate():
-        data = StringIO()
-        writer = csv.writer(data)
-        
-        # Write header
-        writer.writerow(['markerId', 'lat', 'lng', 'info', 'iconType', 'iconColor', 'markerNotes'])
-        
-        # Write data
-        for marker in markers:
-            writer.writerow([marker[0], marker[1], marker[2], marker[3], marker[4], marker[5], marker[6]])
-            yield data.getvalue()
-            data.seek(0)
-            data.truncate(0)
-
-        # Write header for lines
-        writer.writerow(['lineId', 'start_lat', 'start_lng', 'end_lat', 'end_lng', 'info', 'color', 'notes'])
-        
-        # Write data for lines
-        for line in lines:
-            writer.writerow([line[0], line[1], line[2], line[3], line[4], line[5], line[6], line[7]])
-            yield data.getvalue()
-            data.seek(0)
-            data.truncate(0)
-
-    return Response(generate(), mimetype='text/csv')
-
-
-def is_valid_folder_name(folder_name):
+    return export_response(db_path, tables, fmt, folder if kind is None else f'{folder}-{kind}')
+
+def export_response(db_path, tables, fmt, filename):
+    """Streams an export (see exports.py), gzipped for clients that accept it or as a .gz file with ?compress=gzip."""
+    mimetype, extension, _ = EXPORT_FORMATS[fmt]
+    filename = f'{filename}.{extension}'
+    compress = request.args.get('compress')
+    if compress not in (None, 'gzip'):
+        raise ValueError("compress must be gzip")
+    # Exports are compressed as they stream, which gzip (unlike brotli in bundles.py) does from the standard library.
+    # Parquet compresses its pages itself.
+    encode = not compress and fmt != 'parquet' and request.accept_encodings['gzip'] > 0
+    gzip = compress == 'gzip' or encode
+
+    response = Response(stream_export(db_path, tables, fmt, gzip=gzip), mimetype=mimetype)
+    if compress:
+        response.mimetype = 'application/gzip'
+        filename += '.gz'
+    elif encode:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+def is_folder_name(folder_name):
     # Check for directory traversal
     if '..' in folder_name or '/' in folder_name:
         return False
     # Check for invalid characters
-    if not re.match(r'^[\w-]+$', folder_name):
+    return bool(re.match(r'^[\w-]+$', folder_name))
+
+def is_valid_folder_name(folder_name):
+    if not is_folder_name(folder_name):
         return False
     # Check if the directory exists
-    if not os.path.isdir(os.path.join(app.root_path, 'img', folder_name)):
+    if not os.path.isdir(os.path.join(IMG_DIR, folder_name)):
         return False
     return True
 
 @app.route('/export_journals/<folder>', methods=['GET'])
 def export_journals(folder):
+    # Takes format and compress like /export/<folder> - csv, ndjson, arrow or parquet
     
     # Validate the folder name
     if not is_valid_folder_name(folder):
@@ -897,31 +1633,11 @@ def export_journals(folder):
         return redirect(url_for('index'))
 
     # Use the folder name to get the corresponding database
-    db_path = os.path.join(app.root_path, 'img', folder, f'{folder}.db')
-
-    # Initialize the journals database
-    init_journal_db(db_path)  # Make sure you have this function
-
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    journals = c.execute('SELECT * FROM journals').fetchall()
-    conn.close()
-
-    def generate():
-        data = StringIO()
-        writer = csv.writer(data)
-        
-        # Write header for journals
-        writer.writerow(['journalId', 'entry_date', 'linked_item_id', 'entry_title', 'entry_content'])
-        
-        # Write data for journals
-        for journal in journals:
-            writer.writerow([journal[0], journal[1], journal[2], journal[3], journal[4]])
-            yield data.getvalue()
-            data.seek(0)
-            data.truncate(0)
+    db_path = os.path.join(IMG_DIR, folder, f'{folder}.db')
 
-    return Response(generate(), mimetype='text/csv')
+    fmt = request.args.get('format', 'csv')
+    check_export(fmt, ['journals'])
+    return export_response(db_path, ['journals'], fmt, f'{folder}-journals')
 
 @app.route('/backup', methods=['POST'])
 def backup():
@@ -932,18 +1648,14 @@ def backup():
         flash('Invalid directory name.', 'danger')
         return redirect(url_for('index'))
     try:
-        selected_dir = request.form.get('directory')
-        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        backup_filename = f"{selected_dir}_{timestamp}.tar.gz"
-        backup_path = os.path.join(app.root_path, 'backups', backup_filename)
-        
-        with tarfile.open(backup_path, "w:gz") as tar:
-            tar.add(os.path.join(app.root_path, 'img', selected_dir), arcname=os.path.basename(selected_dir))
-            db_file_path = os.path.join(app.root_path, 'img', selected_dir+'.db')
-            if os.path.exists(db_file_path):
-                tar.add(db_file_path, arcname=os.path.basename(selected_dir+'.db'))
+        folder_path = os.path.join(IMG_DIR, selected_dir)
 
-        return {'status': 'success', 'filename': backup_filename}, 200
+        # Only what changed since the last snapshot is stored - tiles are a cache rebuilt from the map image
+        # on demand, and pending uploads are left out too
+        snapshot = snapshot_store.create(selected_dir, folder_path, os.path.join(folder_path, f'{selected_dir}.db'),
+                                         exclude_dirs=(TILE_DIR_NAME, INCOMING_DIR_NAME))
+
+        return {'status': 'success', 'filename': snapshot['name'], 'size': snapshot['size'], 'stored': snapshot['stored']}, 200
 
     except Exception as e:
         print(f"Error creating backup: {e}")
@@ -951,74 +1663,75 @@ def backup():
 
 @app.route('/restore', methods=['POST'])
 def restore():
+    # Checks the backup and queues the restore as a background job - follow it with /restore/<job_id>
     try:
         backup_file = request.form.get('backup_file')
-        backup_path = os.path.join(app.root_path, 'backups', backup_file)
+        if not backup_file or os.path.basename(backup_file) != backup_file or not is_backup(backup_file):
+            return {'status': 'error', 'message': 'Invalid backup file name'}, 400
+        backup_path = os.path.join(BACKUP_DIR, backup_file)
 
         if not os.path.exists(backup_path):
             return {'status': 'error', 'message': 'Backup file not found'}, 404
 
-        with tarfile.open(backup_path, "r:gz") as tar:
-            for member in tar.getmembers():
-                # Prevent directory traversal
-                if os.path.isabs(member.name) or ".." in member.name:
-                    return {'status': 'error', 'message': 'Backup contains invalid paths'}, 400
-                
-                if member.type == tarfile.DIRTYPE and os.path.exists(os.path.join(app.root_path, 'img', member.name)):
-                    # Directory with the same name exists
-                    return {'status': 'error', 'message': 'A directory with the same name already exists. Please rename or delete it before proceeding.'}, 409
-
-            # If there's no conflict, extract the backup
-            tar.extractall(path=os.path.join(app.root_path, 'img'))
-
-        return {'status': 'success'}, 200
+        # A tarball's contents are only known once it is read, so the job checks them (and for conflicts) as it extracts
+        folder = tarball_folder(backup_file)
+        if is_snapshot(backup_file):
+            try:
+                folder = snapshot_store.check(backup_file)['folder']
+            except ValueError as e:
+                return {'status': 'error', 'message': str(e)}, 400
+        if folder and os.path.exists(os.path.join(IMG_DIR, folder)):
+            # Directory with the same name exists
+            return {'status': 'error', 'message': 'A directory with the same name already exists. Please rename or delete it before proceeding.'}, 409
+        if folder:
+            # Pooled connections could still point at the database of a deleted map of the same name
+            db_path = os.path.join(IMG_DIR, folder, f'{folder}.db')
+            connection_manager.close_database(db_path)
+            schema_registry.forget(db_path)
+
+        job_id = job_queue.submit('restore_backup', {
+            'backups_dir': BACKUP_DIR,
+            'img_dir': IMG_DIR,
+            'backup_file': backup_file,
+            'workers': app.config['BACKUP_WORKERS']
+        })
+        return {'status': 'queued', 'job_id': job_id, 'status_url': f'/restore/{job_id}'}, 202
 
     except Exception as e:
         print(f"Error restoring backup: {e}")
         return {'status': 'error', 'message': str(e)}, 500
 
+@app.route('/restore/<job_id>', methods=['GET'])
+def restore_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None or job['kind'] != 'restore_backup':
+        return jsonify({'error': 'Restore not found'}), 404
+    return jsonify(job)
+
 @app.route('/backups')
 def backups():
+    # Listed from the backup index (see backups.py), newest first
     try:
-        backup_directory = os.path.join(app.root_path, 'backups')
-        backup_files = [f for f in os.listdir(backup_directory) if os.path.isfile(os.path.join(backup_directory, f))]
-        return json.dumps(backup_files)
+        return jsonify(snapshot_store.list_backups())
     except Exception as e:
         return render_template('error.html', error=str(e)), 500
 
+@app.route('/backups/<backup_file>', methods=['DELETE'])
+def delete_backup(backup_file):
+    # Chunks that only this snapshot used are deleted with it, those shared with other snapshots stay
+    try:
+        chunks = snapshot_store.delete(backup_file)
+    except FileNotFoundError:
+        return {'status': 'error', 'message': 'Backup file not found'}, 404
+    return {'status': 'success', 'filename': backup_file, 'chunks_deleted': chunks}, 200
+
 @app.errorhandler(ValueError)
 def handle_invalid_directory(error):
     return jsonify(error=str(error)), 400
 
-def init_journal_db(db_path):
-    conn = None
-    try:
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS journals (
-                id TEXT PRIMARY KEY,
-                entry_date TEXT NOT NULL,
-                linked_item_id TEXT,
-                entry_title TEXT NOT NULL,
-                entry_content TEXT NOT NULL,
-                is_favorite TEXT NOT NULL DEFAULT 'no'  -- Add the new column with a default value
-            )
-        ''')
-
-        conn.commit()
-        print(f"init_journal_db() will attempt to create a 'journals' table in the database, if the table does not exist : {db_path}")
-
-    except Exception as e:
-        print(f"Error initializing journal database: {e}")
-    finally:
-        if conn:
-            conn.close()
-
 @app.route('/journals/<selected_dir>', methods=['GET', 'POST'])
 def journals(selected_dir=None):
-    image_base_path = os.path.join(app.root_path, 'img')
+    image_base_path = IMG_DIR
 
     if selected_dir is not None:
         print(f"selected_dir: {selected_dir}")
@@ -1038,11 +1751,10 @@ def journals(selected_dir=None):
             # Pass the folder name to get_journals function
             return get_journals(image_folder=selected_dir)
         elif request.method == 'POST':
-            # Call init_journal_db before adding a new journal entry
+            # Make sure the journals table exists before adding a new journal entry
             image_folder = session.get('image_folder', get_image_folder_path())
-            db_path = os.path.join(app.root_path, 'img', image_folder, f'{image_folder}.db')
-            print(f"initializing database {image_folder}")
-            init_journal_db(db_path)
+            db_path = os.path.join(IMG_DIR, image_folder, f'{image_folder}.db')
+            ensure_schema(db_path)
 
             data = request.get_json()
             entry_title = data['entry_title']
@@ -1052,17 +1764,20 @@ def journals(selected_dir=None):
             # Generate a UUID for the new journal entry
             journal_id = str(uuid.uuid4())
     
-            # Get the current date and time
-            from datetime import datetime
-            current_date = datetime.now().strftime('%B %d, %Y %H:%M')
+            # Get the current date and time - shown as entry_date, sorted and filtered by entry_time
+            now = datetime.now()
+            current_date = now.strftime(JOURNAL_DATE_FORMAT)
 
-            conn = sqlite3.connect(db_path)
+            conn = get_db_connection(db_path)
             c = conn.cursor()
-            c.execute('INSERT INTO journals (id, entry_date, linked_item_id, entry_title, entry_content, is_favorite) VALUES (?, ?, ?, ?, ?, ?)', (journal_id, current_date, linked_item_id, entry_title, entry_content, is_favorite))
+            c.execute('INSERT INTO journals (id, entry_date, entry_time, linked_item_id, entry_title, entry_content, is_favorite) VALUES (?, ?, ?, ?, ?, ?, ?)', (journal_id, current_date, int(now.timestamp()), linked_item_id, entry_title, entry_content, is_favorite))
 
             conn.commit()
+            map_written(db_path)
             return jsonify({'journal_id': journal_id}), 200
 
+    except ValueError:
+        raise  # invalid paging parameters, answered with a 400
     except Exception as e:
         print(f"Error adding journal: {e}")
         return "", 500
@@ -1074,16 +1789,16 @@ def journals(selected_dir=None):
 def journal_entry(folder, id):
     
     # Safety check on path
-    image_base_path = os.path.join(app.root_path, 'img')
+    image_base_path = IMG_DIR
     if not is_safe_path(image_base_path, folder):
         raise InvalidDirectoryError("Invalid directory")
 
-    db_path = os.path.join(app.root_path, 'img', folder, f'{folder}.db')
+    db_path = os.path.join(IMG_DIR, folder, f'{folder}.db')
 
-    # Initialize the journal database
-    init_journal_db(db_path)
+    # Make sure the database has the current schema
+    ensure_schema(db_path)
 
-    conn = sqlite3.connect(db_path)
+    conn = get_db_connection(db_path)
     c = conn.cursor()
 
     if request.method == 'GET':
@@ -1103,6 +1818,9 @@ def journal_entry(folder, id):
                 'entry_content': journal[4],
                 'is_favorite': journal[5]
             }
+            # The linked markers and lines come along, so the journal page doesn't request them one by one
+            refs = parse_item_refs(journal[2])
+            journal_entry['linked_items'] = linked_items(refs, lookup_items(conn, refs))
             
             return jsonify(journal_entry)
 
@@ -1124,6 +1842,7 @@ def journal_entry(folder, id):
             # Validate user inputs 
             c.execute('UPDATE journals SET entry_title=?, entry_content=?, linked_item_id=?, is_favorite=? WHERE id=?', (entry_title, entry_content, linked_item_id, is_favorite, id))
             conn.commit()
+            map_written(db_path)
 
             print(f"Journal Updated")
             return 'OK', 200
@@ -1136,40 +1855,149 @@ def journal_entry(folder, id):
             if conn:
                 conn.close()
 
+DEFAULT_JOURNAL_LIMIT = 50
+MAX_JOURNAL_LIMIT = 500
+EXCERPT_LENGTH = 200
+EXCERPT_SOURCE_LENGTH = 4000  # HTML read for the excerpt of a journal the search index doesn't have yet
+# sort -> the columns /journals/<dir> pages by (the keyset a cursor holds, id breaks ties) and their direction.
+# Favorites come first because 'yes' sorts after 'no'.
+JOURNAL_SORTS = {
+    'newest': (('entry_time', 'id'), 'DESC'),
+    'oldest': (('entry_time', 'id'), 'ASC'),
+    'favorites': (('is_favorite', 'entry_time', 'id'), 'DESC')
+}
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, length):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, UnicodeDecodeError):
+        values = None
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("Invalid cursor - pass the next_cursor of the previous page as it is")
+    return values
+
+def journal_time_bound(value, name, end=False):
+    """
+    The entry_time bound of a from/to parameter: epoch seconds, or an ISO-8601 date or time (local time
+    unless it has an offset). to is inclusive - a date includes the whole day - so its bound is exclusive.
+    """
+    if re.fullmatch(r'-?\d+', value):
+        return int(value) + 1 if end else int(value)
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an ISO-8601 date or time (e.g. 2024-05-04) or epoch seconds")
+    if not end:
+        return int(parsed.timestamp())
+    return int((parsed + timedelta(days=1)).timestamp()) if len(value) == 10 else int(parsed.timestamp()) + 1
+
+def excerpt(text):
+    if len(text) <= EXCERPT_LENGTH:
+        return text
+    return text[:EXCERPT_LENGTH].rsplit(' ', 1)[0] + '…'
+
 def get_journals(image_folder=None):
+    """
+    A page of the map's journals for ?limit=&cursor=&sort=newest|oldest|favorites&favorite=yes|no&from=&to=.
+    Each journal is a summary - title, date, an excerpt of the text and the number of linked items -
+    unless full=true asks for entry_content and linked_items too. Pages are read with a keyset on an
+    index, so a page costs the same however many journals the map has.
+    """
+    sort = request.args.get('sort', 'newest')
+    if sort not in JOURNAL_SORTS:
+        raise ValueError(f"sort must be one of {', '.join(JOURNAL_SORTS)}")
+    try:
+        limit = int(request.args['limit']) if request.args.get('limit') else DEFAULT_JOURNAL_LIMIT
+    except ValueError:
+        raise ValueError("limit must be a whole number")
+    if not 0 < limit <= MAX_JOURNAL_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_JOURNAL_LIMIT}")
+    full = request.args.get('full', '').lower() in ('1', 'true', 'yes')
+    keyset, direction = JOURNAL_SORTS[sort]
+
+    conditions = []
+    params = []
+    favorite = request.args.get('favorite')
+    if favorite:
+        if favorite not in ('yes', 'no'):
+            raise ValueError("favorite must be yes or no")
+        conditions.append("is_favorite = 'yes'" if favorite == 'yes' else "is_favorite != 'yes'")
+    if request.args.get('from'):
+        conditions.append('entry_time >= ?')
+        params.append(journal_time_bound(request.args['from'], 'from'))
+    if request.args.get('to'):
+        conditions.append('entry_time < ?')
+        params.append(journal_time_bound(request.args['to'], 'to', end=True))
+    if request.args.get('cursor'):
+        conditions.append(f"({', '.join(keyset)}) {'<' if direction == 'DESC' else '>'} ({', '.join('?' * len(keyset))})")
+        params.extend(decode_cursor(request.args['cursor'], len(keyset)))
+
     conn = None
     try:
         if image_folder is None:
             image_folder = get_image_folder_path()
 
         image_folder = session.get('image_folder', image_folder)
-        db_path = os.path.join(app.root_path, 'img', image_folder, f'{image_folder}.db')
-
-        # Initialize the journal database
-        init_journal_db(db_path)
-
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        c.execute('SELECT * FROM journals')
-        journals = c.fetchall()
-
-        # Convert the tuples to JSON objects
-        journal_list = [
-            {
-                'id': journal[0],
-                'entry_date': journal[1],
-                'linked_item_id': journal[2],
-                'entry_title': journal[3],
-                'entry_content': journal[4],
-                'is_favorite': journal[5]
-            } for journal in journals
-        ]
-        return jsonify(journal_list)  # Return the JSON object
+        db_path = os.path.join(IMG_DIR, image_folder, f'{image_folder}.db')
+
+        # Make sure the database has the current schema
+        ensure_schema(db_path)
+
+        conn = get_db_connection(db_path)
+        # Summaries take their excerpt from the search index, which has the text without its HTML (and images),
+        # unless the journal changed since it was indexed
+        doc = f"j.rowid * 4 + {SEARCH_COLUMNS['journals'][0]}"
+        indexed = 's.rowid IS NOT NULL AND p.doc IS NULL'
+        content = 'j.entry_content' if full else f'CASE WHEN NOT ({indexed}) THEN substr(j.entry_content, 1, {EXCERPT_SOURCE_LENGTH}) END'
+        rows = conn.execute(f"""SELECT j.id, j.entry_date, j.entry_time, j.entry_title, j.is_favorite, j.linked_item_id,
+                                       CASE WHEN {indexed} THEN substr(s.body, 1, {EXCERPT_LENGTH + 1}) END, {content}
+                                FROM journals j
+                                LEFT JOIN search_index s ON s.rowid = {doc}
+                                LEFT JOIN search_pending p ON p.doc = {doc}
+                                {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+                                ORDER BY {', '.join(f'j.{column} {direction}' for column in keyset)}
+                                LIMIT ?""", params + [limit + 1]).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+
+        journal_list = []
+        refs = {}
+        for journal_id, entry_date, entry_time, entry_title, is_favorite, linked_item_id, text, entry_content in rows:
+            refs[journal_id] = parse_item_refs(linked_item_id)
+            journal = {
+                'id': journal_id,
+                'entry_date': entry_date,
+                'entry_time': datetime.fromtimestamp(entry_time).astimezone().isoformat(),
+                'entry_title': entry_title,
+                'is_favorite': is_favorite,
+                'linked_item_id': linked_item_id,
+                'link_count': len(refs[journal_id]),
+                'excerpt': excerpt(text if text is not None else strip_html(entry_content))
+            }
+            if full:
+                journal['entry_content'] = entry_content
+            journal_list.append(journal)
+
+        if full:
+            # The markers and lines the journals link to, looked up all at once
+            found = lookup_items(conn, [ref for journal_refs in refs.values() for ref in journal_refs])
+            for journal in journal_list:
+                journal['linked_items'] = linked_items(refs[journal['id']], found)
+
+        next_cursor = None
+        if more:
+            last = rows[-1]
+            values = {'id': last[0], 'entry_time': last[2], 'is_favorite': last[4]}
+            next_cursor = encode_cursor([values[column] for column in keyset])
+        return jsonify({'journals': journal_list, 'next_cursor': next_cursor, 'sort': sort, 'limit': limit})
 
     except sqlite3.OperationalError as e:
         app.logger.error(f"Error getting journals from database: {e}")
         app.logger.error(traceback.format_exc())
-        return jsonify([])  # Return an empty list as a JSON object
+        return jsonify({'journals': [], 'next_cursor': None, 'sort': sort, 'limit': limit})
     finally:
         if conn:
             conn.close()
@@ -1185,12 +2013,13 @@ def update_journal():
         linked_item_id = data['linked_item_id']
         is_favorite = data['is_favorite']
         image_folder = session.get('image_folder', get_image_folder_path())
-        db_path = os.path.join(app.root_path, 'img', image_folder, f'{image_folder}.db')
+        db_path = os.path.join(IMG_DIR, image_folder, f'{image_folder}.db')
 
-        conn = sqlite3.connect(db_path)
+        conn = get_db_connection(db_path)
         c = conn.cursor()
         c.execute('UPDATE journals SET entry_title=?, entry_content=?, linked_item_id=?, is_favorite=? WHERE id=?', (entry_title, entry_content, linked_item_id, is_favorite, journal_id))
         conn.commit()
+        map_written(db_path)
 
         print(f"Journal Updated")
         return 'OK', 200
@@ -1209,12 +2038,13 @@ def delete_journal():
         data = request.get_json()
         journal_id = data['id']
         image_folder = session.get('image_folder', get_image_folder_path())
-        db_path = os.path.join(app.root_path, 'img', image_folder, f'{image_folder}.db')
+        db_path = os.path.join(IMG_DIR, image_folder, f'{image_folder}.db')
 
-        conn = sqlite3.connect(db_path)
+        conn = get_db_connection(db_path)
         c = conn.cursor()
         c.execute('DELETE FROM journals WHERE id=?', (journal_id,))
         conn.commit()
+        map_written(db_path)
 
         print(f"Journal {journal_id} deleted")
         return 'OK', 200
@@ -1226,16 +2056,13 @@ def delete_journal():
         if conn:
             conn.close()
 
-def save_dng_raw_image_as_jpeg(image, file_directory, filename):
-    with rawpy.imread(image) as raw:
-        rgb = raw.postprocess()
-    imageio.imsave(os.path.join(file_directory, filename), rgb)
-    thumbnail_filename = f"thumbnail-{os.path.splitext(filename)[0]}.png"
-    create_thumbnail(os.path.join(file_directory, filename), os.path.join(file_directory, thumbnail_filename), (200, 200))
-    print("New .dng or .raw image saved as .jpg and thumbnail image saved")
-
 @app.route('/upload_image', methods=['POST'])
 def upload_image():
+    # check the size of the request before the form is parsed, so oversized bodies are never read
+    max_size = 5 * 1024 * 1024  # 5MB size limit for journal pics
+    if request.content_length is None or request.content_length > max_size:
+        return jsonify({'status': 'File size must be less than 5MB'}), 400
+
     # check if the post request has the file part
     if 'image' not in request.files:
         return jsonify({'status': 'No image part in the request'}), 400
@@ -1246,16 +2073,12 @@ def upload_image():
         return jsonify({'status': 'No image selected for uploading'}), 400
 
     if image and allowed_file(image.filename):
-        # check the size of the file
-        max_size = 5 * 1024 * 1024  # 5MB size limit for journal pics
-        if request.content_length > max_size:
-            return jsonify({'status': 'File size must be less than 1MB'}), 400
 
         filename = secure_filename(image.filename)
         image_folder = get_image_folder_path()
 
         # ensure that the images subfolder exists
-        images_subfolder = os.path.join(app.root_path, 'img', image_folder, 'images')
+        images_subfolder = os.path.join(IMG_DIR, image_folder, 'images')
         if not os.path.exists(images_subfolder):
             os.makedirs(images_subfolder)
 
@@ -1266,7 +2089,9 @@ def upload_image():
         if not is_safe_path(images_subfolder, filename):
             raise InvalidDirectoryError("Invalid directory")
 
-        image.save(filepath)
+        save_replacing(image, str(filepath))
+        # the same picture attached to several journals is only stored once
+        blob_store.add_file(str(filepath), 'journal')
 
         # build a url for the uploaded image file
         # use 'serve_image' route and the path relative to the 'img' folder
@@ -0,0 +1,66 @@
+"""
+Imports markers and lines into a map from a CSV file (the format /export/<folder> writes) or GeoJSON,
+straight into the map's database - the server doesn't have to be running.
+
+    python import_features.py <folder> <file> [--format csv|geojson]
+    python import_features.py <folder> --resume <import id>
+
+An interrupted import (Ctrl+C, a crash) continues from its last checkpoint with --resume.
+"""
+
+import os
+import sys
+import argparse
+
+# Only the import runs in this process - the job queue and file watchers belong to the server
+os.environ['GOGROW_BACKGROUND'] = 'false'
+
+from gogrow_app import app
+from gogrow_app.importer import create_import, get_import, run_import, guess_format, IMPORT_FORMATS
+
+def main():
+    parser = argparse.ArgumentParser(description='Import markers and lines from a CSV or GeoJSON file into a GoGrow map.')
+    parser.add_argument('folder', help='the map folder (in gogrow_app/img)')
+    parser.add_argument('file', nargs='?', help='the CSV or GeoJSON file')
+    parser.add_argument('--format', choices=IMPORT_FORMATS, help='the file format (default: from the file extension)')
+    parser.add_argument('--resume', metavar='IMPORT_ID', help='continue an interrupted import')
+    args = parser.parse_args()
+
+    folder_path = os.path.join(app.config['IMG_DIR'], args.folder)
+    if not os.path.isdir(folder_path):
+        parser.error(f"No map folder {folder_path}")
+    db_path = os.path.join(folder_path, f'{args.folder}.db')
+
+    if args.resume:
+        import_id = args.resume
+        if get_import(db_path, import_id) is None:
+            parser.error(f"No import {import_id} in {args.folder}")
+    elif args.file:
+        try:
+            fmt = args.format or guess_format(args.file)
+        except ValueError as e:
+            parser.error(str(e))
+        import_id = create_import(db_path, os.path.basename(args.file), fmt, args.file)
+    else:
+        parser.error("Give the file to import, or --resume with an import id")
+    print(f"Import {import_id} - if it is interrupted, continue it with --resume {import_id}")
+
+    def report_progress(progress, message=None):
+        print(f"\r{progress:6.1%}  {message or ''}", end='', flush=True)
+
+    try:
+        result = run_import(db_path, import_id, report_progress)
+    except KeyboardInterrupt:
+        print(f"\nStopped - continue with: python import_features.py {args.folder} --resume {import_id}")
+        return 1
+    except ValueError as e:
+        print(f"\nImport failed: {e}")
+        return 1
+
+    print(f"\nDone: {result['inserted']} imported, {result['failed']} failed of {result['records']} records")
+    for error in result['errors']:
+        print(f"  record {error['record']}: {error['error']}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
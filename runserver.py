@@ -4,10 +4,12 @@ This script runs the gogrow_app application using a Waitress server.
 
 from os import environ
 from gogrow_app import app
+from gogrow_app.views import job_queue, RUN_BACKGROUND
 import logging
 from logging.handlers import RotatingFileHandler
 import os
 import sys
+import multiprocessing
 import psutil
 import webbrowser
 import time
@@ -165,6 +167,8 @@ def open_browser_and_start_logging(url, use_default):
         logger.error(f"An error occurred while opening the web browser: {e}")
 
 if __name__ == '__main__':
+    # Needed by the image processing worker processes when running as a frozen (PyInstaller) executable
+    multiprocessing.freeze_support()
     print(Back.GREEN + Fore.WHITE + Style.BRIGHT + "Starting GoGrow App server setup...")
     HOST, PORT = get_server_parameters()
     logger.info(Fore.GREEN + f"Starting the server at {HOST}:{PORT}")
@@ -175,6 +179,10 @@ if __name__ == '__main__':
     # Determine if default settings are used
     use_default_settings = HOST == 'localhost' and PORT == 5555
 
+    # Run the queued jobs, and those left over from the last run
+    if RUN_BACKGROUND:
+        job_queue.start()
+
     # Start the server in a separate thread
     try:
         server_thread = Timer(0, waitress_serve, kwargs={'app': app, 'host': HOST, 'port': PORT})
@@ -0,0 +1,42 @@
+import os
+import sys
+import uuid
+import shutil
+import tempfile
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# The maps, backups and caches of a test run go to a data directory of its own (see GOGROW_DATA_DIR
+# in settings.py), never to the app's img/ - it has to be set before the app is imported
+DATA_DIR = tempfile.mkdtemp(prefix='gogrow_tests_')
+os.environ['GOGROW_DATA_DIR'] = DATA_DIR
+# No job workers, watchers or startup jobs unless a test asks for them
+os.environ['GOGROW_BACKGROUND'] = 'false'
+
+from gogrow_app import app  # also imports views.py, which registers the routes
+
+def pytest_unconfigure(config):
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    return app.test_client()
+
+@pytest.fixture
+def map_folder():
+    """A map folder of its own in the test run's img/, removed afterwards - yields (folder, db_path)."""
+    folder = f'test_{uuid.uuid4().hex[:12]}'
+    folder_path = os.path.join(app.config['IMG_DIR'], folder)
+    os.makedirs(folder_path)
+    try:
+        yield folder, os.path.join(folder_path, f'{folder}.db')
+    finally:
+        shutil.rmtree(folder_path, ignore_errors=True)
+
+@pytest.fixture
+def job_workers():
+    """Runs the app's queued jobs - runserver.py starts the queue, the tests that wait for jobs ask for it."""
+    from gogrow_app.views import job_queue
+    job_queue.start()
+    return job_queue
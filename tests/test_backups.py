@@ -0,0 +1,190 @@
+import io
+import os
+import json
+import shutil
+import tarfile
+import sqlite3
+import pytest
+from gogrow_app import app, backups
+from gogrow_app.backups import SnapshotStore, CHUNK_SIZE, restore_tarball, swap_in
+from gogrow_app.database import ensure_schema, get_db_connection
+from test_jobs import wait_for
+
+def chunk_files(store):
+    return {name for _, _, names in os.walk(store.chunk_root) for name in names}
+
+def make_map(folder_path, image=b'first image'):
+    folder_path.mkdir()
+    (folder_path / 'shared.bin').write_bytes(os.urandom(CHUNK_SIZE + 10))
+    (folder_path / 'map.png').write_bytes(image)
+
+def test_snapshots_store_only_what_changed(tmp_path):
+    store = SnapshotStore(str(tmp_path / 'backups'), workers=2)
+    folder_path = tmp_path / 'garden'
+    make_map(folder_path)
+    first = store.create('garden', str(folder_path), str(folder_path / 'garden.db'))
+    assert first['stored'] > CHUNK_SIZE // 2 and len(chunk_files(store)) == 3
+
+    assert store.create('garden', str(folder_path), str(folder_path / 'garden.db'))['stored'] == 0
+    (folder_path / 'map.png').write_bytes(b'second image, longer')
+    third = store.create('garden', str(folder_path), str(folder_path / 'garden.db'))
+    assert 0 < third['stored'] < 100
+    assert len(chunk_files(store)) == 4
+    assert len(store.snapshots('garden')) == 3
+
+def test_snapshot_restores_the_map_and_its_database(tmp_path):
+    store = SnapshotStore(str(tmp_path / 'backups'))
+    folder_path = tmp_path / 'garden'
+    make_map(folder_path)
+    db_path = str(folder_path / 'garden.db')
+    ensure_schema(db_path)
+    conn = get_db_connection(db_path)
+    conn.execute("INSERT INTO journals (id, entry_date, entry_title, entry_content) VALUES ('j1', 'May 04, 2024 09:30', 'Planted', '')")
+    conn.commit()
+    conn.close()
+    snapshot = store.create('garden', str(folder_path), db_path, exclude_dirs=('tiles',))
+
+    store.restore(snapshot['name'], str(tmp_path / 'restored'))
+    assert sorted(os.listdir(tmp_path / 'restored')) == ['garden.db', 'map.png', 'shared.bin']
+    restored = sqlite3.connect(str(tmp_path / 'restored' / 'garden.db'))
+    assert restored.execute('SELECT entry_title FROM journals').fetchall() == [('Planted',)]
+    restored.close()
+
+def test_deleting_a_snapshot_collects_only_its_own_chunks(tmp_path):
+    store = SnapshotStore(str(tmp_path / 'backups'), workers=2)
+    folder_path = tmp_path / 'garden'
+    make_map(folder_path)
+    first = store.create('garden', str(folder_path), str(folder_path / 'garden.db'))
+    (folder_path / 'map.png').write_bytes(b'second image, longer')
+    second = store.create('garden', str(folder_path), str(folder_path / 'garden.db'))
+    assert len(chunk_files(store)) == 4
+
+    assert store.delete(first['name']) == 1
+    assert len(chunk_files(store)) == 3
+    assert [backup['name'] for backup in store.list_backups()] == [second['name']]
+
+    # The snapshot that's left still restores in full
+    store.restore(second['name'], str(tmp_path / 'restored'))
+    assert (tmp_path / 'restored' / 'map.png').read_bytes() == b'second image, longer'
+    assert (tmp_path / 'restored' / 'shared.bin').read_bytes() == (folder_path / 'shared.bin').read_bytes()
+
+def test_delete_rejects_unknown_and_invalid_names(tmp_path):
+    store = SnapshotStore(str(tmp_path / 'backups'))
+    with pytest.raises(ValueError):
+        store.delete('../garden.db')
+    with pytest.raises(FileNotFoundError):
+        store.delete('garden_2024-01-01_00-00-00.snapshot.json')
+
+def test_garbage_collection_waits_for_other_processes(tmp_path, monkeypatch):
+    store = SnapshotStore(str(tmp_path / 'backups'))
+    store.collect_garbage()
+    # Another process (a second store on the same folder) in the middle of a snapshot
+    other = sqlite3.connect(str(tmp_path / 'backups' / backups.LOCK_FILE_NAME))
+    other.execute('BEGIN IMMEDIATE')
+    monkeypatch.setattr(backups, 'LOCK_TIMEOUT', 0.1)
+    with pytest.raises(sqlite3.OperationalError):
+        store.collect_garbage()
+    other.rollback()
+    assert store.collect_garbage() == 0
+    other.close()
+
+def write_tarball(path, members):
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+def test_index_lists_snapshots_and_tarballs(tmp_path):
+    store = SnapshotStore(str(tmp_path / 'backups'))
+    folder_path = tmp_path / 'garden'
+    make_map(folder_path)
+    snapshot = store.create('garden', str(folder_path), str(folder_path / 'garden.db'))
+    tarball = str(tmp_path / 'backups' / 'farm_2023-01-01_00-00-00.tar.gz')
+    write_tarball(tarball, [('farm/map.png', b'old')])
+    os.utime(tarball, (1672531200, 1672531200))
+    listed = store.list_backups()
+    assert [(backup['name'], backup['kind'], backup['folder']) for backup in listed] == [
+        (snapshot['name'], 'snapshot', 'garden'), ('farm_2023-01-01_00-00-00.tar.gz', 'tarball', 'farm')]
+    assert listed[0]['files'] == 2 and listed[0]['size'] == CHUNK_SIZE + 10 + len(b'first image')
+
+def test_preflight_check_finds_damaged_snapshots(tmp_path):
+    store = SnapshotStore(str(tmp_path / 'backups'))
+    folder_path = tmp_path / 'garden'
+    make_map(folder_path)
+    name = store.create('garden', str(folder_path), str(folder_path / 'garden.db'))['name']
+    assert store.check(name)['folder'] == 'garden'
+    manifest_path = tmp_path / 'backups' / name
+    manifest = json.loads(manifest_path.read_text())
+    manifest['files'][0]['path'] = '../escape.bin'
+    manifest_path.write_text(json.dumps(manifest))
+    with pytest.raises(ValueError, match='invalid paths'):
+        store.check(name)
+    manifest['files'][0]['path'] = 'map.png'
+    manifest['files'][0]['chunks'].append('0' * 64)
+    manifest_path.write_text(json.dumps(manifest))
+    with pytest.raises(ValueError, match='1 of its chunks are missing'):
+        store.check(name)
+    assert not os.path.exists(tmp_path / 'restored')
+
+def test_tarballs_are_streamed_and_checked(tmp_path):
+    path = str(tmp_path / 'farm.tar.gz')
+    write_tarball(path, [('farm/map.png', b'old map'), ('farm/farm.db', b'database')])
+    progress = []
+    restore_tarball(path, str(tmp_path / 'restored'), lambda done, total: progress.append((done, total)))
+    assert (tmp_path / 'restored' / 'farm' / 'map.png').read_bytes() == b'old map'
+    assert progress[-1][1] == os.path.getsize(path)
+
+    write_tarball(path, [('farm/map.png', b'old map'), ('../escape.png', b'nope')])
+    with pytest.raises(ValueError):
+        restore_tarball(path, str(tmp_path / 'escaped'))
+    assert not os.path.exists(tmp_path / 'escape.png')
+
+def test_swap_in_moves_nothing_on_a_conflict(tmp_path):
+    staging, img_dir = tmp_path / 'staging', tmp_path / 'img'
+    (staging / 'garden').mkdir(parents=True)
+    (staging / 'farm').mkdir()
+    (img_dir / 'farm').mkdir(parents=True)
+    with pytest.raises(ValueError, match='farm'):
+        swap_in(str(staging), str(img_dir))
+    assert os.listdir(img_dir) == ['farm']
+    shutil.rmtree(img_dir / 'farm')
+    assert sorted(swap_in(str(staging), str(img_dir))) == ['farm', 'garden']
+
+def test_restore_waits_for_garbage_collection_in_other_processes(tmp_path, monkeypatch):
+    store = SnapshotStore(str(tmp_path / 'backups'))
+    folder_path = tmp_path / 'garden'
+    make_map(folder_path)
+    name = store.create('garden', str(folder_path), str(folder_path / 'garden.db'))['name']
+    other = sqlite3.connect(str(tmp_path / 'backups' / backups.LOCK_FILE_NAME))
+    other.execute('BEGIN IMMEDIATE')
+    monkeypatch.setattr(backups, 'LOCK_TIMEOUT', 0.1)
+    # A second store, as the restore job has, doesn't share the first one's thread lock
+    with pytest.raises(sqlite3.OperationalError):
+        SnapshotStore(str(tmp_path / 'backups')).restore(name, str(tmp_path / 'restored'))
+    other.close()
+    SnapshotStore(str(tmp_path / 'backups')).restore(name, str(tmp_path / 'restored'))
+    assert (tmp_path / 'restored' / 'map.png').read_bytes() == b'first image'
+
+def test_backup_routes(client, map_folder, job_workers):
+    folder, db_path = map_folder
+    folder_path = os.path.dirname(db_path)
+    with open(os.path.join(folder_path, 'garden.png'), 'wb') as file:
+        file.write(b'map image')
+    name = client.post('/backup', data={'directory': folder}).get_json()['filename']
+    assert name in [backup['name'] for backup in client.get('/backups').get_json()]
+    assert client.post('/restore', data={'backup_file': name}).status_code == 409
+
+    shutil.rmtree(folder_path)
+    response = client.post('/restore', data={'backup_file': name})
+    assert response.status_code == 202
+    job = wait_for(lambda: client.get(response.get_json()['status_url']).get_json())
+    assert (job['status'], job['result']['folders']) == ('done', [folder])
+    assert open(os.path.join(folder_path, 'garden.png'), 'rb').read() == b'map image'
+    assert not [entry for entry in os.listdir(app.config['IMG_DIR']) if entry.startswith('.restore-')]
+
+    assert client.delete(f'/backups/{name}').get_json()['filename'] == name
+    assert client.delete(f'/backups/{name}').status_code == 404
+    assert client.delete('/backups/notes.txt').status_code == 400
+    assert client.post('/restore', data={'backup_file': '../x.tar.gz'}).status_code == 400
+    assert client.get('/restore/nothing-like-it').status_code == 404
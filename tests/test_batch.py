@@ -0,0 +1,73 @@
+import sqlite3
+
+def marker(lat, **fields):
+    return {'op': 'insert', 'kind': 'markers', 'lat': lat, 'lng': lat, 'info': f'marker {lat}', 'iconType': 'leaf.svg', 'iconColor': '#00ff00', **fields}
+
+def count(db_path, table):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute(f'SELECT count(*) FROM {table}').fetchone()[0]
+    finally:
+        conn.close()
+
+def test_mixed_operations_are_applied_in_order(client, map_folder):
+    folder, db_path = map_folder
+    operations = [marker(1, id='a'), marker(2, id='b'),
+                  {'op': 'insert', 'kind': 'lines', 'id': 'l1', 'start_lat': 0, 'start_lng': 0, 'end_lat': 1, 'end_lng': 1, 'info': 'path', 'color': '#ff0000'},
+                  {'op': 'insert', 'kind': 'journals', 'entry_title': 'Planted', 'entry_content': 'Tomatoes'},
+                  {'op': 'update', 'kind': 'markers', 'markerId': 'a', 'iconColor': '#ff0000'},
+                  {'op': 'delete', 'kind': 'markers', 'id': 'b'}]
+    result = client.post(f'/maps/{folder}/batch', json=operations).get_json()
+    assert (result['applied'], result['failed']) == (6, 0)
+    assert [item['id'] for item in result['results'][:3]] == ['a', 'b', 'l1']
+    markers = client.get(f'/markers/{folder}').get_json()
+    assert [(item['markerId'], item['iconColor']) for item in markers] == [('a', '#ff0000')]
+    assert (count(db_path, 'lines'), count(db_path, 'journals')) == (1, 1)
+    assert result['version'] == client.get(f'/maps/{folder}/changes').get_json()['version']
+
+def test_invalid_operations_are_reported_and_skipped(client, map_folder):
+    folder, db_path = map_folder
+    operations = [marker(1, id='a'), marker('north'), marker(3, id='a'),
+                  {'op': 'delete', 'kind': 'markers', 'id': 'missing'}, {'op': 'rename', 'kind': 'markers'}]
+    result = client.post(f'/maps/{folder}/batch', json=operations).get_json()
+    assert [item['ok'] for item in result['results']] == [True, False, False, False, False]
+    assert result['results'][1]['error'] == 'lat must be a number'
+    assert result['results'][2]['error'] == 'markers a already exists'
+    assert result['results'][3]['error'] == 'markers missing not found'
+    assert count(db_path, 'markers') == 1
+
+def test_atomic_batch_is_rolled_back_on_any_failure(client, map_folder):
+    folder, db_path = map_folder
+    client.post(f'/maps/{folder}/batch', json=[marker(1, id='a')])
+    version = client.get(f'/maps/{folder}/changes').get_json()['version']
+
+    # The duplicate is only found while writing, after the first insert went in
+    response = client.post(f'/maps/{folder}/batch', json={'atomic': True, 'operations': [marker(2, id='b'), marker(3, id='a')]})
+    assert response.status_code == 400
+    assert [item['ok'] for item in response.get_json()['results']] == [False, False]
+    assert response.get_json()['results'][0]['error'] == 'Not applied because another operation failed'
+    assert count(db_path, 'markers') == 1
+    assert client.get(f'/maps/{folder}/changes').get_json()['version'] == version
+
+    # One that fails the checks isn't started at all
+    response = client.post(f'/maps/{folder}/batch', json={'atomic': True, 'operations': [marker(2, id='b'), {'op': 'insert'}]})
+    assert response.status_code == 400
+    assert count(db_path, 'markers') == 1
+
+def test_batch_invalidates_clusters(client, map_folder):
+    folder, _ = map_folder
+    client.post(f'/maps/{folder}/batch', json=[marker(1), marker(2)])
+    assert [cluster['count'] for cluster in client.get(f'/markers/{folder}/clusters?zoom=0').get_json()] == [2]
+    client.post(f'/maps/{folder}/batch', json=[marker(3)])
+    assert [cluster['count'] for cluster in client.get(f'/markers/{folder}/clusters?zoom=0').get_json()] == [3]
+
+def test_large_batch_is_one_request(client, map_folder):
+    folder, db_path = map_folder
+    result = client.post(f'/maps/{folder}/batch', json=[marker(i % 500) for i in range(5000)]).get_json()
+    assert result['applied'] == 5000
+    assert count(db_path, 'markers') == 5000
+
+def test_batch_must_be_a_list(client, map_folder):
+    folder, _ = map_folder
+    assert client.post(f'/maps/{folder}/batch', json={'operations': 'all of them'}).status_code == 400
+    assert client.post(f'/maps/{folder}/batch', data='not json', content_type='application/json').status_code == 400
@@ -0,0 +1,83 @@
+import os
+from PIL import Image
+from gogrow_app.blobs import BlobStore
+from gogrow_app.ingest import ingest_image
+from test_jobs import wait_for
+
+def write(path, data):
+    with open(path, 'wb') as file:
+        file.write(data)
+
+def test_same_image_in_two_maps_is_stored_and_ingested_once(tmp_path):
+    store = BlobStore(str(tmp_path / '.blobs'))
+    progress = []
+    results = []
+    for name in ('north', 'south'):
+        os.makedirs(tmp_path / name)
+        Image.new('RGB', (600, 400), (40, 160, 40)).save(tmp_path / name / 'garden.png')
+        payload = {'folder': str(tmp_path / name), 'filename': 'garden.png', 'thumbnail': 'thumbnail-garden.png', 'blob_root': store.root}
+        progress.append([])
+        results.append(ingest_image(payload, lambda fraction, message=None: progress[-1].append(message)))
+    assert results[0]['sha256'] == results[1]['sha256']
+    assert os.path.samefile(tmp_path / 'north' / 'garden.png', tmp_path / 'south' / 'garden.png')
+    assert os.path.samefile(tmp_path / 'north' / 'thumbnail-garden.png', tmp_path / 'south' / 'thumbnail-garden.png')
+    # The second map reused the thumbnail of the first
+    assert 'Creating thumbnail' in progress[0] and 'Creating thumbnail' not in progress[1]
+    assert os.path.exists(os.path.join(store.tiles_dir(results[0]['sha256']), '2', '0', '0.jpg'))
+
+def test_replacing_a_file_releases_its_blob(tmp_path):
+    store = BlobStore(str(tmp_path / '.blobs'))
+    image = str(tmp_path / 'map.png')
+    write(image, b'first image')
+    first, _ = store.add_file(image, 'map')
+    os.makedirs(store.tiles_dir(first))
+
+    # Replaced the way uploads are: a new file swapped in
+    write(image + '.tmp', b'second image')
+    os.replace(image + '.tmp', image)
+    second, _ = store.add_file(image, 'map')
+    assert not os.path.exists(store.blob_path(first))
+    assert not os.path.exists(store.tiles_dir(first))
+    assert os.path.exists(store.blob_path(second))
+
+def test_shared_blob_stays_while_referenced(tmp_path):
+    store = BlobStore(str(tmp_path / '.blobs'))
+    one, two = str(tmp_path / 'one.png'), str(tmp_path / 'two.png')
+    write(one, b'same image')
+    write(two, b'same image')
+    sha256, _ = store.add_file(one, 'map')
+    store.add_file(two, 'map')
+    write(one + '.tmp', b'other image')
+    os.replace(one + '.tmp', one)
+    store.add_file(one, 'map')
+    assert os.path.exists(store.blob_path(sha256))
+
+def test_collect_garbage_deletes_blobs_of_deleted_files(tmp_path):
+    store = BlobStore(str(tmp_path / '.blobs'))
+    kept, deleted = str(tmp_path / 'kept.png'), str(tmp_path / 'deleted.png')
+    write(kept, b'kept')
+    write(deleted, b'deleted')
+    kept_sha256, _ = store.add_file(kept, 'map')
+    deleted_sha256, _ = store.add_file(deleted, 'journal')
+    os.remove(deleted)
+    assert store.collect_garbage() == 1
+    assert os.path.exists(store.blob_path(kept_sha256))
+    assert not os.path.exists(store.blob_path(deleted_sha256))
+    assert store.sha256_of(kept) == kept_sha256
+
+def test_inode_cache_keeps_the_most_recent_files(tmp_path):
+    store = BlobStore(str(tmp_path / '.blobs'), inode_cache_size=2)
+    paths = [str(tmp_path / f'{i}.png') for i in range(3)]
+    for i, path in enumerate(paths):
+        write(path, f'image {i}'.encode())
+        store.add_file(path, 'map')
+    for path in paths:
+        assert store.sha256_of(path) is not None
+    assert len(store._inode_cache) == 2
+    assert (os.stat(paths[0]).st_ino, os.stat(paths[0]).st_mtime_ns) not in store._inode_cache
+
+def test_garbage_collection_runs_as_a_job(client, job_workers):
+    response = client.post('/blobs/collect_garbage')
+    assert response.status_code == 202
+    job = wait_for(lambda: client.get(response.get_json()['status_url']).get_json())
+    assert (job['status'], job['result']) == ('done', {'deleted': 0})
@@ -0,0 +1,72 @@
+import os
+import gzip
+import sqlite3
+from gogrow_app.database import ensure_schema, get_change_version
+
+MARKER = {'info': 'tomato', 'iconType': 'leaf.svg', 'iconColor': '#00ff00', 'markerNotes': ''}
+
+def test_change_counter_follows_every_write(map_folder):
+    _, db_path = map_folder
+    ensure_schema(db_path)
+    conn = sqlite3.connect(db_path)
+    versions = [get_change_version(conn)]
+    for statement in ("INSERT INTO markers (id, lat, lng) VALUES ('m1', 1, 1)", "UPDATE markers SET lat = 2",
+                      "INSERT INTO journals (id, entry_date, entry_title, entry_content) VALUES ('j1', '', '', '')",
+                      "DELETE FROM markers"):
+        conn.execute(statement)
+        versions.append(get_change_version(conn))
+    conn.close()
+    assert versions == list(range(versions[0], versions[0] + 5))
+
+def test_bundle_holds_the_whole_map(client, map_folder):
+    folder, db_path = map_folder
+    with open(os.path.join(os.path.dirname(db_path), 'garden.png'), 'wb') as image_file:
+        image_file.write(b'not really a png')
+    client.get(f'/markers/{folder}')
+    marker_id = client.post(f'/markers/{folder}', json={'lat': 1, 'lng': 2, **MARKER}).get_json()['marker_id']
+
+    bundle = client.get(f'/maps/{folder}/bundle').get_json()
+    assert bundle['folder'] == folder
+    assert bundle['image_url'].startswith(f'/img/{folder}/garden.png?v=')
+    assert folder in bundle['folders']
+    assert bundle['markers'] == client.get(f'/markers/{folder}').get_json()
+    assert bundle['markers'][0]['markerId'] == marker_id
+    assert (bundle['lines'], bundle['journals']) == ([], [])
+
+def test_bundle_without_features(client, map_folder):
+    folder, _ = map_folder
+    client.get(f'/markers/{folder}')
+    client.post(f'/markers/{folder}', json={'lat': 1, 'lng': 2, **MARKER})
+    whole = client.get(f'/maps/{folder}/bundle')
+    response = client.get(f'/maps/{folder}/bundle?features=false')
+    bundle = response.get_json()
+    assert 'markers' not in bundle and 'lines' not in bundle
+    assert (bundle['version'], bundle['journals']) == (whole.get_json()['version'], [])
+    assert response.headers['ETag'] != whole.headers['ETag']
+    assert client.get(f'/maps/{folder}/bundle', headers={'If-None-Match': response.headers['ETag']}).status_code == 200
+
+def test_unchanged_map_is_not_sent_again(client, map_folder):
+    folder, _ = map_folder
+    client.get(f'/markers/{folder}')
+    response = client.get(f'/maps/{folder}/bundle')
+    etag = response.headers['ETag']
+    assert client.get(f'/maps/{folder}/bundle', headers={'If-None-Match': etag}).status_code == 304
+
+    client.post(f'/markers/{folder}', json={'lat': 1, 'lng': 2, **MARKER})
+    response = client.get(f'/maps/{folder}/bundle', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+    assert len(response.get_json()['markers']) == 1
+
+def test_bundle_is_compressed_when_accepted(client, map_folder):
+    folder, _ = map_folder
+    plain = client.get(f'/maps/{folder}/bundle', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in plain.headers
+    response = client.get(f'/maps/{folder}/bundle', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert gzip.decompress(response.data) == plain.data
+
+def test_missing_map_has_no_bundle(client):
+    # Like the other folder routes, a folder that doesn't exist is an invalid directory
+    assert client.get('/maps/no_such_map/bundle').status_code == 400
+    assert client.get('/maps/..%2Fsecret/bundle').status_code in (400, 404)
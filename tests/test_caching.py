@@ -0,0 +1,53 @@
+import os
+import time
+import hashlib
+from gogrow_app import app
+
+def write(path, data):
+    with open(path, 'wb') as file:
+        file.write(data)
+
+def test_unchanged_image_is_revalidated(client, map_folder):
+    folder, db_path = map_folder
+    write(os.path.join(os.path.dirname(db_path), 'garden.png'), b'first version')
+    response = client.get(f'/img/{folder}/garden.png')
+    assert response.headers['ETag'] == f'"{hashlib.sha256(b"first version").hexdigest()}"'
+    assert 'no-store' not in response.headers.get('Cache-Control', '')
+    assert client.get(f'/img/{folder}/garden.png', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    assert client.get(f'/img/{folder}/garden.png', headers={'If-Modified-Since': response.headers['Last-Modified']}).status_code == 304
+
+def test_changed_image_gets_a_new_etag_and_url(client, map_folder):
+    folder, db_path = map_folder
+    path = os.path.join(os.path.dirname(db_path), 'garden.png')
+    write(path, b'first version')
+    url = client.get(f'/get_image_url/{folder}').get_data(as_text=True)
+    etag = client.get(f'/{url}').headers['ETag']
+    time.sleep(0.01)
+    write(path, b'second version')
+    response = client.get(f'/img/{folder}/garden.png', headers={'If-None-Match': etag})
+    assert (response.status_code, response.data) == (200, b'second version')
+    assert client.get(f'/get_image_url/{folder}').get_data(as_text=True) != url
+
+def test_fingerprinted_urls_are_immutable(client, map_folder):
+    folder, db_path = map_folder
+    write(os.path.join(os.path.dirname(db_path), 'garden.png'), b'first version')
+    url = client.get(f'/get_image_url/{folder}').get_data(as_text=True)
+    assert url == f"img/{folder}/garden.png?v={hashlib.sha256(b'first version').hexdigest()[:12]}"
+    cache_control = client.get(f'/{url}').headers['Cache-Control']
+    assert 'immutable' in cache_control and 'max-age=31536000' in cache_control
+    # A stale fingerprint isn't cached for good
+    assert 'immutable' not in client.get(f'/img/{folder}/garden.png?v=000000000000').headers.get('Cache-Control', '')
+
+def test_static_files_and_icons_are_cached(client):
+    with app.test_request_context():
+        url = app.jinja_env.globals['static_url']('favicon.ico')
+    assert '?v=' in url
+    response = client.get(url)
+    assert response.status_code == 200 and 'immutable' in response.headers['Cache-Control']
+    assert client.get('/static/favicon.ico', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    assert client.get('/static/../views.py').status_code == 404
+
+    icon = sorted(os.listdir(app.config['ICON_DIR']))[0]
+    response = client.get(f'/icons/{icon}')
+    assert response.mimetype == 'image/svg+xml'
+    assert client.get(f'/icons/{icon}', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
@@ -0,0 +1,102 @@
+import os
+import json
+import sqlite3
+from PIL import Image
+from gogrow_app.catalog import MapCatalog, is_map_image
+from gogrow_app.database import ensure_schema, get_db_connection, get_item_counts
+from test_viewport import add_markers
+
+def make_map(img_dir, folder, size=(300, 200)):
+    folder_path = os.path.join(img_dir, folder)
+    os.makedirs(folder_path)
+    Image.new('RGB', size, (40, 160, 40)).save(os.path.join(folder_path, f'{folder}.jpg'))
+    Image.new('RGB', (20, 20)).save(os.path.join(folder_path, f'thumbnail-{folder}.png'))
+    return os.path.join(folder_path, f'{folder}.db')
+
+def test_map_images_are_told_from_map_data():
+    assert is_map_image('garden.jpg')
+    assert not any(is_map_image(name) for name in ('garden.db', 'garden.db-wal', 'thumbnail-garden.png', '.hidden.png', 'upload.tmp'))
+
+def test_new_and_removed_folders_are_noticed(tmp_path):
+    hashed = []
+    catalog = MapCatalog(str(tmp_path), sha256_of=lambda path: hashed.append(path) or 'abc')
+    assert catalog.maps() == []
+    make_map(str(tmp_path), 'garden')
+    entry = catalog.get('garden')
+    assert (entry['image'], entry['width'], entry['height'], entry['image_sha256']) == ('garden.jpg', 300, 200, 'abc')
+    assert entry['thumbnail'] == 'thumbnail-garden.png'
+    # An image that didn't change isn't hashed again
+    catalog.refresh('garden')
+    assert len(hashed) == 1
+
+    os.remove(os.path.join(tmp_path, 'garden', 'garden.jpg'))
+    os.remove(os.path.join(tmp_path, 'garden', 'thumbnail-garden.png'))
+    os.rmdir(os.path.join(tmp_path, 'garden'))
+    assert catalog.folders() == []
+
+def test_counts_follow_touched_maps_and_other_processes(tmp_path):
+    catalog = MapCatalog(str(tmp_path))
+    db_path = make_map(str(tmp_path), 'garden')
+    ensure_schema(db_path)
+    assert catalog.get('garden')['markers'] == 0
+    add_markers(db_path, [(1, 1), (2, 2)])
+    assert catalog.get('garden')['markers'] == 0  # nobody said the map changed
+    catalog.touch('garden')
+    entry = catalog.get('garden')
+    assert (entry['markers'], entry['revision'] > 0) == (2, True)
+
+    # A write the catalog wasn't told about is found by the watcher's reconcile()
+    conn = sqlite3.connect(db_path)
+    conn.execute("DELETE FROM markers WHERE id = 'm0'")
+    conn.commit()
+    conn.close()
+    catalog.reconcile()
+    assert catalog.get('garden')['markers'] == 1
+
+def test_reads_come_from_memory_until_something_changed(tmp_path, monkeypatch):
+    catalog = MapCatalog(str(tmp_path))
+    db_path = make_map(str(tmp_path), 'garden')
+    add_markers(db_path, [(1, 1)])
+    assert catalog.get('garden')['markers'] == 1
+    queries = []
+    rows = catalog._rows
+    monkeypatch.setattr(catalog, '_rows', lambda conn, folder=None: queries.append(folder) or rows(conn, folder))
+    for _ in range(3):
+        catalog.get('garden')
+        catalog.maps()
+    assert queries == []
+
+    # A touched map is read again, and so is a folder that came along
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO markers (id, lat, lng, info, iconType, iconColor, markerNotes) VALUES ('m1', 2, 2, '', 'leaf.svg', '#00ff00', '')")
+    conn.commit()
+    conn.close()
+    catalog.touch('garden')
+    assert catalog.get('garden')['markers'] == 2
+    make_map(str(tmp_path), 'orchard')
+    assert catalog.folders() == ['garden', 'orchard']
+    assert len(queries) >= 2
+    # Entries handed out are copies
+    catalog.get('garden')['markers'] = 99
+    assert catalog.get('garden')['markers'] == 2
+
+def test_item_counts_are_kept_by_triggers(map_folder):
+    _, db_path = map_folder
+    add_markers(db_path, [(1, 1), (2, 2), (3, 3)])
+    conn = get_db_connection(db_path)
+    conn.execute("DELETE FROM markers WHERE id = 'm1'")
+    conn.execute("INSERT INTO journals (id, entry_date, entry_title, entry_content) VALUES ('j1', 'May 04, 2024 09:30', 'Planted', '')")
+    conn.commit()
+    assert get_item_counts(conn) == {'markers': 2, 'lines': 0, 'journals': 1}
+    conn.close()
+
+def test_map_list_and_image_url_come_from_the_catalog(client, map_folder):
+    folder, db_path = map_folder
+    Image.new('RGB', (300, 200)).save(os.path.join(os.path.dirname(db_path), 'garden.png'))
+    client.get(f'/markers/{folder}')
+    client.post(f'/markers/{folder}', json={'lat': 1, 'lng': 1, 'info': 'tomato', 'iconType': 'leaf.svg', 'iconColor': '#00ff00', 'markerNotes': ''})
+    entry = [entry for entry in client.get('/maps').get_json()['maps'] if entry['folder'] == folder][0]
+    assert (entry['width'], entry['height'], entry['markers']) == (300, 200, 1)
+    assert entry['image_url'].startswith(f'/img/{folder}/garden.png?v=')
+    assert folder in json.loads(client.get('/get_folders').data)
+    assert client.get(f'/get_image_url/{folder}').get_data(as_text=True) == entry['image_url'][1:]
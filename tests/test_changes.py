@@ -0,0 +1,69 @@
+import sqlite3
+from gogrow_app.database import schema_registry, ensure_schema
+
+MARKER = {'info': 'tomato', 'iconType': 'leaf.svg', 'iconColor': '#00ff00', 'markerNotes': ''}
+MARKERS = 2500
+
+def create_unversioned_map(db_path, version):
+    """A map database migrated only up to version, with MARKERS markers written before revisions existed."""
+    migrations = schema_registry._migrations
+    schema_registry._migrations = [migration for migration in migrations if migration[0] <= version]
+    try:
+        ensure_schema(db_path)
+    finally:
+        schema_registry._migrations = migrations
+        schema_registry.forget(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.executemany('INSERT INTO markers (id, lat, lng, info, iconType, iconColor, markerNotes) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     [(f'm{i}', i, i, f'marker {i}', 'leaf.svg', '#00ff00', '') for i in range(MARKERS)])
+    conn.commit()
+    conn.close()
+
+def page_all_changes(client, folder, limit=1000):
+    since, seen, pages = 0, [], 0
+    while True:
+        result = client.get(f'/maps/{folder}/changes?since={since}&limit={limit}').get_json()
+        seen.extend(marker['markerId'] for marker in result['markers'])
+        pages += 1
+        assert result['version'] > since or not result['more']
+        since = result['version']
+        if not result['more']:
+            return seen, pages
+
+def test_only_changes_since_a_revision_are_returned(client, map_folder):
+    folder, _ = map_folder
+    client.get(f'/markers/{folder}')
+    kept, changed, deleted = [client.post(f'/markers/{folder}', json={'lat': i, 'lng': i, **MARKER}).get_json()['marker_id'] for i in range(3)]
+    version = client.get(f'/maps/{folder}/bundle').get_json()['version']
+    assert client.get(f'/maps/{folder}/changes?since={version}').get_json()['markers'] == []
+
+    client.post('/update_marker', json={'id': changed, **MARKER, 'info': 'pepper'})
+    client.post('/delete_marker', json={'id': deleted})
+    result = client.get(f'/maps/{folder}/changes?since={version}').get_json()
+    assert [(marker['markerId'], marker['info']) for marker in result['markers']] == [(changed, 'pepper')]
+    assert result['deleted']['markers'] == [deleted]
+    assert (result['more'], result['version']) == (False, version + 2)
+    assert kept not in [marker['markerId'] for marker in result['markers']]
+
+def test_replaced_database_asks_for_a_reset(client, map_folder):
+    folder, _ = map_folder
+    client.get(f'/markers/{folder}')
+    client.post(f'/markers/{folder}', json={'lat': 1, 'lng': 1, **MARKER})
+    version = client.get(f'/maps/{folder}/changes').get_json()['version']
+    assert client.get(f'/maps/{folder}/changes?since={version + 1}').get_json() == {'reset': True, 'version': version}
+
+def test_changes_pages_through_rows_from_before_revisions(client, map_folder):
+    folder, db_path = map_folder
+    create_unversioned_map(db_path, 4)
+    seen, pages = page_all_changes(client, folder)
+    assert sorted(seen) == sorted(f'm{i}' for i in range(MARKERS))
+    assert pages == 3
+    conn = sqlite3.connect(db_path)
+    assert conn.execute('SELECT count(DISTINCT revision) FROM markers').fetchone()[0] == MARKERS
+    conn.close()
+
+def test_invalid_change_requests_are_rejected(client, map_folder):
+    folder, _ = map_folder
+    assert client.get(f'/maps/{folder}/changes?since=-1').status_code == 400
+    assert client.get(f'/maps/{folder}/changes?since=soon').status_code == 400
+    assert client.get(f'/maps/{folder}/changes?limit=0').status_code == 400
@@ -0,0 +1,60 @@
+from gogrow_app.clusters import build_clusters, cluster_cell_size, ClusterCache
+
+MARKER = {'info': 'tomato', 'iconType': 'leaf.svg', 'iconColor': '#00ff00', 'markerNotes': ''}
+
+def test_markers_in_one_cell_make_one_cluster():
+    clusters = build_clusters(['a', 'b', 'c', 'd'], [1, 3, 2, 500], [1, 2, 3, 500], ['leaf.svg', 'pot.svg', 'pot.svg', 'leaf.svg'], 80)
+    clusters.sort(key=lambda cluster: cluster['count'])
+    single, group = clusters
+    assert single == {'count': 1, 'lat': 500.0, 'lng': 500.0, 'bounds': [500.0, 500.0, 500.0, 500.0], 'iconType': 'leaf.svg', 'markerId': 'd'}
+    assert group['count'] == 3
+    assert (group['lat'], group['lng']) == (2.0, 2.0)
+    assert group['bounds'] == [1.0, 1.0, 3.0, 3.0]
+    assert group['iconType'] == 'pot.svg'
+    assert 'markerId' not in group
+
+def test_cells_shrink_as_the_map_zooms_in():
+    assert cluster_cell_size(0) == 80
+    assert cluster_cell_size(2) == 20
+    ids, lats, lngs, icons = ['a', 'b'], [0, 30], [0, 30], ['leaf.svg'] * 2
+    assert len(build_clusters(ids, lats, lngs, icons, cluster_cell_size(0))) == 1
+    assert len(build_clusters(ids, lats, lngs, icons, cluster_cell_size(2))) == 2
+
+def test_cache_builds_once_until_invalidated(tmp_path):
+    cache = ClusterCache()
+    db_path = str(tmp_path / 'garden.db')
+    loads = []
+
+    def load_markers():
+        loads.append(1)
+        return ['a'], [1], [1], ['leaf.svg']
+
+    cache.get(db_path, 0, load_markers)
+    cache.get(db_path, 0, load_markers)
+    assert len(loads) == 1
+    cache.get(db_path, 1, load_markers)
+    assert len(loads) == 2
+    cache.invalidate(db_path)
+    cache.get(db_path, 0, load_markers)
+    assert len(loads) == 3
+
+def test_clusters_follow_marker_writes(client, map_folder):
+    folder, _ = map_folder
+    client.get(f'/markers/{folder}')
+    ids = [client.post(f'/markers/{folder}', json={'lat': i, 'lng': i, **MARKER}).get_json()['marker_id'] for i in range(3)]
+    assert [cluster['count'] for cluster in client.get(f'/markers/{folder}/clusters?zoom=0').get_json()] == [3]
+
+    client.post('/delete_marker', json={'id': ids[0]})
+    assert [cluster['count'] for cluster in client.get(f'/markers/{folder}/clusters?zoom=0').get_json()] == [2]
+    client.post('/update_marker', json={'id': ids[1], **MARKER, 'iconType': 'pot.svg'})
+    client.post('/update_marker', json={'id': ids[2], **MARKER, 'iconType': 'pot.svg'})
+    assert client.get(f'/markers/{folder}/clusters?zoom=0').get_json()[0]['iconType'] == 'pot.svg'
+
+def test_clusters_outside_the_bbox_are_left_out(client, map_folder):
+    folder, _ = map_folder
+    client.get(f'/markers/{folder}')
+    for lat in (10, 1000):
+        client.post(f'/markers/{folder}', json={'lat': lat, 'lng': lat, **MARKER})
+    clusters = client.get(f'/markers/{folder}/clusters?zoom=0&bbox=0,0,100,100').get_json()
+    assert [(cluster['lat'], cluster['count']) for cluster in clusters] == [(10, 1)]
+    assert client.get(f'/markers/{folder}/clusters?zoom=far').status_code == 400
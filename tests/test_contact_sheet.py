@@ -0,0 +1,84 @@
+import io
+import os
+import shutil
+import pytest
+from PIL import Image
+from gogrow_app.catalog import MapCatalog
+from gogrow_app.contact_sheet import ContactSheet, CELL_SIZE, COLUMNS
+
+def make_map(img_dir, folder, color):
+    folder_path = os.path.join(img_dir, folder)
+    os.makedirs(folder_path, exist_ok=True)
+    Image.new('RGB', (200, 100), color).save(os.path.join(folder_path, f'thumbnail-{folder}.png'))
+
+def cell_color(sheet, offset):
+    # The middle of a cell is inside any thumbnail, whatever its shape
+    return sheet._image.getpixel((offset[0] + CELL_SIZE // 2, offset[1] + CELL_SIZE // 2))
+
+def test_each_map_gets_a_cell(tmp_path):
+    make_map(str(tmp_path), 'farm', (255, 0, 0))
+    make_map(str(tmp_path), 'garden', (0, 0, 255))
+    sheet = ContactSheet(MapCatalog(str(tmp_path)))
+    layout = sheet.current()
+    assert layout['maps'] == {'farm': [0, 0], 'garden': [CELL_SIZE, 0]}
+    assert (layout['width'], layout['height']) == (COLUMNS * CELL_SIZE, CELL_SIZE)
+    assert cell_color(sheet, layout['maps']['farm'])[:3] == (255, 0, 0)
+    assert cell_color(sheet, layout['maps']['garden'])[:3] == (0, 0, 255)
+
+def test_only_changed_cells_are_drawn(tmp_path, monkeypatch):
+    catalog = MapCatalog(str(tmp_path))
+    make_map(str(tmp_path), 'farm', (255, 0, 0))
+    make_map(str(tmp_path), 'garden', (0, 0, 255))
+    sheet = ContactSheet(catalog)
+    version = sheet.current()['version']
+    assert sheet.current()['version'] == version
+
+    drawn = []
+    draw = ContactSheet._draw
+    monkeypatch.setattr(ContactSheet, '_draw', lambda self, slot, path: drawn.append(slot) or draw(self, slot, path))
+    shutil.rmtree(tmp_path / 'farm')
+    layout = sheet.current()
+    assert layout['maps'] == {'garden': [CELL_SIZE, 0]} and drawn == [0]
+    assert cell_color(sheet, (0, 0))[3] == 0
+    # A new map takes the free cell
+    make_map(str(tmp_path), 'orchard', (0, 255, 0))
+    assert sheet.current()['maps']['orchard'] == [0, 0]
+    assert drawn == [0, 0]
+    # A changed thumbnail is drawn again once the catalog has seen it change
+    make_map(str(tmp_path), 'garden', (255, 255, 0))
+    catalog.refresh('garden')
+    assert sheet.current()['version'] not in (version, layout['version'])
+    assert drawn == [0, 0, 1]
+    assert cell_color(sheet, (CELL_SIZE, 0))[:3] == (255, 255, 0)
+
+def test_sheet_is_kept_across_restarts(tmp_path, monkeypatch):
+    make_map(str(tmp_path), 'farm', (255, 0, 0))
+    layout = ContactSheet(MapCatalog(str(tmp_path))).current()
+    monkeypatch.setattr(ContactSheet, '_draw', lambda self, slot, path: pytest.fail('the sheet was drawn again'))
+    assert ContactSheet(MapCatalog(str(tmp_path))).current() == layout
+
+def test_sheet_is_encoded_once_per_version(tmp_path):
+    make_map(str(tmp_path), 'farm', (255, 0, 0))
+    sheet = ContactSheet(MapCatalog(str(tmp_path)))
+    sheet.current()
+    digest, body = sheet.encoded('jpeg')
+    assert sheet.encoded('jpeg')[1] is body
+    with Image.open(io.BytesIO(body)) as image:
+        assert (image.format, image.size) == ('JPEG', (COLUMNS * CELL_SIZE, CELL_SIZE))
+    make_map(str(tmp_path), 'garden', (0, 0, 255))
+    sheet.current()
+    assert sheet.encoded('jpeg')[0] != digest
+    with pytest.raises(ValueError):
+        sheet.encoded('gif')
+
+def test_contact_sheet_routes(client, map_folder):
+    folder, db_path = map_folder
+    make_map(os.path.dirname(os.path.dirname(db_path)), folder, (255, 0, 0))
+    maps = client.get('/maps?fmt=jpeg').get_json()
+    sheet = maps['contact_sheet']
+    assert folder in sheet['maps'] and sheet['image_url'].startswith('/maps/contact_sheet.jpg?v=')
+    response = client.get(sheet['image_url'])
+    assert response.mimetype == 'image/jpeg' and 'immutable' in response.headers['Cache-Control']
+    assert client.get('/maps/contact_sheet.jpg', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    assert client.get('/maps/contact_sheet?fmt=jpeg').get_json()['version'] == sheet['version']
+    assert client.get('/maps/contact_sheet.gif').status_code == 404
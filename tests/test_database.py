@@ -0,0 +1,69 @@
+import sqlite3
+import pytest
+from gogrow_app.database import ConnectionManager, connection_manager
+
+def test_closed_connections_are_reused(tmp_path):
+    manager = ConnectionManager()
+    db_path = str(tmp_path / 'garden.db')
+    conn = manager.connect(db_path)
+    raw = conn._conn
+    conn.close()
+    again = manager.connect(db_path)
+    assert again._conn is raw
+    again.close()
+    assert manager.stats()['hits'] == 1
+    assert manager.stats()['opened'] == 1
+    manager.close_all()
+
+def test_databases_are_switched_to_wal(tmp_path):
+    manager = ConnectionManager()
+    db_path = str(tmp_path / 'garden.db')
+    conn = manager.connect(db_path)
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    conn.close()
+    manager.close_all()
+
+def test_released_connection_rolls_back_an_open_transaction(tmp_path):
+    manager = ConnectionManager()
+    db_path = str(tmp_path / 'garden.db')
+    conn = manager.connect(db_path)
+    conn.execute('CREATE TABLE markers (id TEXT)')
+    conn.commit()
+    conn.execute("INSERT INTO markers VALUES ('unfinished')")
+    conn.close()
+    conn = manager.connect(db_path)
+    assert not conn.in_transaction
+    assert conn.execute('SELECT count(*) FROM markers').fetchone()[0] == 0
+    conn.close()
+    manager.close_all()
+
+def test_closed_wrapper_cannot_be_used(tmp_path):
+    manager = ConnectionManager()
+    conn = manager.connect(str(tmp_path / 'garden.db'))
+    conn.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute('SELECT 1')
+    manager.close_all()
+
+def test_least_recently_used_maps_are_closed_past_the_limit(tmp_path):
+    manager = ConnectionManager(max_connections=2)
+    for name in ('one', 'two', 'three'):
+        manager.connect(str(tmp_path / f'{name}.db')).close()
+    stats = manager.stats()
+    assert stats['open'] == 2
+    assert stats['evicted'] == 1
+    # 'one' was used least recently, so it was the one closed
+    manager.connect(str(tmp_path / 'one.db')).close()
+    assert manager.stats()['misses'] == 4
+    manager.close_all()
+
+def test_map_requests_reuse_pooled_connections(client, map_folder):
+    folder, _ = map_folder
+    client.get(f'/markers/{folder}')
+    marker = {'lat': 1, 'lng': 2, 'info': 'tomato', 'iconType': 'leaf.svg', 'iconColor': '#00ff00', 'markerNotes': ''}
+    assert client.post(f'/markers/{folder}', json=marker).status_code == 200
+    opened = connection_manager.stats()['opened']
+    for _ in range(3):
+        assert client.get(f'/markers/{folder}').status_code == 200
+    assert connection_manager.stats()['opened'] == opened
+    assert client.get('/health').get_json()['database_connections']['hits'] > 0
@@ -0,0 +1,59 @@
+import io
+import os
+from PIL import Image, features
+from gogrow_app.derivatives import DerivativeCache, choose_format, choose_width
+
+def save_image(path, size=(1000, 500), mode='RGB'):
+    Image.new(mode, size, (40, 160, 40, 128) if mode == 'RGBA' else (40, 160, 40)).save(path)
+
+def test_widths_round_up_to_fixed_sizes():
+    assert [choose_width(width) for width in (None, 1, 100, 101, 5000)] == [None, 100, 100, 200, 2400]
+
+def test_format_follows_the_accept_header():
+    webp = [('image/webp', 1), ('*/*', 0.8)]
+    assert choose_format(None, webp, 'garden.png') == ('webp' if features.check('webp') else 'png')
+    assert choose_format(None, [('*/*', 1)], 'garden.jpg') == 'jpeg'
+    assert choose_format(None, [('*/*', 1)], 'garden.png') == 'png'
+    assert choose_format('jpg', webp, 'garden.png') == 'jpeg'
+
+def test_cache_evicts_the_least_recently_used_variants(tmp_path):
+    source = str(tmp_path / 'garden.png')
+    save_image(source)
+    cache = DerivativeCache(str(tmp_path / 'cache'), max_bytes=10 ** 9)
+    first = cache.get(source, 'garden', 100, 'jpeg')
+    assert cache.get(source, 'garden', 100, 'jpeg') == first
+    second = cache.get(source, 'garden', 200, 'jpeg')
+    third = cache.get(source, 'garden', 400, 'jpeg')
+    cache.get(source, 'garden', 100, 'jpeg')
+
+    # Room for everything but the least recently used variant once the next one is added
+    newest = DerivativeCache(str(tmp_path / 'other'), max_bytes=10 ** 9).get(source, 'garden', 800, 'jpeg')
+    cache.max_bytes = sum(os.path.getsize(path) for path in (first, second, third, newest)) - 1
+    cache.get(source, 'garden', 800, 'jpeg')
+    assert not os.path.exists(second)
+    assert os.path.exists(first) and os.path.exists(third)
+    assert cache.stats()['bytes'] <= cache.max_bytes
+
+    # The order survives a restart - it is kept in the files' mtimes
+    assert DerivativeCache(cache.root, cache.max_bytes).stats()['files'] == cache.stats()['files']
+
+def test_resized_image_is_served(client, map_folder):
+    folder, db_path = map_folder
+    save_image(os.path.join(os.path.dirname(db_path), 'garden.png'), mode='RGBA')
+    response = client.get(f'/img/{folder}/garden.png?w=150&fmt=png')
+    assert response.mimetype == 'image/png'
+    with Image.open(io.BytesIO(response.data)) as img:
+        assert (img.size, img.mode) == ((200, 100), 'RGBA')
+
+    response = client.get(f'/img/{folder}/garden.png?w=150', headers={'Accept': 'image/jpeg,*/*'})
+    assert response.mimetype == 'image/png'
+    assert 'Accept' in response.headers['Vary']
+    assert client.get(f'/img/{folder}/garden.png?w=150&fmt=png', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+def test_invalid_variants_are_rejected(client, map_folder):
+    folder, db_path = map_folder
+    save_image(os.path.join(os.path.dirname(db_path), 'garden.png'))
+    assert client.get(f'/img/{folder}/garden.png?w=-5').status_code == 400
+    assert client.get(f'/img/{folder}/garden.png?fmt=bmp').status_code == 400
+    assert client.get(f'/img/{folder}/missing.png?w=100').status_code == 404
+    assert client.get(f'/img/{folder}/{folder}.db?w=100').status_code == 404
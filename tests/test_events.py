@@ -0,0 +1,104 @@
+import time
+import threading
+from gogrow_app.events import ChangeNotifier
+
+MARKER = {'info': 'tomato', 'iconType': 'leaf.svg', 'iconColor': '#00ff00', 'markerNotes': ''}
+
+class FakeMap:
+    """Stands in for a map database's change counter."""
+
+    def __init__(self):
+        self.revision = 0
+
+    def version(self, db_path):
+        return self.revision
+
+def wait_in_thread(notifier, db_path, since, timeout):
+    result = {}
+
+    def run():
+        started = time.monotonic()
+        result['waited'] = notifier.wait(db_path, since, timeout)
+        result['seconds'] = time.monotonic() - started
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, result
+
+def test_publish_wakes_the_waiting_request(tmp_path):
+    fake = FakeMap()
+    notifier = ChangeNotifier(fake.version, poll_interval=60)
+    db_path = str(tmp_path / 'garden.db')
+    thread, result = wait_in_thread(notifier, db_path, 0, 30)
+    while not notifier.stats()['waiting']:
+        time.sleep(0.01)
+    fake.revision = 1
+    notifier.publish(db_path)
+    thread.join(5)
+    assert result['waited'] and result['seconds'] < 5
+    assert notifier.stats()['waiting'] == 0
+
+def test_changes_already_made_return_at_once(tmp_path):
+    fake = FakeMap()
+    fake.revision = 3
+    notifier = ChangeNotifier(fake.version, poll_interval=60)
+    started = time.monotonic()
+    assert notifier.wait(str(tmp_path / 'garden.db'), 1, 30)
+    assert time.monotonic() - started < 1
+
+def test_writes_of_other_processes_are_noticed(tmp_path):
+    fake = FakeMap()
+    notifier = ChangeNotifier(fake.version, poll_interval=0.05)
+    thread, result = wait_in_thread(notifier, str(tmp_path / 'garden.db'), 0, 30)
+    fake.revision = 1  # nobody called publish()
+    thread.join(5)
+    assert result['seconds'] < 5
+
+def test_waits_end_after_the_timeout(tmp_path):
+    notifier = ChangeNotifier(FakeMap().version, max_wait=0.2, poll_interval=60)
+    started = time.monotonic()
+    assert notifier.wait(str(tmp_path / 'garden.db'), 0, 30)
+    assert 0.2 <= time.monotonic() - started < 5
+
+def test_waiting_requests_are_capped(tmp_path):
+    fake = FakeMap()
+    notifier = ChangeNotifier(fake.version, max_waiting=1, poll_interval=60)
+    db_path = str(tmp_path / 'garden.db')
+    thread, result = wait_in_thread(notifier, db_path, 0, 30)
+    while not notifier.stats()['waiting']:
+        time.sleep(0.01)
+    assert not notifier.wait(db_path, 0, 30)
+    fake.revision = 1
+    notifier.publish(db_path)
+    thread.join(5)
+    assert notifier.stats() == {'waiting': 0, 'max_waiting': 1, 'maps': 0, 'declined': 1}
+
+def test_changes_request_waits_for_the_next_write(client, map_folder):
+    folder, _ = map_folder
+    client.get(f'/markers/{folder}')
+    version = client.get(f'/maps/{folder}/changes').get_json()['version']
+    result = {}
+
+    def long_poll():
+        result['changes'] = client.application.test_client().get(f'/maps/{folder}/changes?since={version}&wait=20').get_json()
+
+    thread = threading.Thread(target=long_poll)
+    thread.start()
+    while not client.get('/health').get_json()['changes']['waiting']:
+        time.sleep(0.01)
+    marker_id = client.post(f'/markers/{folder}', json={'lat': 1, 'lng': 1, **MARKER}).get_json()['marker_id']
+    thread.join(10)
+    assert [marker['markerId'] for marker in result['changes']['markers']] == [marker_id]
+    assert result['changes']['version'] > version
+
+def test_changes_request_answers_at_once_when_something_changed(client, map_folder):
+    folder, _ = map_folder
+    client.get(f'/markers/{folder}')
+    version = client.get(f'/maps/{folder}/changes').get_json()['version']
+    client.post(f'/markers/{folder}', json={'lat': 1, 'lng': 1, **MARKER})
+    started = time.monotonic()
+    response = client.get(f'/maps/{folder}/changes?since={version}&wait=20')
+    assert time.monotonic() - started < 5
+    assert len(response.get_json()['markers']) == 1
+    assert 'Retry-After' not in response.headers
+    assert client.get(f'/maps/{folder}/changes?wait=-1').status_code == 400
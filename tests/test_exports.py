@@ -0,0 +1,85 @@
+import io
+import csv
+import json
+import gzip
+import sqlite3
+import pytest
+from gogrow_app.database import ensure_schema
+from gogrow_app.importer import create_import, run_import
+
+def add_map(db_path, markers=3):
+    ensure_schema(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.executemany('INSERT INTO markers (id, lat, lng, info, iconType, iconColor, markerNotes) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     [(f'm{i}', i, i * 2, f'marker {i}', 'leaf.svg', '#00ff00', '') for i in range(markers)])
+    conn.execute("INSERT INTO lines (id, start_lat, start_lng, end_lat, end_lng, info, color, notes) VALUES ('l1', 0, 0, 5, 6, 'path', '#ff0000', '')")
+    conn.execute("INSERT INTO journals (id, entry_date, linked_item_id, entry_title, entry_content, is_favorite) VALUES ('j1', 'May 04, 2024 09:30', 'm0', 'Planted', 'Tomatoes', 'yes')")
+    conn.commit()
+    conn.close()
+
+def plain(client, url):
+    return client.get(url, headers={'Accept-Encoding': 'identity'})
+
+def test_csv_export_round_trips_through_the_importer(client, map_folder, tmp_path):
+    folder, db_path = map_folder
+    add_map(db_path)
+    response = plain(client, f'/export/{folder}')
+    assert response.headers['Content-Disposition'] == f'attachment; filename="{folder}.csv"'
+    rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+    assert rows[0] == ['markerId', 'lat', 'lng', 'info', 'iconType', 'iconColor', 'markerNotes']
+    assert rows[4][0] == 'lineId'
+
+    copy = str(tmp_path / 'copy.db')
+    path = tmp_path / 'export.csv'
+    path.write_bytes(response.data)
+    result = run_import(copy, create_import(copy, 'export.csv', 'csv', str(path)))
+    assert (result['inserted'], result['failed']) == (4, 0)
+
+def test_geojson_and_ndjson_exports(client, map_folder):
+    folder, db_path = map_folder
+    add_map(db_path)
+    collection = json.loads(plain(client, f'/export/{folder}?format=geojson').data)
+    assert [feature['geometry']['type'] for feature in collection['features']] == ['Point'] * 3 + ['LineString']
+    assert collection['features'][1]['geometry']['coordinates'] == [2.0, 1.0]
+    lines = plain(client, f'/export/{folder}?format=ndjson&kind=lines').get_data(as_text=True).splitlines()
+    assert [json.loads(line)['lineId'] for line in lines] == ['l1']
+
+def test_export_is_gzipped_when_accepted_or_asked_for(client, map_folder):
+    folder, db_path = map_folder
+    add_map(db_path, markers=2000)
+    expected = plain(client, f'/export/{folder}').data
+    response = client.get(f'/export/{folder}', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data) == expected
+    response = plain(client, f'/export/{folder}?compress=gzip')
+    assert response.mimetype == 'application/gzip'
+    assert response.headers['Content-Disposition'].endswith('.csv.gz"')
+    assert gzip.decompress(response.data) == expected
+
+def test_columnar_exports(client, map_folder):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    folder, db_path = map_folder
+    add_map(db_path)
+    table = pa.ipc.open_stream(plain(client, f'/export/{folder}?format=arrow&kind=markers').data).read_all()
+    assert table.column('markerId').to_pylist() == ['m0', 'm1', 'm2']
+    assert table.schema.field('lat').type == pa.float64()
+    table = pq.read_table(io.BytesIO(plain(client, f'/export_journals/{folder}?format=parquet').data))
+    assert table.column('is_favorite').to_pylist() == ['yes']
+
+def test_journal_csv_keeps_its_columns(client, map_folder):
+    folder, db_path = map_folder
+    add_map(db_path)
+    rows = list(csv.reader(io.StringIO(plain(client, f'/export_journals/{folder}').get_data(as_text=True))))
+    assert rows == [['journalId', 'entry_date', 'linked_item_id', 'entry_title', 'entry_content'],
+                    ['j1', 'May 04, 2024 09:30', 'm0', 'Planted', 'Tomatoes']]
+
+def test_invalid_exports_are_rejected(client, map_folder):
+    folder, db_path = map_folder
+    assert client.get(f'/export/{folder}').status_code == 400  # nothing to export yet
+    add_map(db_path)
+    assert client.get(f'/export/{folder}?format=xlsx').status_code == 400
+    assert client.get(f'/export/{folder}?format=parquet').status_code == 400
+    assert client.get(f'/export/{folder}?kind=journals').status_code == 400
+    assert client.get(f'/export_journals/{folder}?format=geojson').status_code == 400
+    assert client.get(f'/export/{folder}?compress=zip').status_code == 400
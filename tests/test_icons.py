@@ -0,0 +1,102 @@
+import os
+import json
+import base64
+import time
+import pytest
+from gogrow_app.icons import IconCatalog, IconCache, colorize_svg, parse_icon_pairs
+
+MARKER = {'info': 'tomato', 'markerNotes': ''}
+
+def write_icon(icon_dir, name, svg):
+    with open(os.path.join(icon_dir, name), 'w') as icon_file:
+        icon_file.write(svg)
+
+@pytest.fixture
+def icon_cache(tmp_path):
+    os.makedirs(tmp_path / 'icons')
+    write_icon(tmp_path / 'icons', 'leaf.svg', '<svg viewBox="0 0 10 10"><path d="M0 0h10v10z"/></svg>')
+    return IconCache(IconCatalog(str(tmp_path / 'icons')), str(tmp_path / 'icon_cache'))
+
+def decode(data_uri):
+    return base64.b64decode(data_uri.split(',', 1)[1]).decode('utf-8')
+
+def test_color_is_set_on_the_root_element():
+    assert colorize_svg('<svg viewBox="0 0 1 1"><g/></svg>', '#ff0000') == '<svg viewBox="0 0 1 1" style="fill: #ff0000"><g/></svg>'
+    assert colorize_svg('<svg style="opacity: 1;"><g/></svg>', 'red') == '<svg style="opacity: 1; fill: red"><g/></svg>'
+    with pytest.raises(ValueError):
+        colorize_svg('<html/>', 'red')
+
+def test_pairs_are_parsed_and_checked():
+    assert parse_icon_pairs('tree.svg:#00FF00, leaf.svg:#ff0000,leaf.svg:#ff0000') == [('leaf.svg', '#ff0000'), ('tree.svg', '#00ff00')]
+    assert parse_icon_pairs('leaf.svg') == [('leaf.svg', '#000000')]
+    with pytest.raises(ValueError):
+        parse_icon_pairs('leaf.svg:url(evil)')
+
+def test_bundle_holds_colored_icons_that_exist(icon_cache):
+    etag, body = icon_cache.bundle([('leaf.svg', '#ff0000'), ('missing.svg', '#ff0000'), ('../leaf.svg', '#ff0000')])
+    icons = json.loads(body)
+    assert list(icons) == ['leaf.svg|#ff0000']
+    assert 'fill: #ff0000' in decode(icons['leaf.svg|#ff0000'])
+    assert icon_cache.bundle([('leaf.svg', '#ff0000')])[0] == etag
+    # The colored icon was kept on disk for the next start
+    assert os.listdir(os.path.join(icon_cache.cache_dir, 'ff0000'))[0].startswith('leaf-')
+
+def test_edited_icon_is_colored_again(icon_cache):
+    etag, _ = icon_cache.bundle([('leaf.svg', '#ff0000')])
+    time.sleep(0.01)
+    write_icon(icon_cache.catalog.icon_dir, 'leaf.svg', '<svg viewBox="0 0 20 20"><circle r="5"/></svg>')
+    icon_cache.catalog.refresh(full=True)
+    new_etag, body = icon_cache.bundle([('leaf.svg', '#ff0000')])
+    assert new_etag != etag
+    assert '<circle' in decode(json.loads(body)['leaf.svg|#ff0000'])
+
+def test_catalog_search_puts_prefix_matches_first(tmp_path):
+    for name in ('Tree.svg', 'apple-tree.svg', 'leaf.svg', 'treehouse.svg', 'rose.svg'):
+        write_icon(tmp_path, name, '<svg>\n  <g/>\n</svg>\n')
+    catalog = IconCatalog(str(tmp_path))
+    assert catalog.search('tree') == ['Tree.svg', 'treehouse.svg', 'apple-tree.svg']
+    assert catalog.search('TREE', limit=2) == ['Tree.svg', 'treehouse.svg']
+    assert catalog.search('') == ['Tree.svg', 'apple-tree.svg', 'leaf.svg', 'rose.svg', 'treehouse.svg']
+    assert catalog.read('leaf.svg') == '<svg><g/></svg>'
+
+def test_catalog_follows_the_directory(tmp_path):
+    write_icon(tmp_path, 'leaf.svg', '<svg/>')
+    write_icon(tmp_path, 'rose.svg', '<svg/>')
+    catalog = IconCatalog(str(tmp_path), keep_data=False)
+    digest = catalog.get('leaf.svg').digest
+    assert catalog.get('leaf.svg').data is None
+    time.sleep(0.01)
+    write_icon(tmp_path, 'leaf.svg', '<svg><g/></svg>')
+    write_icon(tmp_path, 'tree.svg', '<svg/>')
+    os.remove(tmp_path / 'rose.svg')
+    catalog.refresh(full=True)
+    assert catalog.names() == ['leaf.svg', 'tree.svg']
+    assert catalog.get('leaf.svg').digest != digest
+    assert catalog.read('leaf.svg') == '<svg><g/></svg>'
+
+def test_sprite_has_a_symbol_per_pair(icon_cache):
+    _, body = icon_cache.sprite([('leaf.svg', '#ff0000'), ('leaf.svg', '#00ff00')])
+    assert body.count('<symbol') == 2
+    assert '<symbol id="icon-1" viewBox="0 0 10 10" style="fill: #00ff00">' in body
+
+def test_map_icons_are_loaded_in_one_request(client, map_folder):
+    folder, _ = map_folder
+    icon = sorted(name for name in os.listdir(client.application.config['ICON_DIR']) if name.endswith('.svg'))[0]
+    client.get(f'/markers/{folder}')
+    for color in ('#FF0000', '#ff0000', '#00ff00'):
+        client.post(f'/markers/{folder}', json={'lat': 1, 'lng': 1, 'iconType': icon, 'iconColor': color, **MARKER})
+    response = client.get(f'/markers/{folder}/icons')
+    assert sorted(response.get_json()) == [f'{icon}|#00ff00', f'{icon}|#ff0000']
+    assert client.get(f'/markers/{folder}/icons', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+    response = client.get('/icons/sprite', query_string={'icons': f'{icon}:#00ff00'})
+    assert response.mimetype == 'image/svg+xml' and 'icon-0' in response.get_data(as_text=True)
+    assert client.get('/icons/bundle', query_string={'icons': f'{icon}:url(x)'}).status_code == 400
+
+def test_icon_picker_search(client):
+    names = client.get('/icon_filenames').get_json()
+    assert names == sorted(names) and names
+    assert client.get('/icon_filenames', query_string={'q': names[0][:3], 'limit': 1}).get_json() == [names[0]]
+    assert client.get('/icon_filenames?limit=0').status_code == 400
+    assert client.get('/icon_filenames?limit=many').status_code == 400
+    assert client.get('/health').get_json()['icons']['icons'] == len(names)
@@ -0,0 +1,27 @@
+import os
+import time
+from gogrow_app.database import ensure_schema, get_db_connection
+
+def write(path, data):
+    with open(path, 'wb') as file:
+        file.write(data)
+
+def test_database_files_are_not_served(client, map_folder):
+    folder, db_path = map_folder
+    for suffix in ('', '-wal', '-shm'):
+        write(db_path + suffix, b'SQLite format 3')
+        assert client.get(f'/img/{folder}/{folder}.db{suffix}').status_code == 404
+
+def test_write_ahead_log_is_not_picked_as_the_map_image(client, map_folder):
+    folder, db_path = map_folder
+    write(os.path.join(os.path.dirname(db_path), 'garden.png'), b'not really a png')
+    time.sleep(0.01)
+    # A write leaves <map>.db-wal and <map>.db-shm, newer than the image
+    ensure_schema(db_path)
+    conn = get_db_connection(db_path)
+    conn.execute("INSERT INTO journals (id, entry_date, entry_title, entry_content) VALUES ('j1', 'May 04, 2024 09:30', 'Planted', '')")
+    conn.commit()
+    conn.close()
+    assert os.path.exists(db_path + '-wal')
+    response = client.get(f'/get_image_url/{folder}')
+    assert response.get_data(as_text=True).split('?')[0] == f'img/{folder}/garden.png'
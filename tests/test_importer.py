@@ -0,0 +1,111 @@
+import io
+import os
+import json
+import sqlite3
+import pytest
+from gogrow_app import app, importer
+from gogrow_app.ingest import INCOMING_DIR_NAME
+from gogrow_app.importer import create_import, get_import, run_import, read_geojson
+from test_jobs import wait_for
+
+def write_csv(path, markers):
+    lines = ['markerId,lat,lng,info,iconType,iconColor,markerNotes']
+    lines += [f'm{i},{i},{i},marker {i},leaf.svg,#00ff00,' for i in range(markers)]
+    lines += ['lineId,start_lat,start_lng,end_lat,end_lng,info,color,notes', 'l1,0,0,5,5,path,#ff0000,']
+    path.write_text('\n'.join(lines) + '\n')
+    return str(path)
+
+def marker_ids(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return [row[0] for row in conn.execute('SELECT id FROM markers ORDER BY rowid')]
+    finally:
+        conn.close()
+
+def test_csv_sections_become_markers_and_lines(map_folder, tmp_path):
+    _, db_path = map_folder
+    path = write_csv(tmp_path / 'garden.csv', 3)
+    result = run_import(db_path, create_import(db_path, 'garden.csv', 'csv', path))
+    assert (result['status'], result['records'], result['inserted'], result['failed']) == ('done', 4, 4, 0)
+    assert marker_ids(db_path) == ['m0', 'm1', 'm2']
+    assert result['progress'] == 1.0
+
+def test_geojson_features_are_read_one_at_a_time(monkeypatch):
+    monkeypatch.setattr(importer, 'READ_CHUNK_SIZE', 7)
+    collection = {'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'id': 'a', 'geometry': {'type': 'Point', 'coordinates': [12.5, 3]}, 'properties': {'info': 'tomato'}},
+        {'type': 'Feature', 'geometry': {'type': 'LineString', 'coordinates': [[0, 1], [2, 3], [4, 5]]}, 'properties': {}},
+        {'type': 'Feature', 'geometry': {'type': 'Polygon', 'coordinates': []}}]}
+    records = list(read_geojson(io.StringIO(json.dumps(collection))))
+    assert records[0] == ('markers', {'info': 'tomato', 'id': 'a', 'lng': 12.5, 'lat': 3}, None)
+    assert records[1][1] == {'start_lng': 0, 'start_lat': 1, 'end_lng': 4, 'end_lat': 5}
+    assert records[2] == (None, None, 'Unsupported geometry: Polygon')
+
+def test_invalid_records_are_counted_and_reported(map_folder, tmp_path):
+    _, db_path = map_folder
+    path = tmp_path / 'garden.csv'
+    path.write_text('markerId,lat,lng,info\nm1,1,1,ok\nm2,north,1,bad\nm1,2,2,again\n')
+    result = run_import(db_path, create_import(db_path, 'garden.csv', 'csv', str(path)))
+    assert (result['inserted'], result['failed']) == (1, 2)
+    assert result['errors'] == [{'record': 2, 'error': 'lat must be a number'}, {'record': 3, 'error': 'markers m1 already exists'}]
+
+def test_interrupted_import_resumes_from_its_checkpoint(map_folder, tmp_path, monkeypatch):
+    _, db_path = map_folder
+    monkeypatch.setattr(importer, 'IMPORT_BATCH_SIZE', 10)
+    path = write_csv(tmp_path / 'garden.csv', 35)
+    import_id = create_import(db_path, 'garden.csv', 'csv', path)
+
+    def stop_after_two_batches(progress, message=None):
+        if get_import(db_path, import_id)['records'] >= 20:
+            raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        run_import(db_path, import_id, stop_after_two_batches)
+    interrupted = get_import(db_path, import_id)
+    assert (interrupted['status'], interrupted['records']) == ('running', 20)
+    assert len(marker_ids(db_path)) == 20
+
+    result = run_import(db_path, import_id)
+    assert (result['status'], result['records'], result['inserted'], result['failed']) == ('done', 36, 36, 0)
+    assert marker_ids(db_path) == [f'm{i}' for i in range(35)]
+
+def test_upload_is_imported_by_a_job(client, map_folder, tmp_path, job_workers):
+    folder, db_path = map_folder
+    with open(write_csv(tmp_path / 'garden.csv', 5), 'rb') as csv_file:
+        response = client.post(f'/maps/{folder}/import', data={'file': (csv_file, 'garden.csv')}, content_type='multipart/form-data')
+    assert response.status_code == 202
+    status_url = response.get_json()['status_url']
+    result = wait_for(lambda: client.get(status_url).get_json())
+    assert (result['status'], result['inserted']) == ('done', 6)
+    assert len(marker_ids(db_path)) == 5
+    # A finished import can't be resumed
+    assert client.post(f'{status_url}/resume').status_code == 409
+    assert client.get(f'/maps/{folder}/imports/nothing-like-it').status_code == 404
+
+def test_import_needs_a_file_and_a_format(client, map_folder):
+    folder, _ = map_folder
+    assert client.post(f'/maps/{folder}/import', data={}, content_type='multipart/form-data').status_code == 400
+    response = client.post(f'/maps/{folder}/import', data={'file': (io.BytesIO(b'x'), 'garden.txt')}, content_type='multipart/form-data')
+    assert response.status_code == 400
+
+def test_format_is_checked_before_the_file_is_kept(client, map_folder):
+    folder, db_path = map_folder
+    incoming_dir = os.path.join(os.path.dirname(db_path), INCOMING_DIR_NAME)
+    response = client.post(f'/maps/{folder}/import', data={'file': (io.BytesIO(b'x'), 'garden.csv'), 'format': '../../garden'},
+                           content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert not os.path.exists(incoming_dir)
+
+    geojson = json.dumps({'type': 'FeatureCollection', 'features': []}).encode()
+    response = client.post(f'/maps/{folder}/import', data={'file': (io.BytesIO(geojson), 'garden.json')}, content_type='multipart/form-data')
+    assert response.status_code == 202
+    conn = sqlite3.connect(db_path)
+    (path,), = conn.execute('SELECT path FROM imports').fetchall()
+    conn.close()
+    assert os.path.dirname(path) == os.path.abspath(incoming_dir)
+    assert path.endswith('.geojson')
+
+def test_import_into_a_missing_map(client):
+    response = client.post('/maps/no_such_map/import', data={'file': (io.BytesIO(b'x'), 'garden.csv')}, content_type='multipart/form-data')
+    assert response.status_code == 404
+    assert not os.path.exists(os.path.join(app.config['IMG_DIR'], 'no_such_map'))
@@ -0,0 +1,45 @@
+import sqlite3
+from gogrow_app import views
+from test_viewport import add_markers, add_line
+
+def add_journal(db_path, journal_id, linked_item_id):
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO journals (id, entry_date, linked_item_id, entry_title, entry_content, is_favorite) VALUES (?, 'May 04, 2024 09:30', ?, 'Planted', '', 'no')",
+                 (journal_id, linked_item_id))
+    conn.commit()
+    conn.close()
+
+def test_items_are_looked_up_together(client, map_folder):
+    folder, db_path = map_folder
+    add_markers(db_path, [(10, 10), (20, 20)])
+    add_line(db_path, 'l1', (0, 0), (5, 5))
+    response = client.get(f'/maps/{folder}/items?ids=Marker:m1,Line:l1,Marker:gone,Tree:m0,Marker:m1')
+    body = response.get_json()
+    assert sorted(body['items']) == ['Line:l1', 'Marker:m1']
+    assert body['items']['Marker:m1']['lat'] == 20
+    assert body['items']['Line:l1']['lineId'] == 'l1'
+    assert body['missing'] == ['Marker:gone']
+
+def test_lookups_are_chunked(client, map_folder, monkeypatch):
+    folder, db_path = map_folder
+    add_markers(db_path, [(i, i) for i in range(25)])
+    monkeypatch.setattr(views, 'ID_QUERY_CHUNK', 10)
+    ids = ','.join(f'Marker:m{i}' for i in range(25))
+    assert len(client.get(f'/maps/{folder}/items?ids={ids}').get_json()['items']) == 25
+
+def test_journals_carry_their_linked_items(client, map_folder):
+    folder, db_path = map_folder
+    add_markers(db_path, [(10, 10)])
+    add_line(db_path, 'l1', (0, 0), (5, 5))
+    add_journal(db_path, 'j1', 'Marker:m0,Line:l1')
+    add_journal(db_path, 'j2', 'Line:deleted')
+    journals = {journal['id']: journal for journal in client.get(f'/journals/{folder}?full=true').get_json()['journals']}
+    assert [(item['id'], item['item']['info']) for item in journals['j1']['linked_items']] == [('Marker:m0', 'marker 0'), ('Line:l1', 'l1')]
+    assert journals['j2']['linked_items'] == [{'id': 'Line:deleted', 'type': 'Line', 'item': None}]
+    entry = client.get(f'/journals/{folder}/j1').get_json()
+    assert entry['linked_items'][0]['item']['markerId'] == 'm0'
+
+def test_too_many_ids_are_rejected(client, map_folder):
+    folder, _ = map_folder
+    ids = ','.join(f'Marker:m{i}' for i in range(views.MAX_ITEM_LOOKUP + 1))
+    assert client.get(f'/maps/{folder}/items?ids={ids}').status_code == 400
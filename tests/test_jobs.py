@@ -0,0 +1,89 @@
+import io
+import os
+import json
+import time
+import uuid
+import sqlite3
+import shutil
+from PIL import Image
+from gogrow_app import app
+from gogrow_app.jobs import JobQueue
+
+def wait_for(get_job, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = get_job()
+        if job and job['status'] in ('done', 'failed'):
+            return job
+        time.sleep(0.1)
+    raise AssertionError('job did not finish')
+
+def save_image(path, size=(600, 400)):
+    Image.new('RGB', size, (40, 160, 40)).save(path)
+
+def test_ingest_job_makes_the_thumbnail_and_tiles(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.db'), workers=1)
+    queue.start()
+    save_image(str(tmp_path / 'garden.jpg'))
+    job_id = queue.submit('ingest_image', {'folder': str(tmp_path), 'filename': 'garden.jpg', 'thumbnail': 'thumbnail-garden.png'})
+    job = wait_for(lambda: queue.get(job_id))
+    assert (job['status'], job['progress']) == ('done', 1)
+    assert job['result'] == {'image': 'garden.jpg', 'thumbnail': 'thumbnail-garden.png', 'max_zoom': 2, 'sha256': None}
+    with Image.open(tmp_path / 'thumbnail-garden.png') as thumbnail:
+        assert max(thumbnail.size) == 200
+    assert os.path.exists(tmp_path / 'tiles' / '2' / '0' / '0.jpg')
+
+def test_failed_job_keeps_its_error(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.db'), workers=1)
+    queue.start()
+    (tmp_path / 'garden.jpg').write_bytes(b'not an image')
+    job_id = queue.submit('ingest_image', {'folder': str(tmp_path), 'filename': 'garden.jpg', 'thumbnail': 'thumbnail-garden.png'})
+    job = wait_for(lambda: queue.get(job_id))
+    assert job['status'] == 'failed'
+    assert 'garden.jpg' in job['message']
+
+def test_jobs_running_at_shutdown_run_again(tmp_path):
+    db_path = str(tmp_path / 'jobs.db')
+    JobQueue(db_path).start()
+    save_image(str(tmp_path / 'garden.jpg'))
+    # A job that was running when the server stopped
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO jobs (id, kind, status, progress, payload, created_at, updated_at) VALUES ('left-over', 'ingest_image', 'running', 0.5, ?, ?, ?)",
+                 (json.dumps({'folder': str(tmp_path), 'filename': 'garden.jpg', 'thumbnail': 'thumbnail-garden.png'}), time.time(), time.time()))
+    conn.commit()
+    conn.close()
+
+    queue = JobQueue(db_path, workers=1)
+    queue.start()
+    assert wait_for(lambda: queue.get('left-over'))['status'] == 'done'
+    assert os.path.exists(tmp_path / 'thumbnail-garden.png')
+
+def test_uploaded_image_is_processed_in_the_background(client, job_workers):
+    name = f'upload_{uuid.uuid4().hex[:8]}'
+    image = io.BytesIO()
+    Image.new('RGB', (300, 300), (40, 160, 40)).save(image, 'PNG')
+    image.seek(0)
+    folder_path = os.path.join(app.config['IMG_DIR'], name)
+    try:
+        client.post('/', data={'image': (image, f'{name}.png')}, content_type='multipart/form-data')
+        with client.session_transaction() as session:
+            job_id = session['ingest_job_id']
+        # The upload itself is saved before the job runs
+        assert os.path.exists(os.path.join(folder_path, f'{name}.png'))
+        job = wait_for(lambda: client.get(f'/jobs/{job_id}').get_json())
+        assert job['status'] == 'done'
+        assert os.path.exists(os.path.join(folder_path, f'thumbnail-{name}.png'))
+    finally:
+        shutil.rmtree(folder_path, ignore_errors=True)
+
+def test_unknown_job(client):
+    assert client.get('/jobs/nothing-like-it').status_code == 404
+
+def test_jobs_wait_in_the_queue_until_it_starts(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.db'), workers=1)
+    save_image(str(tmp_path / 'garden.jpg'))
+    job_id = queue.submit('ingest_image', {'folder': str(tmp_path), 'filename': 'garden.jpg', 'thumbnail': 'thumbnail-garden.png'})
+    time.sleep(0.5)
+    assert queue.get(job_id)['status'] == 'queued'
+    queue.start()
+    assert wait_for(lambda: queue.get(job_id))['status'] == 'done'
@@ -0,0 +1,73 @@
+import sqlite3
+from datetime import datetime
+from gogrow_app.database import ensure_schema, journal_timestamp
+from test_changes import create_unversioned_map
+
+def journal(day, title, content='', **fields):
+    return {'op': 'insert', 'kind': 'journals', 'id': f'j{day:02}', 'entry_date': f'2024-05-{day:02}T09:30',
+            'entry_title': title, 'entry_content': content, **fields}
+
+def add_journals(client, folder, operations):
+    assert client.post(f'/maps/{folder}/batch', json=operations).get_json()['failed'] == 0
+
+def page_ids(client, url):
+    ids = []
+    while url:
+        page = client.get(url).get_json()
+        ids.extend(entry['id'] for entry in page['journals'])
+        url = page['next_cursor'] and f"{url.split('&cursor=')[0]}&cursor={page['next_cursor']}"
+    return ids
+
+def test_existing_dates_are_read_by_the_migration(map_folder):
+    _, db_path = map_folder
+    create_unversioned_map(db_path, 8)
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO journals (id, entry_date, entry_title, entry_content) VALUES ('a', 'May 04, 2024 09:30', 'Planted', '')")
+    conn.execute("INSERT INTO journals (id, entry_date, entry_title, entry_content) VALUES ('b', 'sometime in spring', 'Sowed', '')")
+    conn.commit()
+    conn.close()
+    ensure_schema(db_path)
+    conn = sqlite3.connect(db_path)
+    times = dict(conn.execute('SELECT id, entry_time FROM journals'))
+    conn.close()
+    assert times == {'a': int(datetime(2024, 5, 4, 9, 30).timestamp()), 'b': 0}
+
+def test_batch_writes_dates_in_the_shown_format(client, map_folder):
+    folder, db_path = map_folder
+    add_journals(client, folder, [journal(4, 'Planted')])
+    conn = sqlite3.connect(db_path)
+    assert conn.execute('SELECT entry_date, entry_time FROM journals').fetchone() == ('May 04, 2024 09:30', journal_timestamp('2024-05-04T09:30'))
+    conn.close()
+
+def test_pages_follow_the_cursor_in_every_order(client, map_folder):
+    folder, _ = map_folder
+    add_journals(client, folder, [journal(day, f'Day {day}', is_favorite='yes' if day % 3 == 0 else 'no') for day in range(1, 13)])
+    newest = page_ids(client, f'/journals/{folder}?limit=5')
+    assert newest == [f'j{day:02}' for day in range(12, 0, -1)]
+    assert page_ids(client, f'/journals/{folder}?limit=5&sort=oldest') == newest[::-1]
+    assert page_ids(client, f'/journals/{folder}?limit=3&sort=favorites')[:4] == ['j12', 'j09', 'j06', 'j03']
+    assert page_ids(client, f'/journals/{folder}?favorite=yes&sort=oldest') == ['j03', 'j06', 'j09', 'j12']
+    # to includes the whole of its day
+    assert page_ids(client, f'/journals/{folder}?from=2024-05-03&to=2024-05-05&sort=oldest') == ['j03', 'j04', 'j05']
+
+def test_journals_are_summarized_unless_asked_for_in_full(client, map_folder):
+    folder, _ = map_folder
+    long_text = ' '.join(['tomatoes'] * 100)
+    add_journals(client, folder, [journal(1, 'Planted', f'<p>{long_text}</p><img src="data:image/png;base64,AAAA">', linked_item_id='Marker:m1,Line:l1')])
+    summary = client.get(f'/journals/{folder}').get_json()['journals'][0]
+    assert 'entry_content' not in summary and 'linked_items' not in summary
+    assert summary['excerpt'].startswith('tomatoes tomatoes') and summary['excerpt'].endswith('…')
+    assert len(summary['excerpt']) <= 201 and summary['link_count'] == 2
+    # Once the journal is in the search index, the excerpt comes from there
+    client.get(f'/maps/{folder}/search?q=tomatoes')
+    assert client.get(f'/journals/{folder}').get_json()['journals'][0]['excerpt'] == summary['excerpt']
+    full = client.get(f'/journals/{folder}?full=true').get_json()['journals'][0]
+    assert full['entry_content'].startswith('<p>tomatoes') and len(full['linked_items']) == 2
+
+def test_invalid_paging_is_rejected(client, map_folder):
+    folder, _ = map_folder
+    assert client.get(f'/journals/{folder}?sort=alphabetical').status_code == 400
+    assert client.get(f'/journals/{folder}?limit=0').status_code == 400
+    assert client.get(f'/journals/{folder}?cursor=nonsense').status_code == 400
+    assert client.get(f'/journals/{folder}?favorite=maybe').status_code == 400
+    assert client.get(f'/journals/{folder}?from=yesterday').status_code == 400
@@ -0,0 +1,97 @@
+import os
+import sqlite3
+from gogrow_app.database import ConnectionManager, SchemaRegistry, schema_registry, ensure_schema
+
+def columns(db_path, table):
+    conn = sqlite3.connect(db_path)
+    try:
+        return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    finally:
+        conn.close()
+
+def user_version(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        conn.close()
+
+def counting_registry(calls):
+    registry = SchemaRegistry(ConnectionManager())
+
+    @registry.migration(2, 'add a column')
+    def add_column(conn):
+        calls.append(2)
+        conn.execute('ALTER TABLE plants ADD COLUMN height REAL')
+
+    @registry.migration(1, 'create a table')
+    def create_table(conn):
+        calls.append(1)
+        conn.execute('CREATE TABLE plants (id TEXT PRIMARY KEY)')
+
+    return registry
+
+def test_new_map_gets_the_current_schema(tmp_path):
+    db_path = str(tmp_path / 'garden.db')
+    ensure_schema(db_path)
+    assert user_version(db_path) == schema_registry.version
+    assert 'is_favorite' in columns(db_path, 'journals')
+    assert columns(db_path, 'markers')[:2] == ['id', 'lat']
+
+def test_old_journals_table_is_migrated_in_place(tmp_path):
+    db_path = str(tmp_path / 'garden.db')
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE journals (id TEXT PRIMARY KEY, entry_date TEXT NOT NULL, linked_item_id TEXT, entry_title TEXT NOT NULL, entry_content TEXT NOT NULL)')
+    conn.execute("INSERT INTO journals VALUES ('j1', 'May 04, 2024 09:30', NULL, 'Planted', 'Tomatoes')")
+    conn.commit()
+    conn.close()
+
+    ensure_schema(db_path)
+    conn = sqlite3.connect(db_path)
+    assert conn.execute('SELECT entry_title, is_favorite FROM journals').fetchall() == [('Planted', 'no')]
+    conn.close()
+
+def test_migrations_run_in_order_and_only_once(tmp_path):
+    calls = []
+    registry = counting_registry(calls)
+    db_path = str(tmp_path / 'garden.db')
+    registry.ensure(db_path)
+    registry.forget(db_path)
+    registry.ensure(db_path)
+    assert calls == [1, 2]
+    assert user_version(db_path) == 2
+    assert columns(db_path, 'plants') == ['id', 'height']
+
+def test_current_files_are_not_opened_again(tmp_path):
+    registry = counting_registry([])
+    db_path = str(tmp_path / 'garden.db')
+    registry.ensure(db_path)
+    misses = registry._manager.stats()['misses'] + registry._manager.stats()['hits']
+    registry.ensure(db_path)
+    assert registry._manager.stats()['misses'] + registry._manager.stats()['hits'] == misses
+
+def test_replaced_file_is_checked_again(tmp_path):
+    calls = []
+    registry = counting_registry(calls)
+    db_path = str(tmp_path / 'garden.db')
+    registry.ensure(db_path)
+    registry._manager.close_all()
+    os.remove(db_path)
+    sqlite3.connect(db_path).close()  # e.g. restored from an old backup
+    registry.ensure(db_path)
+    assert calls == [1, 2, 1, 2]
+
+def test_failed_migration_leaves_the_database_as_it_was(tmp_path):
+    registry = counting_registry([])
+
+    @registry.migration(3, 'fail halfway')
+    def fail(conn):
+        conn.execute('CREATE TABLE harvests (id TEXT)')
+        raise RuntimeError('disk full')
+
+    db_path = str(tmp_path / 'garden.db')
+    registry.ensure(db_path)
+    assert user_version(db_path) == 0
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall() == []
+    conn.close()
@@ -0,0 +1,75 @@
+import sqlite3
+from gogrow_app.database import ensure_schema, get_db_connection
+from gogrow_app.search import strip_html, search, index_search, needs_indexing, SEARCH_INLINE_LIMIT
+
+def add_journal(db_path, journal_id, title, content):
+    ensure_schema(db_path)
+    conn = get_db_connection(db_path)
+    conn.execute("INSERT INTO journals (id, entry_date, entry_title, entry_content) VALUES (?, 'May 04, 2024 09:30', ?, ?)",
+                 (journal_id, title, content))
+    conn.commit()
+    conn.close()
+
+def test_html_is_stripped_to_words():
+    assert strip_html('<p>Tomatoes</p><p>planted <strong>today</strong> &amp; watered</p><img src="data:...">') == 'Tomatoes planted today & watered'
+    assert strip_html('plain text') == 'plain text'
+    assert strip_html(None) == ''
+
+def test_search_finds_journals_markers_and_lines(client, map_folder):
+    folder, db_path = map_folder
+    add_journal(db_path, 'j1', 'Watering', '<p>The <em>tomatoes</em> need water</p>')
+    add_journal(db_path, 'j2', 'Tomatoes', '<p>Planted in the raised bed</p>')
+    client.get(f'/markers/{folder}')
+    client.post(f'/markers/{folder}', json={'lat': 1, 'lng': 1, 'info': 'Tomato patch', 'iconType': 'leaf.svg', 'iconColor': '#00ff00', 'markerNotes': ''})
+    result = client.get(f'/maps/{folder}/search?q=tomat').get_json()
+    assert result['total'] == 3 and result['pending'] == 0
+    # Matches in a title rank above one in the text, and the last word matches as a prefix
+    assert sorted(hit['title'] for hit in result['hits'][:2]) == ['<mark>Tomato</mark> patch', '<mark>Tomatoes</mark>']
+    assert sorted(hit['kind'] for hit in result['hits'][:2]) == ['journals', 'markers']
+    assert result['hits'][2]['id'] == 'j1'
+    assert '<mark>tomatoes</mark> need water' in result['hits'][2]['snippet']
+
+def test_writes_are_searchable_right_away(client, map_folder):
+    folder, db_path = map_folder
+    add_journal(db_path, 'j1', 'Compost', 'Turned the heap')
+    assert client.get(f'/maps/{folder}/search?q=compost').get_json()['total'] == 1
+    conn = get_db_connection(db_path)
+    conn.execute("UPDATE journals SET entry_title = 'Mulch' WHERE id = 'j1'")
+    conn.commit()
+    conn.close()
+    assert client.get(f'/maps/{folder}/search?q=compost').get_json()['total'] == 0
+    assert client.get(f'/maps/{folder}/search?q=mulch').get_json()['total'] == 1
+
+def test_query_syntax_is_not_interpreted(client, map_folder):
+    folder, db_path = map_folder
+    add_journal(db_path, 'j1', 'Beans', 'Runner beans OR peas')
+    assert client.get(f'/maps/{folder}/search?q=beans OR').get_json()['total'] == 1
+    assert client.get(f'/maps/{folder}/search?q="NEAR(beans').get_json()['total'] == 0
+
+def test_large_backlogs_are_left_to_the_index_job(map_folder):
+    folder, db_path = map_folder
+    ensure_schema(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.executemany("INSERT INTO journals (id, entry_date, entry_title, entry_content) VALUES (?, 'May 04, 2024 09:30', 'Seedling', '')",
+                     [(f'j{i}',) for i in range(2600)])
+    conn.commit()
+    conn.close()
+    result = search({folder: db_path}, 'seedling')
+    assert (result['total'], result['pending']) == (SEARCH_INLINE_LIMIT, 2600 - SEARCH_INLINE_LIMIT)
+    assert needs_indexing(db_path)
+    index_search({'db_paths': [db_path]}, lambda fraction, message=None: None)
+    assert not needs_indexing(db_path)
+    assert search({folder: db_path}, 'seedling')['total'] == 2600
+
+def test_search_across_maps_ranks_together(client, map_folder):
+    folder, db_path = map_folder
+    add_journal(db_path, 'j1', 'Garlic', 'Planted garlic')
+    result = client.get(f'/maps/{folder}/search?q=garlic&all=true').get_json()
+    assert [(hit['folder'], hit['id']) for hit in result['hits']] == [(folder, 'j1')]
+
+def test_invalid_searches_are_rejected(client, map_folder):
+    folder, _ = map_folder
+    assert client.get(f'/maps/{folder}/search?q=').status_code == 400
+    assert client.get(f'/maps/{folder}/search?q=a&limit=0').status_code == 400
+    assert client.get(f'/maps/{folder}/search?q=a&limit=1000').status_code == 400
+    assert client.get(f'/maps/{folder}/search?q=a&offset=-1').status_code == 400
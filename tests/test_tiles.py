@@ -0,0 +1,65 @@
+import io
+import os
+from PIL import Image
+
+def save_map_image(folder_path, size, color=(40, 160, 40), name='garden.jpg'):
+    path = os.path.join(folder_path, name)
+    Image.new('RGB', size, color).save(path)
+    return path
+
+def open_tile(response):
+    return Image.open(io.BytesIO(response.data))
+
+def test_info_describes_the_pyramid(client, map_folder):
+    folder, db_path = map_folder
+    save_map_image(os.path.dirname(db_path), (1000, 300))
+    info = client.get(f'/tiles/{folder}/info').get_json()
+    assert (info['width'], info['height'], info['tile_size']) == (1000, 300, 256)
+    assert (info['min_zoom'], info['max_zoom']) == (0, 2)
+    assert info['url'] == f"/tiles/{folder}/{{z}}/{{x}}/{{y}}?v={info['version']}"
+
+def test_tiles_are_cut_per_level(client, map_folder):
+    folder, db_path = map_folder
+    save_map_image(os.path.dirname(db_path), (1000, 300))
+    whole = open_tile(client.get(f'/tiles/{folder}/0/0/0'))
+    assert whole.size == (256, 256)
+    full = open_tile(client.get(f'/tiles/{folder}/2/0/0'))
+    assert (full.format, full.size) == ('JPEG', (256, 256))
+    # The bottom right tile of the full resolution level is padded with transparency
+    edge = open_tile(client.get(f'/tiles/{folder}/2/3/1'))
+    assert (edge.format, edge.size) == ('PNG', (256, 256))
+    assert edge.getpixel((255, 255))[3] == 0
+    assert edge.getpixel((0, 0))[3] == 255
+
+def test_tiles_out_of_range_are_not_found(client, map_folder):
+    folder, db_path = map_folder
+    save_map_image(os.path.dirname(db_path), (1000, 300))
+    assert client.get(f'/tiles/{folder}/3/0/0').status_code == 404
+    assert client.get(f'/tiles/{folder}/2/4/0').status_code == 404
+    assert client.get(f'/tiles/{folder}/2/0/2').status_code == 404
+
+def test_tiles_are_revalidated_or_cached_for_good(client, map_folder):
+    folder, db_path = map_folder
+    save_map_image(os.path.dirname(db_path), (600, 600))
+    response = client.get(f'/tiles/{folder}/1/0/0')
+    assert client.get(f'/tiles/{folder}/1/0/0', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    version = client.get(f'/tiles/{folder}/info').get_json()['version']
+    response = client.get(f'/tiles/{folder}/1/0/0?v={version}')
+    assert 'immutable' in response.headers['Cache-Control']
+
+def test_a_new_map_image_replaces_the_tiles(client, map_folder):
+    folder, db_path = map_folder
+    folder_path = os.path.dirname(db_path)
+    path = save_map_image(folder_path, (600, 600), color=(255, 0, 0))
+    version = client.get(f'/tiles/{folder}/info').get_json()['version']
+    assert open_tile(client.get(f'/tiles/{folder}/0/0/0')).getpixel((100, 100))[0] > 200
+
+    save_map_image(folder_path, (600, 600), color=(0, 0, 255), name='garden.tmp.jpg')
+    os.replace(os.path.join(folder_path, 'garden.tmp.jpg'), path)
+    assert client.get(f'/tiles/{folder}/info').get_json()['version'] != version
+    assert open_tile(client.get(f'/tiles/{folder}/0/0/0')).getpixel((100, 100))[2] > 200
+
+def test_folder_without_an_image(client, map_folder):
+    folder, _ = map_folder
+    assert client.get(f'/tiles/{folder}/info').status_code == 404
+    assert client.get(f'/tiles/{folder}/0/0/0').status_code == 404
@@ -0,0 +1,86 @@
+import io
+import os
+import uuid
+import shutil
+import hashlib
+import pytest
+from PIL import Image
+from gogrow_app import app
+from test_jobs import wait_for
+
+@pytest.fixture
+def image_bytes():
+    image = io.BytesIO()
+    Image.new('RGB', (400, 300), (40, 160, 40)).save(image, 'PNG')
+    return image.getvalue()
+
+@pytest.fixture
+def upload_name():
+    """The name of a map uploaded by the test - its folder is removed afterwards."""
+    name = f'upload_{uuid.uuid4().hex[:8]}'
+    yield name
+    shutil.rmtree(os.path.join(app.config['IMG_DIR'], name), ignore_errors=True)
+
+def start(client, name, data, **extra):
+    return client.post('/uploads', json={'filename': f'{name}.png', 'size': len(data), **extra})
+
+def put_chunk(client, url, data, begin, end, total):
+    return client.put(url, data=data[begin:end], headers={'Content-Range': f'bytes {begin}-{end - 1}/{total}'})
+
+def test_chunked_upload_is_assembled_and_processed(client, upload_name, image_bytes, job_workers):
+    total = len(image_bytes)
+    upload = start(client, upload_name, image_bytes, sha256=hashlib.sha256(image_bytes).hexdigest()).get_json()
+    assert (upload['folder'], upload['offset']) == (upload_name, 0)
+
+    middle = total // 2
+    response = put_chunk(client, upload['url'], image_bytes, 0, middle, total)
+    assert (response.status_code, response.get_json()['offset']) == (202, middle)
+    response = put_chunk(client, upload['url'], image_bytes, middle, total, total)
+    assert response.status_code == 200
+    done = response.get_json()
+    assert done['sha256'] == hashlib.sha256(image_bytes).hexdigest()
+
+    folder_path = os.path.join(app.config['IMG_DIR'], upload_name)
+    with open(os.path.join(folder_path, f'{upload_name}.png'), 'rb') as image_file:
+        assert image_file.read() == image_bytes
+    assert os.listdir(os.path.join(folder_path, 'incoming')) == []
+    assert wait_for(lambda: client.get(f"/jobs/{done['job_id']}").get_json())['status'] == 'done'
+
+def test_interrupted_upload_resumes_at_its_offset(client, upload_name, image_bytes):
+    total = len(image_bytes)
+    upload = start(client, upload_name, image_bytes).get_json()
+    put_chunk(client, upload['url'], image_bytes, 0, 100, total)
+    assert client.get(upload['url']).get_json() == {'upload_id': upload['upload_id'], 'offset': 100, 'size': total}
+
+    # A chunk that doesn't continue at the offset is refused and says where to continue
+    response = put_chunk(client, upload['url'], image_bytes, 50, 150, total)
+    assert (response.status_code, response.get_json()['offset']) == (409, 100)
+    assert put_chunk(client, upload['url'], image_bytes, 100, total, total).status_code == 200
+
+def test_bytes_beyond_the_declared_size_are_thrown_away(client, upload_name, image_bytes):
+    upload = start(client, upload_name, image_bytes[:100]).get_json()
+    response = client.put(upload['url'], data=image_bytes[:150])
+    assert (response.status_code, response.get_json()['offset']) == (413, 0)
+    assert client.get(upload['url']).get_json()['offset'] == 0
+
+def test_checksum_mismatch_discards_the_upload(client, upload_name, image_bytes):
+    upload = start(client, upload_name, image_bytes, sha256='0' * 64).get_json()
+    assert client.put(upload['url'], data=image_bytes).status_code == 422
+    assert client.get(upload['url']).status_code == 404
+    assert not os.path.exists(os.path.join(app.config['IMG_DIR'], upload_name, f'{upload_name}.png'))
+
+def test_cancelled_upload_is_gone(client, upload_name, image_bytes):
+    upload = start(client, upload_name, image_bytes).get_json()
+    put_chunk(client, upload['url'], image_bytes, 0, 100, len(image_bytes))
+    assert client.delete(upload['url']).status_code == 200
+    assert client.get(upload['url']).status_code == 404
+    assert os.listdir(os.path.join(app.config['IMG_DIR'], upload_name, 'incoming')) == []
+
+def test_invalid_uploads_are_rejected(client, upload_name, image_bytes):
+    assert client.post('/uploads', json={'filename': 'notes.txt', 'size': 10}).status_code == 400
+    assert client.post('/uploads', json={'filename': f'{upload_name}.png', 'size': 0}).status_code == 400
+    assert client.post('/uploads', json={'filename': f'{upload_name}.png', 'size': app.config['MAX_UPLOAD_SIZE'] + 1}).status_code == 413
+    assert start(client, upload_name, image_bytes, sha256='xyz').status_code == 400
+    upload = start(client, upload_name, image_bytes).get_json()
+    assert client.put(upload['url'], data=b'x', headers={'Content-Range': 'bytes 0-0/1'}).status_code == 400
+    assert client.get(f'/uploads/{upload_name}/{uuid.uuid4().hex}').status_code == 404
@@ -0,0 +1,71 @@
+import sqlite3
+from gogrow_app.database import ensure_schema
+
+def add_markers(db_path, points):
+    ensure_schema(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.executemany('INSERT INTO markers (id, lat, lng, info, iconType, iconColor, markerNotes) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     [(f'm{i}', lat, lng, f'marker {i}', 'leaf.svg', '#00ff00', '') for i, (lat, lng) in enumerate(points)])
+    conn.commit()
+    conn.close()
+
+def add_line(db_path, line_id, start, end):
+    ensure_schema(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute('INSERT INTO lines (id, start_lat, start_lng, end_lat, end_lng, info, color, notes) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                 (line_id, *start, *end, line_id, '#ff0000', ''))
+    conn.commit()
+    conn.close()
+
+def test_markers_in_bbox(client, map_folder):
+    folder, db_path = map_folder
+    add_markers(db_path, [(10, 10), (50, 50), (90, 90), (50.5, 200)])
+    response = client.get(f'/markers/{folder}?bbox=40,40,60,60')
+    assert [marker['markerId'] for marker in response.get_json()] == ['m1']
+    assert 'X-Next-Cursor' not in response.headers
+
+def test_markers_moved_out_of_the_bbox_leave_it(client, map_folder):
+    folder, db_path = map_folder
+    add_markers(db_path, [(50, 50)])
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE markers SET lat = 500 WHERE id = 'm0'")
+    conn.commit()
+    conn.close()
+    assert client.get(f'/markers/{folder}?bbox=40,40,60,60').get_json() == []
+    assert len(client.get(f'/markers/{folder}?bbox=400,40,600,60').get_json()) == 1
+
+def test_lines_crossing_the_bbox(client, map_folder):
+    folder, db_path = map_folder
+    add_line(db_path, 'across', (0, 50), (100, 50))
+    add_line(db_path, 'outside', (0, 200), (100, 200))
+    lines = client.get(f'/lines/{folder}?bbox=40,40,60,60').get_json()
+    assert [line['lineId'] for line in lines] == ['across']
+
+def test_pages_follow_the_next_cursor(client, map_folder):
+    folder, db_path = map_folder
+    add_markers(db_path, [(i, i) for i in range(25)])
+    seen, url = [], f'/markers/{folder}?limit=10'
+    while True:
+        response = client.get(url)
+        seen.extend(marker['markerId'] for marker in response.get_json())
+        cursor = response.headers.get('X-Next-Cursor')
+        if cursor is None:
+            break
+        url = f'/markers/{folder}?limit=10&cursor={cursor}'
+    assert seen == [f'm{i}' for i in range(25)]
+
+def test_bbox_and_paging_combine(client, map_folder):
+    folder, db_path = map_folder
+    add_markers(db_path, [(i, 0 if i % 2 else 1000) for i in range(20)])
+    response = client.get(f'/markers/{folder}?bbox=0,-1,100,1&limit=5')
+    first = [marker['markerId'] for marker in response.get_json()]
+    response = client.get(f"/markers/{folder}?bbox=0,-1,100,1&limit=5&cursor={response.headers['X-Next-Cursor']}")
+    second = [marker['markerId'] for marker in response.get_json()]
+    assert first + second == [f'm{i}' for i in range(1, 20, 2)]
+
+def test_invalid_viewport_arguments_are_rejected(client, map_folder):
+    folder, _ = map_folder
+    assert client.get(f'/markers/{folder}?bbox=1,2,3').status_code == 400
+    assert client.get(f'/markers/{folder}?bbox=60,40,40,60').status_code == 400
+    assert client.get(f'/lines/{folder}?limit=0').status_code == 400
+    assert client.get(f'/lines/{folder}?cursor=abc').status_code == 400